@@ -0,0 +1,324 @@
+"""端口转发基准测试
+
+在本机启动 echo / sink 目标服务，在子进程中运行转发服务，
+用 asyncio 客户端发起 1 到上万个并发连接，输出 JSON 格式的结果：
+吞吐量、往返延迟 p50/p99、转发进程 CPU 时间和峰值内存。
+
+用法:
+    python bench_forward.py --connections 1,100,1000 --payload 4096 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import port_forward
+
+
+def raise_fd_limit():
+    """尽量提高文件描述符上限，上万个连接需要两倍以上的描述符"""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY:
+            hard = 65536
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def fd_limit():
+    if resource is None:
+        return None
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def peak_rss_kb():
+    """当前进程的峰值内存（KB）
+
+    Linux 上优先读取 VmHWM：ru_maxrss 会把 fork 时父进程的内存也算进来。
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+
+def process_usage():
+    """当前进程的 CPU 时间（秒）和峰值内存（KB）"""
+    times = os.times()
+    return {"cpu": times.user + times.system, "peak_rss_kb": peak_rss_kb()}
+
+
+def serve_forwarder(args):
+    """子进程：运行转发服务，通过标准输入输出与主进程交互"""
+    raise_fd_limit()
+    service = port_forward.ForwardService(bufsize=args.bufsize)
+    rule = port_forward.ForwardRule("TCP", "127.0.0.1", 0, "127.0.0.1", args.target_port,
+                                    splice=args.splice)
+    forwarder = service.add_rule(rule, map_upnp=False)
+    print(forwarder.server_socket.getsockname()[1], flush=True)
+
+    for line in sys.stdin:
+        command = line.strip()
+        if command == "stats":
+            result = process_usage()
+            stats = service.get_stats()
+            if stats:
+                snapshot = stats[0][1]
+                result["connect_p50_ms"] = snapshot["connect_p50"]
+                result["connect_p99_ms"] = snapshot["connect_p99"]
+                result["errors"] = snapshot["errors"]
+            print(json.dumps(result), flush=True)
+        elif command == "stop":
+            break
+    service.stop()
+
+
+class ForwarderProcess:
+    """在子进程中运行的转发服务"""
+
+    def __init__(self, target_port, bufsize, splice):
+        command = [sys.executable, os.path.abspath(__file__), "--serve-forwarder",
+                   "--target-port", str(target_port), "--bufsize", str(bufsize)]
+        if splice:
+            command.append("--splice")
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        text=True)
+        self.port = int(self.process.stdout.readline())
+
+    def stats(self):
+        self.process.stdin.write("stats\n")
+        self.process.stdin.flush()
+        return json.loads(self.process.stdout.readline())
+
+    def stop(self):
+        try:
+            self.process.stdin.write("stop\n")
+            self.process.stdin.flush()
+            self.process.wait(10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+async def handle_echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        # 服务关闭时未结束的连接会被取消
+        pass
+    finally:
+        writer.close()
+
+
+async def handle_sink(reader, writer):
+    try:
+        while await reader.read(65536):
+            pass
+    except (ConnectionError, asyncio.CancelledError):
+        # 服务关闭时未结束的连接会被取消
+        pass
+    finally:
+        writer.close()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(len(values) * p / 100 + 0.5) - 1))
+    return values[index]
+
+
+async def open_connections(port, count, connect_limit):
+    """建立 count 个到转发端口的连接，同时进行的握手数受 connect_limit 限制"""
+    semaphore = asyncio.Semaphore(connect_limit)
+
+    async def connect():
+        async with semaphore:
+            return await asyncio.open_connection("127.0.0.1", port)
+
+    results = await asyncio.gather(*(connect() for _ in range(count)), return_exceptions=True)
+    connections = [r for r in results if not isinstance(r, BaseException)]
+    return connections, len(results) - len(connections)
+
+
+async def run_echo(port, args, connections_count):
+    connections, errors = await open_connections(port, connections_count, args.connect_limit)
+    payload = os.urandom(args.payload)
+    rtts = []
+
+    async def client(reader, writer):
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            writer.write(payload)
+            await writer.drain()
+            await reader.readexactly(len(payload))
+            rtts.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(client(r, w) for r, w in connections), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    errors += sum(1 for r in results if isinstance(r, BaseException))
+    return {
+        "elapsed_s": elapsed,
+        "bytes": len(rtts) * len(payload) * 2,
+        "rtt_p50_ms": _ms(percentile(rtts, 50)),
+        "rtt_p99_ms": _ms(percentile(rtts, 99)),
+        "client_errors": errors,
+    }
+
+
+async def run_sink(port, args, connections_count):
+    connections, errors = await open_connections(port, connections_count, args.connect_limit)
+    chunk = os.urandom(min(args.payload, args.sink_bytes))
+    sent = [0]
+
+    async def client(reader, writer):
+        remaining = args.sink_bytes
+        while remaining > 0:
+            data = chunk[:remaining]
+            writer.write(data)
+            await writer.drain()
+            remaining -= len(data)
+            sent[0] += len(data)
+        writer.write_eof()
+        await reader.read()
+        writer.close()
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(client(r, w) for r, w in connections), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    errors += sum(1 for r in results if isinstance(r, BaseException))
+    return {
+        "elapsed_s": elapsed,
+        "bytes": sent[0],
+        "rtt_p50_ms": None,
+        "rtt_p99_ms": None,
+        "client_errors": errors,
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+async def run_case(mode, connections_count, args):
+    handler = handle_echo if mode == "echo" else handle_sink
+    server = await asyncio.start_server(handler, "127.0.0.1", 0, backlog=4096)
+    target_port = server.sockets[0].getsockname()[1]
+    forwarder = ForwarderProcess(target_port, args.bufsize, args.splice)
+    try:
+        before = forwarder.stats()
+        if mode == "echo":
+            result = await run_echo(forwarder.port, args, connections_count)
+        else:
+            result = await run_sink(forwarder.port, args, connections_count)
+        after = forwarder.stats()
+    finally:
+        forwarder.stop()
+        server.close()
+        await server.wait_closed()
+
+    elapsed = result.pop("elapsed_s")
+    total_bytes = result.pop("bytes")
+    return {
+        "mode": mode,
+        "connections": connections_count,
+        "payload": args.payload,
+        "elapsed_s": elapsed,
+        "bytes": total_bytes,
+        "throughput_mb_s": total_bytes / elapsed / 1e6 if elapsed else None,
+        **result,
+        "forwarder_cpu_s": after["cpu"] - before["cpu"],
+        "forwarder_peak_rss_kb": after["peak_rss_kb"],
+        "connect_p50_ms": after.get("connect_p50_ms"),
+        "connect_p99_ms": after.get("connect_p99_ms"),
+        "forwarder_errors": after.get("errors", {}),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="端口转发基准测试")
+    parser.add_argument("--connections", default="1,10,100,1000",
+                        help="并发连接数列表，逗号分隔（默认 1,10,100,1000）")
+    parser.add_argument("--payload", type=int, default=4096, help="每次发送的数据大小（字节）")
+    parser.add_argument("--rounds", type=int, default=20, help="echo 模式下每个连接的往返次数")
+    parser.add_argument("--sink-bytes", type=int, default=4 * 1024 * 1024,
+                        help="sink 模式下每个连接发送的总字节数")
+    parser.add_argument("--mode", choices=["echo", "sink", "both"], default="both")
+    parser.add_argument("--bufsize", type=int, default=port_forward.BUFFER_SIZE, help="转发缓冲区大小")
+    parser.add_argument("--splice", action="store_true", help="使用零拷贝转发")
+    parser.add_argument("--connect-limit", type=int, default=200, help="同时进行的连接握手数")
+    parser.add_argument("--output", help="结果 JSON 文件路径（默认输出到标准输出）")
+    parser.add_argument("--serve-forwarder", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--target-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve_forwarder:
+        serve_forwarder(args)
+        return
+
+    raise_fd_limit()
+    modes = ["echo", "sink"] if args.mode == "both" else [args.mode]
+    counts = [int(c) for c in args.connections.split(",") if c.strip()]
+
+    results = []
+    limit = fd_limit()
+    for mode in modes:
+        for count in counts:
+            # 本进程同时持有客户端和目标端的套接字
+            if limit is not None and 2 * count + 64 > limit:
+                print(f"{mode:>4} {count:>6} 连接: 跳过，文件描述符上限 {limit} 不足", file=sys.stderr)
+                results.append({"mode": mode, "connections": count,
+                                "skipped": f"RLIMIT_NOFILE {limit} too low"})
+                continue
+            result = asyncio.run(run_case(mode, count, args))
+            results.append(result)
+            print(f"{mode:>4} {count:>6} 连接: {result['throughput_mb_s']:.1f} MB/s, "
+                  f"转发CPU {result['forwarder_cpu_s']:.2f}s", file=sys.stderr)
+
+    report = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "splice": args.splice and port_forward.SPLICE_AVAILABLE,
+        "bufsize": args.bufsize,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
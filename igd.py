@@ -0,0 +1,338 @@
+"""UPnP 网关（IGD）的发现与连接缓存
+
+启动时直接用保存的根描述地址连接上次使用的网关（miniupnpc selectigd(url)），
+不再等待 SSDP 发现；缓存的设备无响应时才退回完整的发现流程。
+
+网络中有多个网关（Mesh、双重 NAT）时，收集所有响应的网关并测量控制请求的
+往返时间，按策略或由用户选择使用哪一个。
+"""
+import collections
+import ipaddress
+import json
+import os
+import socket
+import threading
+import time
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+# 缓存文件位置
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".upnp_gui")
+CACHE_PATH = os.path.join(CACHE_DIR, "igd.json")
+
+# 各路由器的功能档案，按设备 UDN 保存
+PROFILES_PATH = os.path.join(CACHE_DIR, "profiles.json")
+
+# 读取根描述的超时（秒）
+DESCRIPTION_TIMEOUT = 3
+
+# SSDP 组播地址
+SSDP_ADDR = ("239.255.255.250", 1900)
+
+# 搜索的设备类型
+IGD_DEVICE = "urn:schemas-upnp-org:device:InternetGatewayDevice:1"
+IGD_DEVICE_V2 = "urn:schemas-upnp-org:device:InternetGatewayDevice:2"
+
+# SSDP 搜索等待响应的时间（秒）
+SSDP_TIMEOUT = 2.0
+
+# 自适应发现窗口（秒）：没有响应时每隔 RESEND 重发一次，最长等待 MAX_WAIT；
+# 收到响应后再过 SETTLE 没有新网关即结束
+DISCOVERY_RESEND = 0.5
+DISCOVERY_MAX_WAIT = 5.0
+DISCOVERY_SETTLE = 0.3
+
+# 网关选择策略：fastest 选往返时间最短的；public 优先外网地址为公网地址的（双重 NAT 时选最外层）
+POLICIES = ("fastest", "public")
+
+# 发现的网关：根描述地址、控制地址、外网IP、控制请求往返时间（秒）、miniupnpc 对象
+Gateway = collections.namedtuple("Gateway", "root_url control_url external_ip rtt upnp")
+
+
+def load_cache(path=CACHE_PATH):
+    """读取缓存的网关信息，不存在或损坏时返回 None"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or not data.get("root_url"):
+        return None
+    return data
+
+
+def save_cache(data, path=CACHE_PATH):
+    """保存网关信息"""
+    _write_json(path, dict(data, saved_at=time.time()))
+
+
+def _write_json(path, data):
+    """先写临时文件再替换，避免中途退出留下损坏的文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = f"{path}.tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(temp, path)
+
+
+def clear_cache(path=CACHE_PATH):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def ssdp_search(search_target=IGD_DEVICE, timeout=SSDP_TIMEOUT):
+    """发送 M-SEARCH，返回响应中去重后的 LOCATION 列表（根描述地址）"""
+    request = ("M-SEARCH * HTTP/1.1\r\n"
+               f"HOST: {SSDP_ADDR[0]}:{SSDP_ADDR[1]}\r\n"
+               'MAN: "ssdp:discover"\r\n'
+               f"MX: {max(1, int(timeout))}\r\n"
+               f"ST: {search_target}\r\n\r\n").encode("ascii")
+    locations = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        sock.sendto(request, SSDP_ADDR)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, addr = sock.recvfrom(65536)
+            except socket.timeout:
+                break
+            except OSError:
+                break
+            location = parse_ssdp_headers(data).get("location")
+            if location and location not in locations:
+                locations.append(location)
+    return locations
+
+
+def discover_locations(resend=DISCOVERY_RESEND, max_wait=DISCOVERY_MAX_WAIT,
+                       settle=DISCOVERY_SETTLE):
+    """自适应窗口的 SSDP 发现，返回所有网关的根描述地址
+
+    同时搜索 IGD:1 和 IGD:2。收到第一个响应后，SETTLE 时间内没有新网关即提前结束；
+    一直没有响应时按 RESEND 间隔重发，直到 MAX_WAIT。
+    """
+    requests = [("M-SEARCH * HTTP/1.1\r\n"
+                 f"HOST: {SSDP_ADDR[0]}:{SSDP_ADDR[1]}\r\n"
+                 'MAN: "ssdp:discover"\r\n'
+                 "MX: 1\r\n"
+                 f"ST: {target}\r\n\r\n").encode("ascii")
+                for target in (IGD_DEVICE, IGD_DEVICE_V2)]
+    locations = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        start = time.monotonic()
+        next_send = start
+        last_new = None
+        while True:
+            now = time.monotonic()
+            if last_new is not None and now - last_new >= settle:
+                break
+            if now - start >= max_wait:
+                break
+            if last_new is None and now >= next_send:
+                for request in requests:
+                    try:
+                        sock.sendto(request, SSDP_ADDR)
+                    except OSError:
+                        pass
+                next_send = now + resend
+            if last_new is None:
+                wait = min(next_send, start + max_wait) - now
+            else:
+                wait = last_new + settle - now
+            sock.settimeout(max(0.01, wait))
+            try:
+                data, addr = sock.recvfrom(65536)
+            except OSError:
+                continue
+            location = parse_ssdp_headers(data).get("location")
+            if location and location not in locations:
+                locations.append(location)
+                last_new = time.monotonic()
+    return locations
+
+
+def probe_gateway(factory, root_url):
+    """连接一个网关并测量 GetExternalIPAddress 的往返时间，失败时返回 None"""
+    try:
+        upnp = factory()
+        control_url = upnp.selectigd(root_url)
+        start = time.monotonic()
+        external_ip = upnp.externalipaddress()
+        rtt = time.monotonic() - start
+    except Exception:
+        return None
+    if not control_url:
+        return None
+    return Gateway(root_url, control_url, external_ip, rtt, upnp)
+
+
+def probe_gateways(factory, root_urls):
+    """并行连接所有网关，返回按往返时间排序的 Gateway 列表"""
+    if not root_urls:
+        return []
+    with ThreadPoolExecutor(max_workers=len(root_urls)) as executor:
+        gateways = [gateway for gateway in executor.map(lambda url: probe_gateway(factory, url), root_urls)
+                    if gateway is not None]
+    return sorted(gateways, key=lambda gateway: gateway.rtt)
+
+
+def is_public(ip):
+    try:
+        return ipaddress.ip_address(ip).is_global
+    except ValueError:
+        return False
+
+
+def select_gateway(gateways, policy="fastest", preferred=None):
+    """按策略选择网关；preferred 为用户上次选择的根描述地址，存在时优先"""
+    if not gateways:
+        return None
+    for gateway in gateways:
+        if preferred and gateway.root_url == preferred:
+            return gateway
+    if policy == "public":
+        public = [gateway for gateway in gateways if is_public(gateway.external_ip)]
+        if public:
+            return min(public, key=lambda gateway: gateway.rtt)
+    return min(gateways, key=lambda gateway: gateway.rtt)
+
+
+def parse_ssdp_headers(data):
+    """解析 SSDP 响应头，键为小写"""
+    headers = {}
+    for line in data.decode("utf-8", "replace").split("\r\n")[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def find_root_url(control_url, timeout=SSDP_TIMEOUT):
+    """查找控制地址所属设备的根描述地址
+
+    miniupnpc 的 Python 接口不提供根描述地址，用 SSDP 搜索并按主机和端口匹配。
+    """
+    netloc = urllib.parse.urlsplit(control_url).netloc
+    try:
+        locations = ssdp_search(timeout=timeout)
+    except OSError:
+        return None
+    for location in locations:
+        if urllib.parse.urlsplit(location).netloc == netloc:
+            return location
+    return None
+
+
+def connect_cached(upnp, cache):
+    """用缓存的根描述地址直接连接网关，返回 (控制地址, 外网IP)；设备无响应时返回 None"""
+    try:
+        control_url = upnp.selectigd(cache["root_url"])
+        external_ip = upnp.externalipaddress()
+    except TypeError:
+        # 旧版 miniupnpc 的 selectigd 不接受参数
+        return None
+    except Exception:
+        return None
+    if not control_url or not external_ip:
+        return None
+    return control_url, external_ip
+
+
+def fetch_identity(root_url, timeout=DESCRIPTION_TIMEOUT):
+    """读取根描述中的设备标识，返回 {udn, manufacturer, model_name, model_number, serial_number}
+
+    读取或解析失败时返回 None。
+    """
+    try:
+        with urllib.request.urlopen(root_url, timeout=timeout) as response:
+            root = ET.fromstring(response.read())
+    except (OSError, ValueError, ET.ParseError):
+        return None
+    device = None
+    for element in root.iter():
+        if element.tag.rsplit('}', 1)[-1] == "device":
+            device = element
+            break
+    if device is None:
+        return None
+    fields = {}
+    for child in device:
+        fields[child.tag.rsplit('}', 1)[-1]] = (child.text or "").strip()
+    if not fields.get("UDN"):
+        return None
+    return {
+        "udn": fields["UDN"],
+        "manufacturer": fields.get("manufacturer", ""),
+        "model_name": fields.get("modelName", ""),
+        "model_number": fields.get("modelNumber", ""),
+        "serial_number": fields.get("serialNumber", ""),
+    }
+
+
+class RouterProfile:
+    """路由器功能档案：记录该设备实际接受的 AddPortMapping 参数变体
+
+    按 UDN 保存；厂商、型号或型号编号（多数路由器在其中包含固件版本）变化时
+    视为设备已更换或升级，丢弃记录重新学习。identity 为 None 时只在内存中记录。
+    """
+
+    def __init__(self, identity=None, path=PROFILES_PATH):
+        self.identity = identity
+        self.path = path
+        self.variant = None
+        # 档案因设备变化被丢弃
+        self.reset = False
+        self._lock = threading.Lock()
+        if identity is None:
+            return
+        stored = self._load_all().get(identity["udn"])
+        if isinstance(stored, dict):
+            if stored.get("fingerprint") == self.fingerprint:
+                self.variant = stored.get("variant")
+            else:
+                self.reset = True
+
+    @property
+    def fingerprint(self):
+        if self.identity is None:
+            return None
+        return "|".join(self.identity.get(name, "") for name in
+                        ("manufacturer", "model_name", "model_number", "serial_number"))
+
+    def learn(self, variant):
+        """记录成功的变体，与已记录的相同时不写文件"""
+        with self._lock:
+            if variant == self.variant:
+                return
+            self.variant = variant
+            if self.identity is None:
+                return
+            profiles = self._load_all()
+            profiles[self.identity["udn"]] = {
+                "fingerprint": self.fingerprint,
+                "model": f"{self.identity['manufacturer']} {self.identity['model_name']}".strip(),
+                "variant": variant,
+                "learned_at": time.time(),
+            }
+            try:
+                _write_json(self.path, profiles)
+            except OSError:
+                pass
+
+    def _load_all(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                profiles = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return profiles if isinstance(profiles, dict) else {}
@@ -0,0 +1,212 @@
+"""IGD 控制操作的 asyncio 接口
+
+每个调用都可以 await、取消并设置超时；同一网关同时进行的请求数由信号量限制，
+上层（批量添加、映射表遍历、命令行）可以安全地重叠多个路由器往返。
+请求由 soap_client.UPnPClient 在工作线程中发送，HTTP/1.1 连接在请求间复用。
+被取消或超时的请求在工作线程中继续到套接字超时为止，期间仍占用一个并发名额；
+只有读完整个响应的连接才会放回连接池。
+
+    async with await AsyncIGD.connect(root_url) as gateway:
+        print(await gateway.external_ip())
+        await gateway.add_mapping(8080, "TCP", "192.168.1.10", 80, "web", timeout=3)
+"""
+import asyncio
+import functools
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import igd
+from port_mapping import (BATCH_CONCURRENCY, LIST_PAGE_SIZE, MAX_ENTRIES, SOAP_TIMEOUT, SoapError,
+                          UNSUPPORTED_ERRORS, list_port_mappings, parse_generic_entry, parse_specific_entry)
+from soap_client import UPnPClient
+
+# 同一网关同时进行的请求数上限
+MAX_IN_FLIGHT = BATCH_CONCURRENCY
+
+
+async def discover(resend=igd.DISCOVERY_RESEND, max_wait=igd.DISCOVERY_MAX_WAIT,
+                   settle=igd.DISCOVERY_SETTLE):
+    """SSDP 发现，返回所有网关的根描述地址；见 igd.discover_locations"""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(igd.discover_locations, resend, max_wait, settle))
+
+
+async def discover_gateways(timeout=SOAP_TIMEOUT, **kwargs):
+    """发现并连接所有网关，返回按 GetExternalIPAddress 往返时间排序的 [(AsyncIGD, 外网IP, 往返秒数)]
+
+    无法连接的网关被跳过；kwargs 传给 AsyncIGD。
+    """
+    async def probe(location):
+        try:
+            gateway = await AsyncIGD.connect(location, timeout=timeout, **kwargs)
+        except (OSError, RuntimeError, SoapError, asyncio.TimeoutError):
+            return None
+        try:
+            start = time.monotonic()
+            external_ip = await gateway.external_ip()
+            return gateway, external_ip, time.monotonic() - start
+        except (OSError, SoapError, asyncio.TimeoutError):
+            await gateway.aclose()
+            return None
+
+    results = await asyncio.gather(*(probe(location) for location in await discover()))
+    return sorted((result for result in results if result is not None), key=lambda result: result[2])
+
+
+class AsyncIGD:
+    """一个网关的 asyncio 控制接口
+
+    所有操作接受 timeout（秒，None 使用构造时的默认值），超时抛出 asyncio.TimeoutError；
+    路由器返回 UPnP 错误时抛出 SoapError。一个对象只能在创建它的事件循环中使用。
+    """
+
+    def __init__(self, control_url, service_type, max_in_flight=MAX_IN_FLIGHT, timeout=SOAP_TIMEOUT,
+                 root_url=None):
+        self.client = UPnPClient(timeout=timeout, pool_size=max_in_flight)
+        self.client.control_url = control_url
+        self.client.service_type = service_type
+        self.root_url = root_url
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        # 是否支持 GetListOfPortMappings：None 表示尚未检测
+        self.bulk_supported = None
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    @property
+    def control_url(self):
+        return self.client.control_url
+
+    @property
+    def service_type(self):
+        return self.client.service_type
+
+    @classmethod
+    async def connect(cls, root_url, max_in_flight=MAX_IN_FLIGHT, timeout=SOAP_TIMEOUT):
+        """读取根描述并选择 WAN 连接服务"""
+        gateway = cls(None, None, max_in_flight, timeout, root_url)
+        try:
+            await gateway._run(timeout, gateway.client.selectigd, root_url)
+        except BaseException:
+            await gateway.aclose()
+            raise
+        return gateway
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        self._executor.shutdown(wait=False)
+        self.client.close()
+
+    async def call(self, action, arguments=(), timeout=None, service=None):
+        """发送一个 SOAP 请求，返回 {输出参数名: 文本}；排队等待的时间不计入超时"""
+        timeout = self._timeout(timeout)
+        return await self._run(timeout, self.client.soap_call, self.control_url,
+                               service or self.service_type, action, list(arguments), timeout)
+
+    async def external_ip(self, timeout=None):
+        return (await self.call("GetExternalIPAddress", timeout=timeout)).get("NewExternalIPAddress", "")
+
+    async def add_mapping(self, external_port, protocol, internal_ip, internal_port, description,
+                          remote_host='', duration=0, timeout=None):
+        await self._run(self._timeout(timeout), self.client.addportmapping, external_port, protocol,
+                        internal_ip, internal_port, description, remote_host, duration)
+
+    async def delete_mapping(self, external_port, protocol, remote_host='', timeout=None):
+        await self._run(self._timeout(timeout), self.client.deleteportmapping, external_port, protocol,
+                        remote_host)
+
+    async def get_mapping(self, external_port, protocol, timeout=None):
+        """查询单个端口，未映射时返回 None"""
+        entry = await self._run(self._timeout(timeout), self.client.getspecificportmapping,
+                                int(external_port), protocol.upper())
+        return parse_specific_entry(external_port, protocol, entry)
+
+    async def get_generic_entry(self, index, timeout=None):
+        """按索引读取映射，超出范围时返回 None"""
+        entry = await self._run(self._timeout(timeout), self.client.getgenericportmapping, index)
+        return parse_generic_entry(entry)
+
+    async def list_mappings(self, timeout=None):
+        """读取全部映射，按外部端口排序
+
+        支持 GetListOfPortMappings 时分页读取，否则并发读取 max_in_flight 个索引为一批，
+        遇到第一个空位为止。timeout 为单个请求的超时。
+        """
+        mappings = None
+        if self.bulk_supported is not False:
+            mappings = await self._list_bulk(timeout)
+        if mappings is None:
+            mappings = await self._list_generic(timeout)
+        return sorted(mappings, key=lambda mapping: (mapping.external_port, mapping.protocol))
+
+    async def add_mappings(self, rules, timeout=None):
+        """同时添加多条规则（PortMapping），返回与 rules 对应的错误列表（成功时为 None）"""
+        async def add(rule):
+            try:
+                await self.add_mapping(rule.external_port, rule.protocol, rule.internal_ip, rule.internal_port,
+                                       rule.description, rule.remote_host, rule.duration, timeout)
+            except (OSError, SoapError, asyncio.TimeoutError) as e:
+                return e
+            return None
+
+        return await asyncio.gather(*(add(rule) for rule in rules))
+
+    async def _list_bulk(self, timeout):
+        """按页读取，路由器不支持 GetListOfPortMappings 时返回 None"""
+        mappings = []
+        try:
+            # 分页依次进行，超时作用于每一页的请求
+            for protocol in ("TCP", "UDP"):
+                mappings += await self._run(None, list_port_mappings, self.control_url, protocol,
+                                            LIST_PAGE_SIZE, self._timeout(timeout), self.client.soap_call)
+        except SoapError as e:
+            if e.code not in UNSUPPORTED_ERRORS:
+                raise
+            self.bulk_supported = False
+            return None
+        except ET.ParseError:
+            # 列表格式错误时本次改为逐条读取，不记为不支持
+            return None
+        self.bulk_supported = True
+        return mappings
+
+    async def _list_generic(self, timeout):
+        mappings = []
+        for first in range(0, MAX_ENTRIES, self.max_in_flight):
+            batch = await asyncio.gather(*(self.get_generic_entry(index, timeout)
+                                           for index in range(first, min(first + self.max_in_flight, MAX_ENTRIES))))
+            for mapping in batch:
+                if mapping is None:
+                    return mappings
+                mappings.append(mapping)
+        return mappings
+
+    def _timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
+
+    async def _run(self, timeout, function, *args):
+        """在工作线程中调用 function，timeout 为 None 时不限时
+
+        工作线程结束前不释放并发名额，排队等待名额的时间不计入超时。
+        """
+        await self._semaphore.acquire()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(function, *args))
+        except BaseException:
+            self._semaphore.release()
+            raise
+        future.add_done_callback(self._finished)
+        # shield 使超时或取消不会提前结束 future，名额在线程真正结束后才释放
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+    def _finished(self, future):
+        self._semaphore.release()
+        if not future.cancelled():
+            # 已超时或被取消的调用不再有人读取结果
+            future.exception()
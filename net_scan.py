@@ -0,0 +1,696 @@
+"""局域网扫描
+
+按开销从低到高选择探测方式，尽量不创建子进程：
+
+- arp:  读取内核邻居表（/proc/net/arp），不产生任何网络流量
+- icmp: 非特权 ICMP 数据报套接字，一个套接字探测所有主机
+- tcp:  非阻塞 TCP 连接常用端口，收到 RST 也说明主机在线
+- ping: 系统 ping 命令，仅作为显式指定的后备方式
+"""
+import collections
+import errno
+import ipaddress
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+# ping 方式默认同时运行的子进程数
+DEFAULT_CONCURRENCY = 64
+
+# 单个主机的探测超时（秒）
+DEFAULT_TIMEOUT = 1.0
+
+# 默认的探测方式及顺序
+DEFAULT_METHODS = ("arp", "icmp", "tcp")
+
+# TCP 探测使用的常用端口
+COMMON_PORTS = (80, 443, 22, 445, 139, 3389, 8080, 53, 554, 62078)
+
+# TCP 探测同时打开的套接字数（Windows 的 select 最多支持 512 个）
+TCP_CONCURRENCY = 500
+
+# ICMP 探测同时等待回复的请求数，限制发送速率
+ICMP_CONCURRENCY = 500
+
+# 一次扫描最多探测的主机数（所有网卡合计）
+DEFAULT_MAX_HOSTS = 4096
+
+# 主机缓存条目的有效期（秒），超过后重新主动探测
+HOST_TTL = 300
+
+# 后台读取邻居表的间隔（秒）
+NEIGHBOUR_REFRESH_INTERVAL = 10
+
+# Linux 网卡 ioctl
+_SIOCGIFFLAGS = 0x8913
+_SIOCGIFADDR = 0x8915
+_SIOCGIFNETMASK = 0x891b
+_IFF_UP = 0x1
+_IFF_LOOPBACK = 0x8
+
+# 等待网络事件的最长时间（秒），保证取消扫描能及时生效
+_POLL_INTERVAL = 0.1
+
+# 连接被拒绝说明主机在线，只是端口没有开放
+_ALIVE_ERRORS = (0, errno.ECONNREFUSED)
+
+_CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+# 探测结果：地址、探测方式、延迟（秒，未知时为 None）
+HostResult = collections.namedtuple("HostResult", "ip method latency")
+
+# 主机缓存条目：地址、最近一次确认的方式、延迟、最后在线时间（time.monotonic）
+HostEntry = collections.namedtuple("HostEntry", "ip method latency last_seen")
+
+# 网卡：名称、本机地址、所在网段（ipaddress.IPv4Network）
+Interface = collections.namedtuple("Interface", "name ip network")
+
+
+def ping_command(ip, timeout=DEFAULT_TIMEOUT):
+    """生成只发送一个回显请求的 ping 命令"""
+    if sys.platform.startswith("win"):
+        return ['ping', '-n', '1', '-w', str(int(timeout * 1000)), ip]
+    if sys.platform == "darwin":
+        # macOS 的 -W 单位是毫秒
+        return ['ping', '-c', '1', '-W', str(int(timeout * 1000)), ip]
+    # Linux 的 -W 单位是秒，且只接受整数
+    return ['ping', '-c', '1', '-W', str(max(1, int(timeout + 0.5))), ip]
+
+
+def ping_host(ip, timeout=DEFAULT_TIMEOUT):
+    """使用系统 ping 检测主机是否在线"""
+    kwargs = {}
+    if sys.platform.startswith("win"):
+        # 避免每次探测弹出控制台窗口
+        kwargs['creationflags'] = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+    try:
+        result = subprocess.run(ping_command(ip, timeout), stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, timeout=timeout + 1, **kwargs)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
+
+
+def subnet_hosts(local_ip, prefix=24):
+    """返回 local_ip 所在网段中除自身外的所有主机地址"""
+    network = ipaddress.ip_network(f"{local_ip}/{prefix}", strict=False)
+    return [str(host) for host in network.hosts() if str(host) != local_ip]
+
+
+def list_interfaces():
+    """返回所有已启用的 IPv4 网卡及其网段，不包含回环和链路本地地址
+
+    优先使用 psutil；没有安装时在 Linux 上通过 ioctl 读取，
+    其他平台退回到默认路由所在地址并假定为 /24。
+    """
+    if PSUTIL_AVAILABLE:
+        interfaces = _psutil_interfaces()
+    elif fcntl is not None and sys.platform.startswith("linux"):
+        interfaces = _linux_interfaces()
+    else:
+        interfaces = []
+    if not interfaces:
+        interfaces = _fallback_interfaces()
+
+    usable = []
+    for interface in interfaces:
+        address = ipaddress.ip_address(interface.ip)
+        if address.is_loopback or address.is_link_local:
+            continue
+        usable.append(interface)
+    return usable
+
+
+def _psutil_interfaces():
+    interfaces = []
+    stats = psutil.net_if_stats()
+    for name, addresses in psutil.net_if_addrs().items():
+        if name in stats and not stats[name].isup:
+            continue
+        for address in addresses:
+            if address.family != socket.AF_INET or not address.netmask:
+                continue
+            network = ipaddress.ip_network(f"{address.address}/{address.netmask}", strict=False)
+            interfaces.append(Interface(name, address.address, network))
+    return interfaces
+
+
+def _linux_interfaces():
+    interfaces = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for index, name in socket.if_nameindex():
+            ifreq = struct.pack("256s", name.encode()[:15])
+            try:
+                flags = struct.unpack("H", fcntl.ioctl(sock.fileno(), _SIOCGIFFLAGS, ifreq)[16:18])[0]
+                if not flags & _IFF_UP or flags & _IFF_LOOPBACK:
+                    continue
+                ip = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), _SIOCGIFADDR, ifreq)[20:24])
+                netmask = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), _SIOCGIFNETMASK, ifreq)[20:24])
+            except OSError:
+                # 没有 IPv4 地址的网卡
+                continue
+            network = ipaddress.ip_network(f"{ip}/{netmask}", strict=False)
+            interfaces.append(Interface(name, ip, network))
+    return interfaces
+
+
+def _fallback_interfaces():
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(("8.8.8.8", 80))
+            ip = sock.getsockname()[0]
+    except OSError:
+        return []
+    return [Interface("default", ip, ipaddress.ip_network(f"{ip}/24", strict=False))]
+
+
+def interface_hosts(interface, max_hosts=DEFAULT_MAX_HOSTS):
+    """返回网卡所在网段中除本机外的主机地址
+
+    网段大于 max_hosts 时只取包含本机地址的、不超过上限的最大子网，
+    避免对 /16 这类网段发起数万次探测。
+    """
+    network = interface.network
+    if network.num_addresses > max_hosts:
+        prefix = 32
+        while prefix > network.prefixlen and 2 ** (33 - prefix) <= max_hosts:
+            prefix -= 1
+        network = ipaddress.ip_network(f"{interface.ip}/{prefix}", strict=False)
+    return [str(host) for host in network.hosts() if str(host) != interface.ip]
+
+
+def read_neighbours(path="/proc/net/arp", include_incomplete=False):
+    """读取内核邻居表，返回 {IP: MAC}
+
+    默认只包含已完成解析的条目；include_incomplete=True 时，
+    解析失败的条目以 MAC 为 None 的形式一并返回。不支持的平台返回空字典。
+    """
+    neighbours = {}
+    try:
+        with open(path) as f:
+            next(f, None)
+            for line in f:
+                fields = line.split()
+                if len(fields) < 4:
+                    continue
+                ip, flags, mac = fields[0], fields[2], fields[3]
+                # ATF_COM：地址解析已完成
+                if int(flags, 16) & 0x2 and mac != "00:00:00:00:00:00":
+                    neighbours[ip] = mac
+                elif include_incomplete:
+                    neighbours[ip] = None
+    except (OSError, ValueError):
+        pass
+    return neighbours
+
+
+def icmp_available():
+    """当前用户能否创建非特权 ICMP 数据报套接字
+
+    Linux 需要 net.ipv4.ping_group_range 包含当前用户组，macOS 默认允许。
+    """
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    except (OSError, AttributeError):
+        return False
+    sock.close()
+    return True
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _echo_request(seq):
+    payload = b'upnp-scan'
+    header = struct.pack("!BBHHH", 8, 0, 0, 0, seq & 0xffff)
+    checksum = _checksum(header + payload)
+    return struct.pack("!BBHHH", 8, 0, checksum, 0, seq & 0xffff) + payload
+
+
+def _cancelled(cancel):
+    return cancel is not None and cancel.is_set()
+
+
+def icmp_sweep(hosts, timeout=DEFAULT_TIMEOUT, on_alive=None, cancel=None, on_progress=None,
+               concurrency=ICMP_CONCURRENCY):
+    """用一个 ICMP 数据报套接字探测所有主机，返回在线主机的 HostResult 列表
+
+    同时等待回复的请求不超过 concurrency 个，收到回复或超时后才发送新的请求。
+    cancel 为 threading.Event，置位后尽快返回已有结果；
+    on_progress(done, total) 报告已发送的请求数，等待回复阶段按时间推进。
+    """
+    results = []
+    pending = {}
+    # 尚未回复且未超时的请求：按发送顺序排列的 (发送时间, 地址) 和地址集合
+    sent = collections.deque()
+    in_flight = set()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP) as sock:
+        sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        selector.register(sock, events)
+        queue = collections.deque(enumerate(hosts))
+        # 发送和等待回复各占一半进度
+        total = 2 * len(hosts)
+        deadline = None
+        try:
+            while not _cancelled(cancel):
+                now = time.monotonic()
+                while sent and (sent[0][0] <= now - timeout or sent[0][1] not in in_flight):
+                    in_flight.discard(sent.popleft()[1])
+                if not queue:
+                    if deadline is None:
+                        deadline = now + timeout
+                    if now >= deadline or not pending:
+                        break
+                can_send = bool(queue) and len(in_flight) < concurrency
+                wanted = selectors.EVENT_READ | (selectors.EVENT_WRITE if can_send else 0)
+                if wanted != events:
+                    events = wanted
+                    selector.modify(sock, events)
+                if queue:
+                    wait = _POLL_INTERVAL if can_send else min(_POLL_INTERVAL, max(0, sent[0][0] + timeout - now))
+                else:
+                    wait = min(_POLL_INTERVAL, max(0, deadline - now))
+                for key, mask in selector.select(wait):
+                    if mask & selectors.EVENT_READ:
+                        _icmp_receive(sock, pending, results, on_alive, in_flight)
+                    if mask & selectors.EVENT_WRITE and queue:
+                        _icmp_send(sock, queue, pending, sent, in_flight, concurrency)
+                if on_progress is not None:
+                    done = len(hosts) - len(queue)
+                    if deadline is not None:
+                        done += int(len(hosts) * min(1, 1 - (deadline - time.monotonic()) / timeout))
+                    on_progress(done, total)
+        finally:
+            selector.close()
+    return results
+
+
+def _icmp_send(sock, queue, pending, sent, in_flight, concurrency):
+    while queue and len(in_flight) < concurrency:
+        seq, ip = queue[0]
+        try:
+            sock.sendto(_echo_request(seq), (ip, 0))
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # 无路由等错误，视为不在线
+            queue.popleft()
+            continue
+        queue.popleft()
+        now = time.monotonic()
+        pending[ip] = now
+        sent.append((now, ip))
+        in_flight.add(ip)
+
+
+def _icmp_receive(sock, pending, results, on_alive, in_flight):
+    while True:
+        try:
+            data, (ip, _) = sock.recvfrom(1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            continue
+        # macOS 的数据报套接字会带上 IP 头
+        if data and data[0] >> 4 == 4:
+            data = data[(data[0] & 0x0f) * 4:]
+        if not data or data[0] != 0 or ip not in pending:
+            continue
+        in_flight.discard(ip)
+        result = HostResult(ip, "icmp", time.monotonic() - pending.pop(ip))
+        results.append(result)
+        if on_alive is not None:
+            on_alive(result)
+
+
+def tcp_sweep(hosts, ports=COMMON_PORTS, timeout=DEFAULT_TIMEOUT, concurrency=TCP_CONCURRENCY, on_alive=None,
+              cancel=None, on_progress=None):
+    """非阻塞连接每个主机的常用端口，返回在线主机的 HostResult 列表
+
+    同时打开的套接字数不超过 concurrency；某个主机确认在线后取消它的其余连接。
+    on_progress(done, total) 报告已结束的连接尝试数。
+    """
+    results = []
+    alive = set()
+    attempts = collections.deque((ip, port) for ip in hosts for port in ports)
+    total = len(attempts)
+    selector = selectors.DefaultSelector()
+    open_sockets = {}
+
+    def finish(sock):
+        selector.unregister(sock)
+        del open_sockets[sock]
+        sock.close()
+
+    try:
+        while (attempts or open_sockets) and not _cancelled(cancel):
+            # 补充新的连接直到达到并发上限
+            while attempts and len(open_sockets) < concurrency:
+                ip, port = attempts.popleft()
+                if ip in alive:
+                    continue
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                start = time.monotonic()
+                err = sock.connect_ex((ip, port))
+                if err in _ALIVE_ERRORS:
+                    sock.close()
+                    _tcp_alive(ip, start, alive, results, on_alive)
+                elif err in _CONNECT_IN_PROGRESS:
+                    open_sockets[sock] = (ip, start)
+                    selector.register(sock, selectors.EVENT_WRITE)
+                else:
+                    sock.close()
+
+            if not open_sockets:
+                continue
+
+            now = time.monotonic()
+            oldest = min(start for ip, start in open_sockets.values())
+            for key, mask in selector.select(min(_POLL_INTERVAL, max(0, oldest + timeout - now))):
+                sock = key.fileobj
+                ip, start = open_sockets[sock]
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                finish(sock)
+                if err in _ALIVE_ERRORS:
+                    _tcp_alive(ip, start, alive, results, on_alive)
+
+            # 关闭超时的连接以及已确认在线主机的多余连接
+            now = time.monotonic()
+            for sock, (ip, start) in list(open_sockets.items()):
+                if ip in alive or now - start >= timeout:
+                    finish(sock)
+
+            if on_progress is not None:
+                on_progress(total - len(attempts) - len(open_sockets), total)
+    finally:
+        for sock in list(open_sockets):
+            sock.close()
+        selector.close()
+    return results
+
+
+def _tcp_alive(ip, start, alive, results, on_alive):
+    if ip in alive:
+        return
+    alive.add(ip)
+    result = HostResult(ip, "tcp", time.monotonic() - start)
+    results.append(result)
+    if on_alive is not None:
+        on_alive(result)
+
+
+def ping_sweep(hosts, timeout=DEFAULT_TIMEOUT, concurrency=DEFAULT_CONCURRENCY, on_alive=None,
+               cancel=None, on_progress=None):
+    """用系统 ping 命令并发探测，每个主机一个子进程"""
+    results = []
+    if not hosts:
+        return results
+
+    def probe(ip):
+        if _cancelled(cancel):
+            return None
+        start = time.monotonic()
+        if ping_host(ip, timeout):
+            return HostResult(ip, "ping", time.monotonic() - start)
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(hosts)))) as executor:
+        for done, future in enumerate(as_completed([executor.submit(probe, ip) for ip in hosts]), 1):
+            try:
+                result = future.result()
+            except Exception:
+                result = None
+            if result is not None:
+                results.append(result)
+                if on_alive is not None:
+                    on_alive(result)
+            if on_progress is not None:
+                on_progress(done, len(hosts))
+    return results
+
+
+def scan_hosts(hosts, timeout=DEFAULT_TIMEOUT, concurrency=None,
+               on_alive=None, methods=DEFAULT_METHODS, cancel=None, on_progress=None):
+    """按 methods 顺序探测 hosts，前一种方式确认在线的主机不再重复探测
+
+    concurrency 限制每种主动探测方式同时进行的探测数，为 None 时使用各自的默认值
+    （ICMP_CONCURRENCY / TCP_CONCURRENCY / DEFAULT_CONCURRENCY）。
+    返回按地址排序的 HostResult 列表；on_alive 在发现每个在线主机时立即调用。
+    cancel 置位后提前结束；on_progress(fraction) 报告 0 到 1 之间的整体进度。
+    """
+    found = {}
+    # 同一链路上 ARP 解析失败的地址，确定不在线
+    absent = set()
+
+    def report(result):
+        if result.ip not in found:
+            found[result.ip] = result
+            if on_alive is not None:
+                on_alive(result)
+
+    def remaining():
+        return [ip for ip in hosts if ip not in found and ip not in absent]
+
+    def check_neighbours(prune=False):
+        neighbours = read_neighbours(include_incomplete=prune)
+        for ip in remaining():
+            if ip not in neighbours:
+                continue
+            if neighbours[ip] is not None:
+                report(HostResult(ip, "arp", None))
+            else:
+                absent.add(ip)
+
+    # 每个主动探测方式占相同的进度份额：stage 为当前份额的起点和宽度
+    stages = [method for method in methods if method != "arp"]
+    stage = [0.0, 1.0]
+
+    def progress(done, total):
+        if on_progress is not None and total:
+            on_progress(min(1.0, (stage[0] + stage[1] * done / total) / max(1, len(stages))))
+
+    use_arp = "arp" in methods
+    for method in methods:
+        if _cancelled(cancel):
+            break
+        targets = remaining()
+        if not targets:
+            break
+        if method == "arp":
+            check_neighbours()
+            continue
+        stage[:] = [stages.index(method), 1.0]
+        if method == "icmp":
+            if icmp_available():
+                icmp_sweep(targets, timeout, report, cancel, progress, concurrency or ICMP_CONCURRENCY)
+        elif method == "tcp":
+            tcp_concurrency = concurrency or TCP_CONCURRENCY
+            if use_arp:
+                # 先只探测前两个端口，借此触发 ARP 解析并排除链路上不存在的地址
+                stage[1] = 0.5
+                tcp_sweep(targets, COMMON_PORTS[:2], timeout, tcp_concurrency, report, cancel, progress)
+                check_neighbours(prune=True)
+                stage[0] += 0.5
+                targets = remaining()
+                tcp_sweep(targets, COMMON_PORTS[2:], timeout, tcp_concurrency, report, cancel, progress)
+            else:
+                tcp_sweep(targets, COMMON_PORTS, timeout, tcp_concurrency, report, cancel, progress)
+        elif method == "ping":
+            ping_sweep(targets, timeout, concurrency or DEFAULT_CONCURRENCY, report, cancel, progress)
+        # 主动探测会触发 ARP 解析：不响应探测但在线的主机会出现在邻居表中，
+        # 超时后仍未解析的地址不在线，后续方式不再探测
+        if use_arp:
+            check_neighbours(prune=True)
+        if not _cancelled(cancel):
+            progress(1, 1)
+
+    if on_progress is not None and not _cancelled(cancel):
+        on_progress(1.0)
+    return sorted(found.values(), key=lambda result: ipaddress.ip_address(result.ip))
+
+
+def probe_host(ip, timeout=DEFAULT_TIMEOUT, methods=DEFAULT_METHODS):
+    """探测单个主机，在线时返回 HostResult，否则返回 None"""
+    results = scan_hosts([ip], timeout, methods=methods)
+    return results[0] if results else None
+
+
+def scan_interfaces(interfaces=None, max_hosts=DEFAULT_MAX_HOSTS, timeout=DEFAULT_TIMEOUT,
+                    concurrency=None, on_alive=None, methods=DEFAULT_METHODS,
+                    cancel=None, on_progress=None):
+    """并行扫描多个网卡所在的网段，返回合并后按地址排序的 HostResult 列表
+
+    max_hosts 是所有网卡合计的探测上限，按网卡平均分配。
+    on_progress(fraction) 按各网段主机数加权汇总进度，变化不足 1% 时不报告。
+    """
+    if interfaces is None:
+        interfaces = list_interfaces()
+    # 多个网卡可能位于同一网段
+    networks = {}
+    for interface in interfaces:
+        networks.setdefault(interface.network, interface)
+    interfaces = list(networks.values())
+    if not interfaces:
+        return []
+
+    per_interface = max(1, max_hosts // len(interfaces))
+    host_lists = [interface_hosts(interface, per_interface) for interface in interfaces]
+    total = sum(len(hosts) for hosts in host_lists) or 1
+    fractions = [0.0] * len(host_lists)
+    reported = [0.0]
+    lock = threading.Lock()
+
+    def progress_for(index):
+        def progress(fraction):
+            with lock:
+                fractions[index] = fraction
+                overall = sum(f * len(hosts) for f, hosts in zip(fractions, host_lists)) / total
+                if overall - reported[0] < 0.01 and overall < 1:
+                    return
+                reported[0] = overall
+            on_progress(overall)
+        return progress if on_progress is not None else None
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=len(interfaces)) as executor:
+        futures = [executor.submit(scan_hosts, hosts, timeout, concurrency, on_alive, methods,
+                                   cancel, progress_for(index))
+                   for index, hosts in enumerate(host_lists)]
+        for future in futures:
+            for result in future.result():
+                found.setdefault(result.ip, result)
+    return sorted(found.values(), key=lambda result: ipaddress.ip_address(result.ip))
+
+
+class HostCache:
+    """已发现主机的缓存，记录每个地址的最后在线时间和探测延迟
+
+    后台线程定期读取内核邻居表被动刷新，只对超过 ttl 仍未出现的条目重新主动探测，
+    探测失败的条目被移除。on_change 在地址集合变化时从后台线程调用。
+    """
+
+    def __init__(self, ttl=HOST_TTL, refresh_interval=NEIGHBOUR_REFRESH_INTERVAL,
+                 timeout=DEFAULT_TIMEOUT, on_change=None):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.on_change = on_change
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, ip):
+        with self._lock:
+            return ip in self._entries
+
+    def update(self, result, seen=None):
+        """记录一个在线主机（HostResult），返回是否为新地址"""
+        seen = time.monotonic() if seen is None else seen
+        with self._lock:
+            entry = self._entries.get(result.ip)
+            added = entry is None
+            # 邻居表不提供延迟，保留上一次主动探测的结果
+            latency = result.latency if result.latency is not None or added else entry.latency
+            self._entries[result.ip] = HostEntry(result.ip, result.method, latency, seen)
+        if added:
+            self._changed()
+        return added
+
+    def discard(self, ip):
+        with self._lock:
+            removed = self._entries.pop(ip, None) is not None
+        if removed:
+            self._changed()
+
+    def hosts(self):
+        """按地址排序的 HostEntry 列表"""
+        with self._lock:
+            entries = list(self._entries.values())
+        return sorted(entries, key=lambda entry: ipaddress.ip_address(entry.ip))
+
+    def ips(self):
+        return [entry.ip for entry in self.hosts()]
+
+    def stale(self, now=None):
+        """超过 ttl 未见的地址"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return [ip for ip, entry in self._entries.items() if now - entry.last_seen >= self.ttl]
+
+    def refresh_neighbours(self):
+        """从内核邻居表刷新，不产生网络流量"""
+        now = time.monotonic()
+        for ip, mac in read_neighbours().items():
+            self.update(HostResult(ip, "arp", None), now)
+
+    def revalidate(self, cancel=None):
+        """主动探测过期条目，更新在线的，移除不在线的"""
+        targets = self.stale()
+        if not targets:
+            return
+        alive = {result.ip: result for result in scan_hosts(targets, self.timeout, cancel=cancel)}
+        if _cancelled(cancel):
+            return
+        for ip in targets:
+            if ip in alive:
+                self.update(alive[ip])
+            else:
+                self.discard(ip)
+
+    def start(self):
+        """启动后台刷新线程"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.timeout * 2 + 1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh_neighbours()
+                self.revalidate(self._stop)
+            except Exception:
+                # 后台刷新失败不影响已缓存的结果，下一轮重试
+                pass
+            self._stop.wait(self.refresh_interval)
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
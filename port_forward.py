@@ -0,0 +1,1093 @@
+"""端口转发引擎
+
+所有客户端和目标连接都在同一个 selectors 事件循环线程中复用，
+取代原来每个连接两个阻塞线程的转发方式。
+"""
+import bisect
+import collections
+import errno
+import heapq
+import itertools
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 单次读取的缓冲区大小
+BUFFER_SIZE = 65536
+
+# 单个 TCP 连接（两个方向合计）最多缓存的待写数据
+CONNECTION_MEMORY = 4 * BUFFER_SIZE
+
+# 所有 TCP 转发共用的缓冲区池内存上限
+POOL_MEMORY = 64 * 1024 * 1024
+
+# Linux 下可以通过内核管道 splice 转发，数据不进入 Python
+SPLICE_AVAILABLE = sys.platform.startswith("linux") and hasattr(os, "splice")
+
+# splice 不支持该套接字/文件组合时的错误，出现时该方向改用复制模式
+_SPLICE_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, getattr(errno, "ENOTSUP", errno.EOPNOTSUPP)}
+
+# 连接目标的超时（秒），目标丢弃 SYN 时不必等到系统放弃
+CONNECT_TIMEOUT = 10
+
+# UDP 会话空闲超时（秒）
+UDP_IDLE_TIMEOUT = 60
+
+# 单条 UDP 转发最多的会话数，每个会话占用一个上游套接字；超过时回收最久未活动的会话
+UDP_MAX_SESSIONS = 1024
+
+# 每次就绪最多处理的数据报数量，避免单个套接字饿死其他连接
+UDP_BATCH = 256
+
+# 非阻塞 connect 正在进行中的错误码
+_CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+
+def _null_log(message, level="INFO"):
+    pass
+
+
+class TimerHandle:
+    """call_later 返回的定时器句柄"""
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop:
+    """单线程事件循环，负责所有套接字的就绪分发和定时器
+
+    注册到循环中的每个套接字都带有一个回调 handler(mask)，
+    除 call_soon 和 call_later 外的所有方法都只能在循环线程内调用。
+    """
+
+    def __init__(self, log=None):
+        self.log = log or _null_log
+        self._calls = collections.deque()
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+        self._open()
+
+    def _open(self):
+        self.selector = selectors.DefaultSelector()
+        # 用于从其他线程唤醒 select() 的套接字对
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, EVENT_READ, self._on_wakeup)
+        self._closed = False
+
+    def start(self):
+        """在后台线程中启动事件循环，stop 之后可以再次启动"""
+        if self._thread is not None:
+            return
+        if self._closed:
+            self._open()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="port-forward-loop", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """停止事件循环并等待线程退出"""
+        if self._thread is None:
+            return
+        self.call_soon(self._halt)
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        self._thread = None
+
+    def in_loop_thread(self):
+        return self._thread is threading.current_thread()
+
+    def call_soon(self, callback, *args):
+        """线程安全：在循环线程中执行回调"""
+        with self._lock:
+            self._calls.append((callback, args))
+        self._wakeup()
+
+    def call_wait(self, callback, *args, timeout=5):
+        """线程安全：在循环线程中执行回调并等待完成，循环未运行时直接执行"""
+        if self._thread is None or self.in_loop_thread():
+            return callback(*args)
+        done = threading.Event()
+        result = []
+
+        def run():
+            try:
+                result.append(callback(*args))
+            finally:
+                done.set()
+
+        self.call_soon(run)
+        done.wait(timeout)
+        return result[0] if result else None
+
+    def call_later(self, delay, callback, *args):
+        """线程安全：delay 秒后在循环线程中执行回调"""
+        handle = TimerHandle(time.monotonic() + delay, callback, args)
+        with self._lock:
+            heapq.heappush(self._timers, (handle.when, next(self._timer_seq), handle))
+        if not self.in_loop_thread():
+            self._wakeup()
+        return handle
+
+    def _wakeup(self):
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            # 唤醒缓冲区已满说明循环已经会被唤醒
+            pass
+
+    def set_events(self, sock, events, handler):
+        """设置套接字关注的事件，events 为 0 时取消注册"""
+        try:
+            key = self.selector.get_key(sock)
+        except (KeyError, ValueError):
+            key = None
+
+        if key is None:
+            if events:
+                self.selector.register(sock, events, handler)
+        elif not events:
+            self.selector.unregister(sock)
+        elif key.events != events or key.data is not handler:
+            self.selector.modify(sock, events, handler)
+
+    def discard(self, sock):
+        """取消注册套接字（如果已注册）"""
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _on_wakeup(self, mask):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def _run_calls(self):
+        with self._lock:
+            calls = list(self._calls)
+            self._calls.clear()
+        for callback, args in calls:
+            try:
+                callback(*args)
+            except Exception as e:
+                self.log(f"事件循环回调错误: {str(e)}", "ERROR")
+
+    def _run_timers(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._timers and self._timers[0][0] <= now:
+                due.append(heapq.heappop(self._timers)[2])
+        for handle in due:
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except Exception as e:
+                self.log(f"定时器回调错误: {str(e)}", "ERROR")
+
+    def _halt(self):
+        self._running = False
+
+    def _run(self):
+        try:
+            while self._running:
+                for key, mask in self.selector.select(self._select_timeout()):
+                    try:
+                        key.data(mask)
+                    except Exception as e:
+                        self.log(f"事件处理错误: {str(e)}", "ERROR")
+                self._run_timers()
+                self._run_calls()
+        finally:
+            for key in list(self.selector.get_map().values()):
+                if key.fileobj is not self._wake_r:
+                    try:
+                        key.fileobj.close()
+                    except OSError:
+                        pass
+            self.selector.close()
+            self._wake_r.close()
+            self._wake_w.close()
+            # 丢弃属于已关闭套接字的回调和定时器，再次启动时重新创建选择器
+            with self._lock:
+                self._calls.clear()
+                self._timers.clear()
+            self._closed = True
+
+    def _select_timeout(self):
+        with self._lock:
+            if self._calls:
+                return 0
+            if self._timers:
+                return max(0, self._timers[0][0] - time.monotonic())
+            return None
+
+
+class LatencyHistogram:
+    """对数分桶的延迟直方图，记录 O(log 桶数)，百分位取所在桶的上界"""
+
+    # 桶上界（毫秒）：0.05ms 起每桶放大 √2 倍，约到 100 秒
+    BOUNDS = [0.05 * (2 ** (i / 2)) for i in range(42)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds * 1000)] += 1
+        self.total += 1
+
+    def percentile(self, p):
+        """返回第 p 百分位的延迟（毫秒），没有样本时返回 None"""
+        if not self.total:
+            return None
+        rank = max(1, int(self.total * p / 100 + 0.5))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.BOUNDS[min(i, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+
+class ForwardStats:
+    """单条转发规则的统计，只在循环线程中更新
+
+    字节数按数据块累加；活跃连接的字节数保存在各自的通道中，
+    连接关闭时并入 bytes_up/bytes_down。
+    """
+
+    def __init__(self):
+        self.accepted = 0
+        self.bytes_up = 0      # 客户端 -> 目标
+        self.bytes_down = 0    # 目标 -> 客户端
+        self.errors = collections.Counter()
+        self.connect_latency = LatencyHistogram()
+        self._mark = (time.monotonic(), 0, 0, 0)
+
+    def snapshot(self, active, live_up=0, live_down=0):
+        """生成统计快照，速率按距上次快照的时间计算"""
+        now = time.monotonic()
+        bytes_up = self.bytes_up + live_up
+        bytes_down = self.bytes_down + live_down
+        last_time, last_accepted, last_up, last_down = self._mark
+        elapsed = max(now - last_time, 1e-6)
+        self._mark = (now, self.accepted, bytes_up, bytes_down)
+        return {
+            "active": active,
+            "accepted": self.accepted,
+            "accept_rate": (self.accepted - last_accepted) / elapsed,
+            "bytes_up": bytes_up,
+            "bytes_down": bytes_down,
+            "up_rate": (bytes_up - last_up) / elapsed,
+            "down_rate": (bytes_down - last_down) / elapsed,
+            "connect_p50": self.connect_latency.percentile(50),
+            "connect_p90": self.connect_latency.percentile(90),
+            "connect_p99": self.connect_latency.percentile(99),
+            "errors": dict(self.errors),
+        }
+
+
+class BufferPool:
+    """预分配的接收缓冲区池，同时充当全局内存上限
+
+    所有缓冲区大小相同；已分配的缓冲区总量达到 max_memory 后 acquire 返回 None，
+    调用方通过 wait 注册回调，在有缓冲区归还时得到通知。只能在循环线程中使用。
+    """
+
+    def __init__(self, bufsize=BUFFER_SIZE, max_memory=POOL_MEMORY, preallocate=16):
+        self.bufsize = bufsize
+        self.max_buffers = max(1, max_memory // bufsize)
+        self.allocated = 0
+        self._free = []
+        self._waiters = []
+        for _ in range(min(preallocate, self.max_buffers)):
+            self._free.append(bytearray(bufsize))
+            self.allocated += 1
+
+    def available(self):
+        return bool(self._free) or self.allocated < self.max_buffers
+
+    def in_use(self):
+        return self.allocated - len(self._free)
+
+    def acquire(self):
+        if self._free:
+            return self._free.pop()
+        if self.allocated < self.max_buffers:
+            self.allocated += 1
+            return bytearray(self.bufsize)
+        return None
+
+    def release(self, buf):
+        self._free.append(buf)
+        if self._waiters:
+            waiters, self._waiters = self._waiters, []
+            for callback in waiters:
+                callback()
+
+    def wait(self, callback):
+        self._waiters.append(callback)
+
+
+class _Pipe:
+    """单方向数据通道：从 src 读取并写入 dst"""
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.eof = False
+        self.shut = False
+        # 因全局内存上限而暂停读取
+        self.starved = False
+        # 已读取的字节数，按数据块累加
+        self.transferred = 0
+
+    def _maybe_shutdown(self):
+        # 源端关闭且数据已全部写出后，向目标端发送 FIN
+        if self.done() and not self.shut:
+            self.shut = True
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+        pass
+
+
+class _CopyPipe(_Pipe):
+    """复制模式通道：recv_into 到池中的缓冲区，再从 memoryview 写出
+
+    待写数据达到 max_chunks 个缓冲区时暂停读取 src，形成背压。
+    """
+
+    def __init__(self, src, dst, pool, max_chunks):
+        super().__init__(src, dst)
+        self.pool = pool
+        self.max_chunks = max_chunks
+        # 待写数据块：[缓冲区, 起始偏移, 结束偏移]
+        self.chunks = collections.deque()
+
+    def want_read(self):
+        self.starved = False
+        if self.eof or len(self.chunks) >= self.max_chunks:
+            return False
+        if not self.pool.available():
+            self.starved = True
+            return False
+        return True
+
+    def want_write(self):
+        return bool(self.chunks)
+
+    def done(self):
+        return self.eof and not self.chunks
+
+    def read(self):
+        buf = self.pool.acquire()
+        if buf is None:
+            return
+        try:
+            n = self.src.recv_into(buf)
+        except (BlockingIOError, InterruptedError):
+            self.pool.release(buf)
+            return
+        except OSError:
+            self.pool.release(buf)
+            raise
+        if n == 0:
+            self.pool.release(buf)
+            self.eof = True
+        else:
+            self.transferred += n
+            self.chunks.append([buf, 0, n])
+            # 先尝试直接写出，避免多一轮 select
+            self.write()
+        self._maybe_shutdown()
+
+    def write(self):
+        while self.chunks:
+            chunk = self.chunks[0]
+            buf, start, end = chunk
+            try:
+                sent = self.dst.send(memoryview(buf)[start:end])
+            except (BlockingIOError, InterruptedError):
+                return
+            if start + sent < end:
+                chunk[1] = start + sent
+                return
+            self.chunks.popleft()
+            self.pool.release(buf)
+        self._maybe_shutdown()
+
+    def close(self):
+        while self.chunks:
+            self.pool.release(self.chunks.popleft()[0])
+
+
+class _SpliceUnsupported(Exception):
+    """splice 调用因不支持而失败，pipe 为出错的 _SplicePipe"""
+
+    def __init__(self, pipe):
+        super().__init__("splice 不可用")
+        self.pipe = pipe
+
+
+class _SplicePipe(_Pipe):
+    """单方向零拷贝通道：src -> 内核管道 -> dst，仅限 Linux
+
+    splice 返回 _SPLICE_UNSUPPORTED 中的错误时抛出 _SpliceUnsupported，由连接改用复制模式。
+    """
+
+    def __init__(self, src, dst, bufsize=BUFFER_SIZE):
+        super().__init__(src, dst)
+        self.bufsize = bufsize
+        self.pipe_r, self.pipe_w = os.pipe()
+        os.set_blocking(self.pipe_r, False)
+        os.set_blocking(self.pipe_w, False)
+        if bufsize > BUFFER_SIZE and hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                fcntl.fcntl(self.pipe_w, fcntl.F_SETPIPE_SZ, bufsize)
+            except OSError:
+                pass
+        # 已进入管道但尚未写到 dst 的字节数
+        self.pending = 0
+        self.flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+    def want_read(self):
+        return not self.eof and not self.pending
+
+    def want_write(self):
+        return self.pending > 0
+
+    def done(self):
+        return self.eof and not self.pending
+
+    def read(self):
+        try:
+            n = os.splice(self.src.fileno(), self.pipe_w, self.bufsize, flags=self.flags)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._check_unsupported(e)
+            raise
+        if n == 0:
+            self.eof = True
+        else:
+            self.transferred += n
+            self.pending += n
+            self.write()
+        self._maybe_shutdown()
+
+    def write(self):
+        try:
+            n = os.splice(self.pipe_r, self.dst.fileno(), self.pending, flags=self.flags)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._check_unsupported(e)
+            raise
+        self.pending -= n
+        self._maybe_shutdown()
+
+    def _check_unsupported(self, error):
+        if error.errno in _SPLICE_UNSUPPORTED:
+            raise _SpliceUnsupported(self) from error
+
+    def to_copy(self, pool, max_chunks):
+        """转换为复制模式的 _CopyPipe，已进入内核管道的数据移入池中的缓冲区
+
+        没有可用的缓冲区存放这些数据时返回 None。
+        """
+        copy = _CopyPipe(self.src, self.dst, pool, max_chunks)
+        copy.eof, copy.shut, copy.transferred = self.eof, self.shut, self.transferred
+        if self.pending:
+            # 每次最多读入 bufsize 字节，且有待写数据时不再读取，一个缓冲区即可容纳
+            buf = pool.acquire()
+            if buf is None:
+                return None
+            try:
+                n = os.readv(self.pipe_r, [memoryview(buf)[:self.pending]])
+            except OSError:
+                pool.release(buf)
+                return None
+            copy.chunks.append([buf, 0, n])
+        return copy
+
+    def close(self):
+        for fd in (self.pipe_r, self.pipe_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class TcpConnection:
+    """一条客户端连接及其对应的目标连接"""
+
+    def __init__(self, forwarder, client, addr, target):
+        self.forwarder = forwarder
+        self.loop = forwarder.loop
+        self.client = client
+        self.addr = addr
+        self.target = target
+        self.upstream = self.downstream = None
+        if forwarder.splice:
+            try:
+                self.upstream = _SplicePipe(client, target, forwarder.pool.bufsize)
+                self.downstream = _SplicePipe(target, client, forwarder.pool.bufsize)
+            except OSError:
+                # 管道创建失败（如文件描述符耗尽）时退回复制模式
+                if self.upstream is not None:
+                    self.upstream.close()
+                self.upstream = None
+        if self.upstream is None:
+            pool = forwarder.pool
+            self.upstream = _CopyPipe(client, target, pool, forwarder.max_chunks)    # 客户端 -> 目标
+            self.downstream = _CopyPipe(target, client, pool, forwarder.max_chunks)  # 目标 -> 客户端
+        self.closed = False
+        self._waiting_pool = False
+        self._connect_start = None
+        self._connect_timer = None
+
+    def start(self):
+        """等待到目标的非阻塞连接完成，超过 connect_timeout 时关闭两端"""
+        self._connect_start = time.monotonic()
+        self._connect_timer = self.loop.call_later(self.forwarder.connect_timeout, self._on_connect_timeout)
+        self.loop.set_events(self.target, EVENT_WRITE, self._on_connect)
+
+    def _on_connect_timeout(self):
+        self._connect_timer = None
+        if self.closed:
+            return
+        self.forwarder.stats.errors["connect_timeout"] += 1
+        self.forwarder.log(f"连接目标 {self.forwarder.target_addr[0]}:{self.forwarder.target_addr[1]} 超时", "ERROR")
+        self.close()
+
+    def _on_connect(self, mask):
+        if self.closed:
+            return
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        err = self.target.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.forwarder.stats.errors["connect"] += 1
+            self.forwarder.log(f"连接目标 {self.forwarder.target_addr[0]}:{self.forwarder.target_addr[1]} 失败: "
+                               f"{errno.errorcode.get(err, err)}", "ERROR")
+            self.close()
+            return
+        self.forwarder.stats.connect_latency.add(time.monotonic() - self._connect_start)
+        self._update()
+
+    def _on_client(self, mask):
+        self._on_event(mask, self.upstream, self.downstream)
+
+    def _on_target(self, mask):
+        self._on_event(mask, self.downstream, self.upstream)
+
+    def _on_event(self, mask, inbound, outbound):
+        if self.closed:
+            return
+        try:
+            if mask & EVENT_WRITE:
+                outbound.write()
+            if mask & EVENT_READ:
+                inbound.read()
+        except _SpliceUnsupported as e:
+            if not self._fall_back(e.pipe):
+                self.forwarder.stats.errors["relay"] += 1
+                self.close()
+                return
+        except OSError:
+            self.forwarder.stats.errors["relay"] += 1
+            self.close()
+            return
+        self._update()
+
+    def _fall_back(self, pipe):
+        """该方向的 splice 不可用，改用复制模式继续转发；无法转换时返回 False"""
+        forwarder = self.forwarder
+        copy = pipe.to_copy(forwarder.pool, forwarder.max_chunks)
+        pipe.close()
+        if copy is None:
+            return False
+        if pipe is self.upstream:
+            self.upstream = copy
+        else:
+            self.downstream = copy
+        forwarder.splice_failed()
+        return True
+
+    def _update(self):
+        """根据两个方向的缓冲状态刷新关注的事件"""
+        if self.upstream.done() and self.downstream.done():
+            self.close()
+            return
+        self.loop.set_events(self.client, self._events(self.upstream, self.downstream), self._on_client)
+        self.loop.set_events(self.target, self._events(self.downstream, self.upstream), self._on_target)
+        if (self.upstream.starved or self.downstream.starved) and not self._waiting_pool:
+            # 全局内存已满，等有缓冲区归还后再恢复读取
+            self._waiting_pool = True
+            self.forwarder.pool.wait(self._on_pool_available)
+
+    def _on_pool_available(self):
+        self._waiting_pool = False
+        self.loop.call_soon(self._resume)
+
+    def _resume(self):
+        if not self.closed:
+            self._update()
+
+    @staticmethod
+    def _events(inbound, outbound):
+        events = 0
+        if inbound.want_read():
+            events |= EVENT_READ
+        if outbound.want_write():
+            events |= EVENT_WRITE
+        return events
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        stats = self.forwarder.stats
+        stats.bytes_up += self.upstream.transferred
+        stats.bytes_down += self.downstream.transferred
+        self.upstream.close()
+        self.downstream.close()
+        for sock in (self.client, self.target):
+            self.loop.discard(sock)
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self.forwarder.connections.discard(self)
+
+
+class TcpForwarder:
+    """TCP 转发规则：监听 listen_addr，并把每个连接转发到 target_addr
+
+    splice=True 时在支持的平台上使用零拷贝转发，否则退回复制模式。
+    复制模式的缓冲区来自 pool（多个转发可共享同一个池以共用全局内存上限），
+    每个连接最多缓存 connection_memory 字节的待写数据；到目标的连接超过
+    connect_timeout 秒未建立时关闭客户端连接。
+    """
+
+    def __init__(self, loop, listen_addr, target_addr, log=None,
+                 pool=None, connection_memory=CONNECTION_MEMORY, backlog=128, splice=False,
+                 connect_timeout=CONNECT_TIMEOUT):
+        self.loop = loop
+        self.listen_addr = listen_addr
+        self.target_addr = target_addr
+        self.log = log or _null_log
+        self.pool = pool or BufferPool()
+        # 两个方向平分单连接内存上限
+        self.max_chunks = max(1, connection_memory // (2 * self.pool.bufsize))
+        self.splice = splice and SPLICE_AVAILABLE
+        self.backlog = backlog
+        self.connect_timeout = connect_timeout
+        self.server_socket = None
+        self.connections = set()
+        self.stats = ForwardStats()
+
+    def start(self):
+        """创建监听套接字并注册到事件循环，绑定失败时直接抛出异常"""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind(self.listen_addr)
+            server_socket.listen(self.backlog)
+            server_socket.setblocking(False)
+        except OSError:
+            server_socket.close()
+            raise
+        self.server_socket = server_socket
+        self.loop.call_soon(self.loop.set_events, server_socket, EVENT_READ, self._on_accept)
+
+    def connection_count(self):
+        return len(self.connections)
+
+    def splice_failed(self):
+        """连接的 splice 不可用时调用：之后的新连接直接使用复制模式"""
+        self.stats.errors["splice_fallback"] += 1
+        if self.splice:
+            self.splice = False
+            self.log(f"零拷贝转发不可用，{self.listen_addr[1]} 端口改用复制模式", "WARNING")
+
+    def snapshot(self):
+        """统计快照，只能在循环线程中调用"""
+        live_up = sum(conn.upstream.transferred for conn in self.connections)
+        live_down = sum(conn.downstream.transferred for conn in self.connections)
+        return self.stats.snapshot(len(self.connections), live_up, live_down)
+
+    def close(self):
+        """线程安全：停止监听并断开所有连接，返回时监听端口已释放"""
+        self.loop.call_wait(self._close)
+
+    def _close(self):
+        if self.server_socket is not None:
+            self.loop.discard(self.server_socket)
+            self.server_socket.close()
+            self.server_socket = None
+        for conn in list(self.connections):
+            conn.close()
+
+    def _on_accept(self, mask):
+        # 一次就绪尽量接收所有排队的连接
+        while self.server_socket is not None:
+            try:
+                client, addr = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.stats.errors["accept"] += 1
+                self.log(f"连接处理错误: {str(e)}", "ERROR")
+                return
+
+            self.stats.accepted += 1
+            self.log(f"新连接来自: {addr}", "INFO")
+            client.setblocking(False)
+            target = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            target.setblocking(False)
+            err = target.connect_ex(self.target_addr)
+            if err not in _CONNECT_IN_PROGRESS:
+                self.stats.errors["connect"] += 1
+                self.log(f"连接目标 {self.target_addr[0]}:{self.target_addr[1]} 失败: "
+                         f"{errno.errorcode.get(err, err)}", "ERROR")
+                client.close()
+                target.close()
+                continue
+
+            conn = TcpConnection(self, client, addr, target)
+            self.connections.add(conn)
+            conn.start()
+
+
+class _UdpSession:
+    """一个客户端地址对应的 UDP 会话，拥有独立的上游套接字"""
+
+    def __init__(self, forwarder, addr):
+        self.forwarder = forwarder
+        self.addr = addr
+        self.last_active = time.monotonic()
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.upstream.setblocking(False)
+            self.upstream.connect(forwarder.target_addr)
+        except OSError:
+            self.upstream.close()
+            raise
+        forwarder.loop.set_events(self.upstream, EVENT_READ, self._on_reply)
+
+    def send(self, data):
+        self.last_active = time.monotonic()
+        try:
+            self.upstream.send(data)
+        except (BlockingIOError, InterruptedError):
+            # UDP 不保证送达，发送缓冲区满时直接丢弃
+            self.forwarder.stats.errors["dropped"] += 1
+        except OSError:
+            # 目标返回 ICMP 不可达等错误时忽略，由空闲超时回收会话
+            self.forwarder.stats.errors["relay"] += 1
+
+    def _on_reply(self, mask):
+        forwarder = self.forwarder
+        view = forwarder.view
+        for _ in range(UDP_BATCH):
+            try:
+                n = self.upstream.recv_into(forwarder.buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                continue
+            self.last_active = time.monotonic()
+            forwarder.stats.bytes_down += n
+            forwarder.sessions.move_to_end(self.addr)
+            try:
+                forwarder.server_socket.sendto(view[:n], self.addr)
+            except (BlockingIOError, InterruptedError):
+                pass
+
+    def close(self):
+        self.forwarder.loop.discard(self.upstream)
+        self.upstream.close()
+
+
+class UdpForwarder:
+    """UDP 转发规则：按客户端地址维护会话表，空闲超时后回收会话
+
+    会话表按最近活动时间排序，回收时只需从表头检查已过期的会话；
+    会话数达到 max_sessions 时，新会话替换表头最久未活动的会话，
+    避免大量伪造源地址耗尽文件描述符。
+    """
+
+    def __init__(self, loop, listen_addr, target_addr, log=None,
+                 bufsize=BUFFER_SIZE, idle_timeout=UDP_IDLE_TIMEOUT, max_sessions=UDP_MAX_SESSIONS):
+        self.loop = loop
+        self.listen_addr = listen_addr
+        self.target_addr = target_addr
+        self.log = log or _null_log
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+        self.server_socket = None
+        self.sessions = collections.OrderedDict()
+        self._evict_timer = None
+        self.stats = ForwardStats()
+
+    def start(self):
+        """创建监听套接字并注册到事件循环，绑定失败时直接抛出异常"""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            server_socket.bind(self.listen_addr)
+            server_socket.setblocking(False)
+        except OSError:
+            server_socket.close()
+            raise
+        self.server_socket = server_socket
+        self.loop.call_soon(self._start)
+
+    def _start(self):
+        self.loop.set_events(self.server_socket, EVENT_READ, self._on_datagram)
+        self._schedule_evict()
+
+    def connection_count(self):
+        return len(self.sessions)
+
+    def snapshot(self):
+        """统计快照，只能在循环线程中调用"""
+        return self.stats.snapshot(len(self.sessions))
+
+    def close(self):
+        """线程安全：停止监听并关闭所有会话，返回时监听端口已释放"""
+        self.loop.call_wait(self._close)
+
+    def _close(self):
+        if self._evict_timer is not None:
+            self._evict_timer.cancel()
+            self._evict_timer = None
+        if self.server_socket is not None:
+            self.loop.discard(self.server_socket)
+            self.server_socket.close()
+            self.server_socket = None
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+
+    def _on_datagram(self, mask):
+        for _ in range(UDP_BATCH):
+            if self.server_socket is None:
+                return
+            try:
+                n, addr = self.server_socket.recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+
+            session = self.sessions.get(addr)
+            if session is None:
+                if len(self.sessions) >= self.max_sessions:
+                    self.stats.errors["evicted"] += 1
+                    self.sessions.popitem(last=False)[1].close()
+                try:
+                    session = _UdpSession(self, addr)
+                except OSError as e:
+                    self.stats.errors["session"] += 1
+                    self.log(f"创建UDP会话失败: {str(e)}", "ERROR")
+                    continue
+                self.stats.accepted += 1
+                self.sessions[addr] = session
+                self.log(f"新UDP会话来自: {addr}", "INFO")
+            else:
+                self.sessions.move_to_end(addr)
+            self.stats.bytes_up += n
+            session.send(self.view[:n])
+
+    def _schedule_evict(self):
+        self._evict_timer = self.loop.call_later(max(1, self.idle_timeout / 4), self._evict)
+
+    def _evict(self):
+        """回收空闲超时的会话"""
+        deadline = time.monotonic() - self.idle_timeout
+        while self.sessions:
+            addr, session = next(iter(self.sessions.items()))
+            if session.last_active > deadline:
+                break
+            del self.sessions[addr]
+            session.close()
+        self._schedule_evict()
+
+
+class ForwardRule:
+    """一条端口转发规则：外部端口映射到本机 listen_ip，再转发到 target_ip:internal_port"""
+
+    def __init__(self, protocol, listen_ip, external_port, target_ip, internal_port,
+                 description="", splice=False):
+        self.protocol = protocol
+        self.listen_ip = listen_ip
+        self.external_port = external_port
+        self.target_ip = target_ip
+        self.internal_port = internal_port
+        self.description = description or f"Forward to {target_ip}:{internal_port}"
+        self.splice = splice
+
+    @property
+    def key(self):
+        return (self.protocol, self.external_port)
+
+    def __str__(self):
+        return (f"{self.protocol} {self.listen_ip}:{self.external_port} -> "
+                f"{self.target_ip}:{self.internal_port}")
+
+
+class ForwardService:
+    """端口转发服务：所有规则共用一个事件循环
+
+    每条规则只占用一个监听套接字，线程和内存开销只随活跃连接增长。
+    upnp 不为 None 时，添加/删除规则会同步添加/删除路由器上的端口映射。
+    """
+
+    def __init__(self, upnp=None, log=None, bufsize=BUFFER_SIZE,
+                 pool_memory=POOL_MEMORY, connection_memory=CONNECTION_MEMORY):
+        self.upnp = upnp
+        self.log = log or _null_log
+        self.loop = EventLoop(log=self.log)
+        self.pool = BufferPool(bufsize, pool_memory)
+        self.connection_memory = connection_memory
+        self.rules = {}
+        self._lock = threading.Lock()
+
+    def add_rule(self, rule, map_upnp=True):
+        """添加并启动一条转发规则，失败时回滚已添加的端口映射"""
+        with self._lock:
+            if rule.key in self.rules:
+                raise ValueError(f"转发规则已存在: {rule.protocol} {rule.external_port}")
+            # 先占位，防止并发添加同一端口
+            self.rules[rule.key] = (rule, None, False)
+
+        mapped = False
+        try:
+            if map_upnp and self.upnp is not None:
+                if not self.upnp.addportmapping(rule.external_port, rule.protocol, rule.listen_ip,
+                                                rule.external_port, rule.description, ''):
+                    raise RuntimeError("端口映射到本机失败")
+                mapped = True
+
+            if rule.protocol == "UDP":
+                forwarder = UdpForwarder(self.loop, (rule.listen_ip, rule.external_port),
+                                         (rule.target_ip, rule.internal_port), log=self.log,
+                                         bufsize=self.pool.bufsize)
+            else:
+                forwarder = TcpForwarder(self.loop, (rule.listen_ip, rule.external_port),
+                                         (rule.target_ip, rule.internal_port), log=self.log,
+                                         pool=self.pool, connection_memory=self.connection_memory,
+                                         splice=rule.splice)
+            self.loop.start()
+            forwarder.start()
+        except Exception:
+            with self._lock:
+                del self.rules[rule.key]
+            if mapped:
+                self._delete_mapping(rule)
+            raise
+
+        with self._lock:
+            self.rules[rule.key] = (rule, forwarder, mapped)
+        return forwarder
+
+    def remove_rule(self, protocol, external_port):
+        """停止一条转发规则并删除其端口映射，规则不存在时返回 False"""
+        with self._lock:
+            entry = self.rules.get((protocol, external_port))
+            if entry is None or entry[1] is None:
+                return False
+            del self.rules[(protocol, external_port)]
+        rule, forwarder, mapped = entry
+        forwarder.close()
+        if mapped:
+            self._delete_mapping(rule)
+        return True
+
+    def update_rule(self, rule, map_upnp=True):
+        """用新配置替换同一外部端口上的规则"""
+        self.remove_rule(rule.protocol, rule.external_port)
+        return self.add_rule(rule, map_upnp)
+
+    def list_rules(self):
+        """返回 (规则, 活跃连接数) 列表"""
+        with self._lock:
+            entries = [entry for entry in self.rules.values() if entry[1] is not None]
+        return [(rule, forwarder.connection_count()) for rule, forwarder, mapped in entries]
+
+    def get_stats(self):
+        """返回 (规则, 统计快照) 列表，速率按距上次调用的时间计算"""
+        with self._lock:
+            entries = [entry for entry in self.rules.values() if entry[1] is not None]
+        if not entries:
+            return []
+        snapshots = self.loop.call_wait(lambda: [forwarder.snapshot() for rule, forwarder, mapped in entries])
+        if snapshots is None:
+            return []
+        return [(entry[0], snapshot) for entry, snapshot in zip(entries, snapshots)]
+
+    def request_stats(self, callback):
+        """线程安全且不阻塞：在循环线程中生成快照后调用 callback([(规则, 统计快照)])
+
+        界面线程用它代替 get_stats，避免等待循环线程；callback 在循环线程中执行。
+        """
+        with self._lock:
+            entries = [entry for entry in self.rules.values() if entry[1] is not None]
+        if not entries:
+            callback([])
+            return
+        self.loop.call_soon(lambda: callback([(rule, forwarder.snapshot()) for rule, forwarder, mapped in entries]))
+
+    def stop(self):
+        """删除所有规则及其端口映射并停止事件循环"""
+        with self._lock:
+            keys = list(self.rules)
+        for protocol, external_port in keys:
+            self.remove_rule(protocol, external_port)
+        self.loop.stop()
+
+    def _delete_mapping(self, rule):
+        if self.upnp is None:
+            return
+        try:
+            self.upnp.deleteportmapping(rule.external_port, rule.protocol)
+        except Exception as e:
+            self.log(f"删除端口映射失败: {rule.protocol} {rule.external_port}: {str(e)}", "WARNING")
@@ -0,0 +1,818 @@
+"""路由器端口映射表的本地镜像
+
+GetGenericPortMappingEntry 每个条目一次 SOAP 往返，条目多时遍历一次需要数秒。
+MappingTable 只在首次读取和过期后遍历路由器，其余读取直接返回内存中的结果；
+通过它进行的添加/删除会同步更新镜像。
+
+支持 WANIPConnection:2 的路由器用 GetListOfPortMappings 分页读取，
+一次请求返回一段端口范围内的所有条目；不支持时退回逐条读取。
+"""
+import collections
+import csv
+import ipaddress
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import urllib.error
+import urllib.request
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+# 镜像的有效期（秒），过期后在后台重新遍历路由器
+MAPPING_TTL = 60
+
+# 遍历失败后重试的间隔（秒），期间读取仍返回上一次的结果
+REFRESH_RETRY = 10
+
+# 单次遍历最多读取的条目数，防止路由器实现错误时无限循环
+MAX_ENTRIES = 4096
+
+# 查找空闲端口的默认范围，避开需要特权的知名端口
+PORT_RANGE = (1024, 65535)
+
+# GetListOfPortMappings 每页最多返回的条目数
+LIST_PAGE_SIZE = 500
+
+# 批量添加时同时进行的请求数，家用路由器的 HTTP 服务通常只有很少的工作线程
+BATCH_CONCURRENCY = 8
+
+# 租期续约：在到期前 LEASE_MARGIN 比例（至少 LEASE_MIN_MARGIN 秒）时重新添加映射
+LEASE_MARGIN = 0.2
+LEASE_MIN_MARGIN = 5
+
+# 续约失败后的重试间隔（秒）
+LEASE_RETRY = 10
+
+# 时间轮：每格 LEASE_TICK 秒，共 LEASE_SLOTS 格，超过一圈的条目记录剩余圈数
+LEASE_TICK = 1.0
+LEASE_SLOTS = 512
+
+# 路由器只支持永久映射：(错误码, miniupnpc 异常消息)
+_PERMANENT_ONLY_ERROR = (725, "OnlyPermanentLeasesSupported")
+
+# AddPortMapping 的参数变体，部分路由器只接受其中一种：(名称, 说明, 生成 (描述, 远程主机))
+ADD_VARIANTS = (
+    ("standard", "标准参数", lambda port, description: (description, '')),
+    ("remote_host_0", "修改后的远程主机参数", lambda port, description: (description, '0')),
+    ("simple_description", "简化描述", lambda port, description: (f"Port{port}", '')),
+    ("minimal_description", "最简参数", lambda port, description: ("UPnP", '')),
+)
+
+# 端口冲突，换参数变体也无法解决：(错误码, miniupnpc 异常消息)
+_CONFLICT_ERROR = (718, "ConflictInMappingEntry")
+
+# 批量导入规则时未提供描述使用的默认值
+DEFAULT_DESCRIPTION = "Python UPnP 映射"
+
+# SOAP 请求超时（秒）
+SOAP_TIMEOUT = 5
+
+WANIP_V2 = "urn:schemas-upnp-org:service:WANIPConnection:2"
+
+# 路由器不支持该操作时返回的 UPnP 错误码：Invalid Action / Optional Action Not Implemented
+UNSUPPORTED_ERRORS = (401, 602)
+
+# NoSuchEntryInArray / PortMappingNotFound：指定范围内没有映射
+EMPTY_LIST_ERRORS = (714, 730)
+
+# SpecifiedArrayIndexInvalid：按索引遍历时超出映射表末尾
+END_OF_TABLE_ERROR = 713
+
+# 端口映射条目
+PortMapping = collections.namedtuple(
+    "PortMapping",
+    "external_port protocol internal_ip internal_port description enabled remote_host duration")
+
+# 批量添加的单条结果：规则（PortMapping）和错误信息（成功时为 None）
+BatchResult = collections.namedtuple("BatchResult", "rule error")
+
+
+def _null_log(message, level="INFO"):
+    pass
+
+
+def parse_generic_entry(entry):
+    """把 getgenericportmapping 的返回值转换为 PortMapping
+
+    miniupnpc 返回 (外部端口, 协议, (内部地址, 内部端口), 描述, 启用, 远程主机, 租期)，
+    其中启用为字符串 '0' / '1'；兼容内部地址和端口平铺的旧格式。无法识别时返回 None。
+    """
+    if not entry or len(entry) < 3:
+        return None
+    fields = list(entry)
+    if isinstance(fields[2], (tuple, list)):
+        fields[2:3] = list(fields[2])
+    fields += [None] * (8 - len(fields))
+    try:
+        external_port, internal_port = int(fields[0]), int(fields[3])
+        enabled = bool(int(fields[5])) if fields[5] is not None else True
+    except (TypeError, ValueError):
+        return None
+    return PortMapping(external_port, str(fields[1]).upper(), fields[2], internal_port,
+                       fields[4] or "", enabled, fields[6] or "", fields[7])
+
+
+class SoapError(Exception):
+    """路由器返回的 UPnP 错误，code 为 UPnPError 错误码（未知时为 None）"""
+
+    def __init__(self, code, description):
+        super().__init__(f"{code} {description}")
+        self.code = code
+        self.description = description
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _child_text(element, name):
+    for child in element:
+        if _local_name(child.tag) == name:
+            return child.text or ""
+    return None
+
+
+def soap_call(control_url, service, action, arguments=(), timeout=SOAP_TIMEOUT):
+    """向控制地址发送一个 SOAP 请求，返回 {输出参数名: 文本}
+
+    路由器返回 UPnP 错误时抛出 SoapError。
+    """
+    body = "".join(f"<{name}>{escape(str(value))}</{name}>" for name, value in arguments)
+    envelope = ('<?xml version="1.0"?>'
+                '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+                's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+                f'<s:Body><u:{action} xmlns:u="{service}">{body}</u:{action}></s:Body>'
+                '</s:Envelope>').encode("utf-8")
+    request = urllib.request.Request(control_url, data=envelope, method="POST", headers={
+        "Content-Type": 'text/xml; charset="utf-8"',
+        "SOAPAction": f'"{service}#{action}"',
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status, data = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, data = e.code, e.read()
+    return parse_soap_response(action, status, data)
+
+
+def parse_soap_response(action, status, data):
+    """解析 SOAP 响应，返回 {输出参数名: 文本}；UPnP 错误或 HTTP 错误时抛出 SoapError"""
+    if status >= 400:
+        code = description = None
+        try:
+            for element in ET.fromstring(data).iter():
+                if _local_name(element.tag) == "errorCode":
+                    code = int(element.text)
+                elif _local_name(element.tag) == "errorDescription":
+                    description = element.text
+        except (ET.ParseError, ValueError, TypeError):
+            pass
+        raise SoapError(code, description or f"HTTP {status}")
+
+    for element in ET.fromstring(data).iter():
+        if _local_name(element.tag) == f"{action}Response":
+            return {_local_name(child.tag): child.text or "" for child in element}
+    raise SoapError(None, f"{action} 响应格式错误")
+
+
+def parse_port_listing(listing):
+    """解析 GetListOfPortMappings 返回的 NewPortListing XML，返回 PortMapping 列表"""
+    mappings = []
+    if not listing or not listing.strip():
+        return mappings
+    for entry in ET.fromstring(listing).iter():
+        if _local_name(entry.tag) != "PortMappingEntry":
+            continue
+        try:
+            mappings.append(PortMapping(
+                int(_child_text(entry, "NewExternalPort")),
+                (_child_text(entry, "NewProtocol") or "").upper(),
+                _child_text(entry, "NewInternalClient") or "",
+                int(_child_text(entry, "NewInternalPort")),
+                _child_text(entry, "NewDescription") or "",
+                (_child_text(entry, "NewEnabled") or "1").strip() in ("1", "true"),
+                _child_text(entry, "NewRemoteHost") or "",
+                int(_child_text(entry, "NewLeaseTime") or 0)))
+        except (TypeError, ValueError):
+            continue
+    return mappings
+
+
+def list_port_mappings(control_url, protocol, page_size=LIST_PAGE_SIZE, timeout=SOAP_TIMEOUT, call=soap_call):
+    """用 GetListOfPortMappings 分页读取一个协议的全部映射
+
+    部分路由器每页返回的条目少于 page_size，因此一直读到空页或 NoSuchEntryInArray 为止。
+    call 为发送请求的函数，参数与 soap_call 相同（例如 soap_client.UPnPClient.soap_call）。
+    """
+    mappings = []
+    start = 0
+    while start <= 65535:
+        try:
+            result = call(control_url, WANIP_V2, "GetListOfPortMappings", [
+                ("NewStartPort", start), ("NewEndPort", 65535), ("NewProtocol", protocol),
+                ("NewManage", 1), ("NewNumberOfPorts", page_size)], timeout)
+        except SoapError as e:
+            if e.code in EMPTY_LIST_ERRORS:
+                break
+            raise
+        # 忽略起始端口之前的条目，路由器不按 NewStartPort 过滤时也不会重复读取
+        page = [mapping for mapping in parse_port_listing(result.get("NewPortListing"))
+                if mapping.external_port >= start]
+        if not page:
+            break
+        mappings.extend(page)
+        start = max(mapping.external_port for mapping in page) + 1
+    return mappings
+
+
+def parse_specific_entry(external_port, protocol, entry):
+    """把 getspecificportmapping 的返回值 (内部地址, 内部端口, 描述, 启用, 租期) 转换为 PortMapping"""
+    if not entry or len(entry) < 2:
+        return None
+    fields = list(entry) + [None] * (5 - len(entry))
+    try:
+        internal_port = int(fields[1])
+        enabled = bool(int(fields[3])) if fields[3] is not None else True
+    except (TypeError, ValueError):
+        return None
+    return PortMapping(int(external_port), protocol.upper(), fields[0], internal_port,
+                       fields[2] or "", enabled, "", fields[4])
+
+
+def make_rule(external_port, protocol, internal_ip, internal_port=None, description=None, lease=None):
+    """校验并生成一条映射规则，参数错误时抛出 ValueError"""
+    external_port = int(external_port)
+    lease = int(lease or 0)
+    if lease < 0:
+        raise ValueError(f"租期不能为负数: {lease}")
+    internal_port = external_port if internal_port in (None, "") else int(internal_port)
+    protocol = str(protocol or "TCP").strip().upper()
+    internal_ip = str(internal_ip).strip()
+    for port in (external_port, internal_port):
+        if not 1 <= port <= 65535:
+            raise ValueError(f"端口超出范围: {port}")
+    if protocol not in ("TCP", "UDP"):
+        raise ValueError(f"不支持的协议: {protocol}")
+    ipaddress.IPv4Address(internal_ip)
+    return PortMapping(external_port, protocol, internal_ip, internal_port,
+                       description or DEFAULT_DESCRIPTION, True, "", lease)
+
+
+def load_rules(path):
+    """从 CSV 或 JSON 文件读取映射规则列表
+
+    CSV 需要表头 external_port,protocol,internal_ip,internal_port,description,lease；
+    JSON 为同样字段的对象数组。internal_port、description 和 lease（租期秒数）可以省略。
+    """
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if os.path.splitext(path)[1].lower() == ".json":
+            rows = json.load(f)
+            if not isinstance(rows, list):
+                raise ValueError("JSON 文件应为规则对象数组")
+            first_line = 1
+        else:
+            rows = list(csv.DictReader(f))
+            first_line = 2
+
+    rules = []
+    seen = set()
+    for line, row in enumerate(rows, first_line):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError("规则应为对象")
+            rule = make_rule(row.get("external_port"), row.get("protocol"), row.get("internal_ip"),
+                             row.get("internal_port"), row.get("description"), row.get("lease"))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"第 {line} 条规则无效: {str(e)}") from None
+        key = (rule.external_port, rule.protocol)
+        if key in seen:
+            raise ValueError(f"第 {line} 条规则重复: {rule.protocol} {rule.external_port}")
+        seen.add(key)
+        rules.append(rule)
+    return rules
+
+
+def _is_upnp_error(error, code, name):
+    """判断异常是否为指定的 UPnP 错误：SoapError 比较错误码，miniupnpc 的异常消息为错误名称"""
+    if isinstance(error, SoapError):
+        return error.code == code
+    return str(error).strip() == name
+
+
+def _is_end_of_table(error):
+    return _is_upnp_error(error, END_OF_TABLE_ERROR, "SpecifiedArrayIndexInvalid")
+
+
+class MappingTable:
+    """端口映射表镜像，按 (外部端口, 协议) 索引
+
+    addportmapping/deleteportmapping 与 miniupnpc 的同名方法参数一致，
+    可以代替 upnp 对象传给 ForwardService 等只做写操作的调用方。
+    """
+
+    def __init__(self, upnp, control_url=None, ttl=MAPPING_TTL, log=None, profile=None):
+        self.upnp = upnp
+        self.control_url = control_url
+        # 记录路由器接受的参数变体（igd.RouterProfile），为 None 时每次按顺序尝试
+        self.profile = profile
+        self.ttl = ttl
+        self.log = log or _null_log
+        # 是否支持 GetListOfPortMappings：None 表示尚未检测
+        self.bulk_supported = None if control_url else False
+        self._mappings = {}
+        self._loaded_at = None
+        self._expired = False
+        # 遍历期间通过本对象做的修改，遍历结束后重放
+        self._pending = None
+        self._lock = threading.Lock()
+        # 同一时间只进行一次遍历；等到锁后发现已被其他线程刷新时不再重复
+        self._refresh_lock = threading.RLock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        # 带租期的映射由时间轮在到期前续约
+        self.leases = LeaseRenewer(self, log=self.log)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._mappings)
+
+    @property
+    def loaded(self):
+        return self._loaded_at is not None
+
+    def is_stale(self, now=None):
+        if self._loaded_at is None or self._expired:
+            return True
+        now = time.monotonic() if now is None else now
+        return now - self._loaded_at >= self.ttl
+
+    def refresh(self):
+        """遍历路由器的映射表并替换镜像，返回条目数
+
+        遍历中途出错时保留原来的镜像并标记为过期，异常继续抛出。
+        """
+        with self._refresh_lock:
+            with self._lock:
+                self._pending = []
+            started = time.monotonic()
+            try:
+                mappings = None
+                if self.bulk_supported is not False:
+                    mappings = self._fetch_bulk()
+                if mappings is None:
+                    mappings = self._fetch_generic()
+            except BaseException:
+                with self._lock:
+                    self._pending = None
+                    self._expired = True
+                raise
+            with self._lock:
+                for key, mapping in self._pending:
+                    self._apply(mappings, key, mapping)
+                self._pending = None
+                self._mappings = mappings
+                self._loaded_at = started
+                self._expired = False
+            return len(mappings)
+
+    def _fetch_bulk(self):
+        """按页读取 TCP 和 UDP 映射，路由器不支持时返回 None"""
+        mappings = {}
+        # 后端自带连接复用时通过它发送请求
+        call = getattr(self.upnp, "soap_call", soap_call)
+        try:
+            for protocol in ("TCP", "UDP"):
+                for mapping in list_port_mappings(self.control_url, protocol, call=call):
+                    mappings[(mapping.external_port, mapping.protocol)] = mapping
+        except SoapError as e:
+            if e.code in UNSUPPORTED_ERRORS or self.bulk_supported is None:
+                self.bulk_supported = False
+                self.log("路由器不支持 GetListOfPortMappings，改为逐条读取映射表", "INFO")
+            else:
+                self.log(f"批量读取映射表失败，改为逐条读取: {str(e)}", "WARNING")
+            return None
+        except (OSError, ET.ParseError) as e:
+            self.log(f"批量读取映射表失败，改为逐条读取: {str(e)}", "WARNING")
+            return None
+        self.bulk_supported = True
+        return mappings
+
+    def _fetch_generic(self):
+        """用 GetGenericPortMappingEntry 逐条读取
+
+        只有 SpecifiedArrayIndexInvalid（miniupnpc 对它返回 None）表示读到末尾，
+        超时、连接错误等其他异常继续抛出，不能当作映射表已经读完。
+        """
+        mappings = {}
+        for index in range(MAX_ENTRIES):
+            try:
+                entry = self.upnp.getgenericportmapping(index)
+            except Exception as e:
+                if not _is_end_of_table(e):
+                    raise
+                break
+            if not entry:
+                break
+            mapping = parse_generic_entry(entry)
+            if mapping is not None:
+                mappings[(mapping.external_port, mapping.protocol)] = mapping
+        return mappings
+
+    def ensure_loaded(self):
+        """尚未加载时同步遍历一次，其他线程正在遍历时等待其结果"""
+        if self.loaded:
+            return
+        with self._refresh_lock:
+            if not self.loaded:
+                self.refresh()
+
+    def mappings(self):
+        """按外部端口排序的 PortMapping 列表"""
+        self.ensure_loaded()
+        with self._lock:
+            mappings = list(self._mappings.values())
+        return sorted(mappings, key=lambda mapping: (mapping.external_port, mapping.protocol))
+
+    def get(self, external_port, protocol):
+        """查询镜像中的映射，不存在时返回 None"""
+        self.ensure_loaded()
+        with self._lock:
+            return self._mappings.get((int(external_port), protocol.upper()))
+
+    def lookup(self, external_port, protocol):
+        """用 GetSpecificPortMappingEntry 向路由器查询单个端口
+
+        只需一次请求，结果同步到镜像。端口未映射时返回 None。
+        """
+        external_port, protocol = int(external_port), protocol.upper()
+        mapping = parse_specific_entry(external_port, protocol,
+                                       self.upnp.getspecificportmapping(external_port, protocol))
+        self._record((external_port, protocol), mapping)
+        return mapping
+
+    def is_free(self, external_port, protocol):
+        return self.get(external_port, protocol) is None
+
+    def find_free_ports(self, count, near, protocol, port_range=PORT_RANGE, exclude=()):
+        """在镜像中查找 count 个离 near 最近的空闲外部端口，不写路由器
+
+        按 near, near+1, near-1, near+2 ... 的顺序查找，返回可能不足 count 个。
+        """
+        self.ensure_loaded()
+        low, high = port_range
+        protocol = protocol.upper()
+        exclude = set(exclude)
+        with self._lock:
+            used = {port for port, proto in self._mappings if proto == protocol}
+        used |= exclude
+
+        ports = []
+        for distance in range(max(near - low, high - near) + 1):
+            for port in (near + distance, near - distance) if distance else (near,):
+                if low <= port <= high and port not in used:
+                    ports.append(port)
+                    if len(ports) == count:
+                        return ports
+        return ports
+
+    def apply_batch(self, rules, concurrency=BATCH_CONCURRENCY, rollback=False, on_result=None):
+        """并发添加多条映射，返回 (BatchResult 列表, 是否已回滚)
+
+        先用镜像排除与其他地址冲突的规则，不产生请求；on_result(result, done, total)
+        在每条规则完成时从工作线程调用。rollback=True 时任一规则失败即停止
+        提交剩余规则，并删除本批次新建的映射；提交前已存在的相同映射不会被删除。
+        """
+        results = [None] * len(rules)
+        done = [0]
+        failed = threading.Event()
+        lock = threading.Lock()
+
+        def finish(index, error):
+            result = BatchResult(rules[index], error)
+            with lock:
+                results[index] = result
+                done[0] += 1
+                count = done[0]
+            if error is not None:
+                failed.set()
+            if on_result is not None:
+                on_result(result, count, len(rules))
+
+        def apply(index):
+            rule = rules[index]
+            if rollback and failed.is_set():
+                finish(index, "已取消")
+                return
+            try:
+                self.add_learned(rule.external_port, rule.protocol, rule.internal_ip,
+                                 rule.internal_port, rule.description, rule.duration)
+                finish(index, None)
+            except Exception as e:
+                finish(index, str(e))
+
+        pending = []
+        # 提交前镜像中不存在的 (外部端口, 协议)，回滚时只删除这些
+        absent = set()
+        for index, rule in enumerate(rules):
+            existing = self.get(rule.external_port, rule.protocol)
+            if existing is not None and (existing.internal_ip, existing.internal_port) != (rule.internal_ip, rule.internal_port):
+                finish(index, f"端口已被映射到 {existing.internal_ip}:{existing.internal_port}")
+                continue
+            if existing is None:
+                absent.add((rule.external_port, rule.protocol))
+            pending.append(index)
+
+        # miniupnpc 在请求期间释放 GIL，多个线程可以同时等待路由器响应
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(pending)))) as executor:
+            for future in as_completed([executor.submit(apply, index) for index in pending]):
+                future.result()
+
+        rolled_back = False
+        if rollback and failed.is_set():
+            applied = {(result.rule.external_port, result.rule.protocol): result.rule for result in results
+                       if result.error is None and (result.rule.external_port, result.rule.protocol) in absent}
+            applied = list(applied.values())
+            with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(applied)))) as executor:
+                for rule in applied:
+                    executor.submit(self._rollback, rule)
+            rolled_back = True
+        return results, rolled_back
+
+    def _rollback(self, rule):
+        try:
+            self.deleteportmapping(rule.external_port, rule.protocol)
+        except Exception as e:
+            self.log(f"回滚端口映射失败: {rule.protocol} {rule.external_port}: {str(e)}", "WARNING")
+
+    def invalidate(self):
+        """标记镜像过期，读取仍返回旧结果，后台线程会尽快重新遍历"""
+        self._expired = True
+        self._wakeup.set()
+
+    def addportmapping(self, external_port, protocol, internal_ip, internal_port,
+                       description, remote_host='', duration=0):
+        """添加映射；duration 为租期（秒），大于 0 时由 self.leases 在到期前自动续约"""
+        try:
+            result = self.upnp.addportmapping(external_port, protocol, internal_ip, internal_port,
+                                              description, remote_host, *([duration] if duration else []))
+        except Exception as e:
+            if not duration or not _is_upnp_error(e, *_PERMANENT_ONLY_ERROR):
+                raise
+            self.log(f"路由器只支持永久映射，{protocol} {external_port} 不设置租期", "WARNING")
+            duration = 0
+            result = self.upnp.addportmapping(external_port, protocol, internal_ip, internal_port,
+                                              description, remote_host)
+        if result:
+            mapping = PortMapping(int(external_port), protocol.upper(), internal_ip, int(internal_port),
+                                  description, True, remote_host, duration)
+            self._record((mapping.external_port, mapping.protocol), mapping)
+            if duration:
+                self.leases.schedule(mapping)
+            else:
+                self.leases.cancel(mapping.external_port, mapping.protocol)
+        return result
+
+    def attach_profile(self, profile):
+        """换上从设备描述得到的路由器档案；之前在内存中学到的变体写入新档案"""
+        learned = self.profile.variant if self.profile is not None else None
+        self.profile = profile
+        if learned is not None and profile.variant is None:
+            profile.learn(learned)
+
+    def add_learned(self, external_port, protocol, internal_ip, internal_port, description,
+                    duration=0, on_failure=None):
+        """用路由器档案记录的参数变体添加映射，返回成功变体的说明
+
+        先尝试已记录的变体，失败时按顺序尝试其余变体并更新档案；
+        on_failure(说明, 错误) 在每个变体失败时调用。全部失败或端口冲突时抛出异常。
+        """
+        learned = self.profile.variant if self.profile is not None else None
+        first_error = None
+        for name, label, build in sorted(ADD_VARIANTS, key=lambda variant: variant[0] != learned):
+            variant_description, remote_host = build(external_port, description)
+            try:
+                if self.addportmapping(external_port, protocol, internal_ip, internal_port,
+                                       variant_description, remote_host, duration):
+                    if self.profile is not None:
+                        self.profile.learn(name)
+                    return label
+                error = RuntimeError("路由器拒绝了请求")
+            except Exception as e:
+                error = e
+                if _is_upnp_error(e, *_CONFLICT_ERROR):
+                    raise
+            if on_failure is not None:
+                on_failure(label, error)
+            first_error = first_error or error
+        raise first_error
+
+    def deleteportmapping(self, external_port, protocol, remote_host=''):
+        self.leases.cancel(external_port, protocol)
+        result = self.upnp.deleteportmapping(external_port, protocol, *([remote_host] if remote_host else []))
+        if result:
+            self._record((int(external_port), protocol.upper()), None)
+        return result
+
+    def start(self):
+        """启动后台重新验证线程"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, release_leases=False):
+        """停止后台线程和续约；release_leases=True 时删除所有带租期的映射
+
+        返回不再续约的带租期映射，可交给 adopt_leases 继续续约。
+        """
+        self._stop.set()
+        self._wakeup.set()
+        self._thread = None
+        return self.leases.stop(release=release_leases)
+
+    def adopt_leases(self, mappings):
+        """接管另一镜像停止时返回的带租期映射，立即续约一次，之后按租期调度"""
+        for mapping in mappings:
+            self.leases.schedule(mapping, 0)
+
+    def _record(self, key, mapping):
+        """记录一次本地修改，mapping 为 None 表示删除"""
+        with self._lock:
+            self._apply(self._mappings, key, mapping)
+            if self._pending is not None:
+                self._pending.append((key, mapping))
+
+    @staticmethod
+    def _apply(mappings, key, mapping):
+        if mapping is None:
+            mappings.pop(key, None)
+        else:
+            mappings[key] = mapping
+
+    def _run(self):
+        while not self._stop.is_set():
+            failed = False
+            try:
+                with self._refresh_lock:
+                    if self.is_stale():
+                        self.refresh()
+            except Exception as e:
+                failed = True
+                self.log(f"刷新端口映射表失败: {str(e)}", "WARNING")
+            if failed:
+                delay = REFRESH_RETRY
+            elif self._loaded_at is None:
+                delay = self.ttl
+            else:
+                delay = max(0, self._loaded_at + self.ttl - time.monotonic())
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+
+
+class LeaseRenewer:
+    """带租期映射的续约调度器
+
+    所有映射共用一个哈希时间轮和一个线程：添加、取消为 O(1)，每个时间格只处理
+    到期的条目，上千条映射几乎没有开销。续约请求交给小线程池，避免阻塞时间轮。
+    """
+
+    def __init__(self, table, tick=LEASE_TICK, slots=LEASE_SLOTS, log=None):
+        self.table = table
+        self.tick = tick
+        self.log = log or _null_log
+        self._slots = [dict() for _ in range(slots)]
+        # (外部端口, 协议) -> 所在格
+        self._index = {}
+        # 正在续约的条目：(外部端口, 协议) -> 映射；取消或重新安排时移除
+        self._renewing = {}
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+        self._closed = False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._index) + len(self._renewing)
+
+    def schedule(self, mapping, delay=None):
+        """安排在 delay 秒后续约，默认在租期到期前留出余量"""
+        with self._lock:
+            if self._closed:
+                return
+            self._insert(mapping, delay)
+
+    def cancel(self, external_port, protocol):
+        with self._lock:
+            self._remove((int(external_port), protocol.upper()))
+
+    def mappings(self):
+        with self._lock:
+            return self._mappings()
+
+    def stop(self, release=False):
+        """停止续约，返回停止时仍在续约的映射
+
+        release=True 时等待进行中的续约结束，再删除所有带租期的映射；
+        否则不等待，进行中的续约完成后不再安排下一次。
+        """
+        with self._lock:
+            mappings = self._mappings()
+            for slot in self._slots:
+                slot.clear()
+            self._index.clear()
+            self._renewing.clear()
+            self._closed = True
+            self._stop.set()
+            self._thread = None
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=release, cancel_futures=True)
+        if release and mappings:
+            with ThreadPoolExecutor(max_workers=min(BATCH_CONCURRENCY, len(mappings))) as pool:
+                for mapping in mappings:
+                    pool.submit(self.table._rollback, mapping)
+            return []
+        return mappings
+
+    def _insert(self, mapping, delay):
+        if delay is None:
+            delay = mapping.duration - max(LEASE_MIN_MARGIN, mapping.duration * LEASE_MARGIN)
+        ticks = max(1, int(delay / self.tick))
+        key = (mapping.external_port, mapping.protocol)
+        self._remove(key)
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot][key] = [(ticks - 1) // len(self._slots), mapping]
+        self._index[key] = slot
+        if self._thread is None:
+            self._start()
+
+    def _remove(self, key):
+        self._renewing.pop(key, None)
+        slot = self._index.pop(key, None)
+        if slot is not None:
+            self._slots[slot].pop(key, None)
+
+    def _mappings(self):
+        return ([self._slots[slot][key][1] for key, slot in self._index.items()]
+                + list(self._renewing.values()))
+
+    def _start(self):
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY)
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), daemon=True)
+        self._thread.start()
+
+    def _run(self, stop):
+        next_tick = time.monotonic() + self.tick
+        while not stop.wait(max(0, next_tick - time.monotonic())):
+            next_tick += self.tick
+            due = []
+            with self._lock:
+                self._cursor = (self._cursor + 1) % len(self._slots)
+                slot = self._slots[self._cursor]
+                for key, entry in list(slot.items()):
+                    if entry[0] > 0:
+                        entry[0] -= 1
+                    else:
+                        del slot[key]
+                        del self._index[key]
+                        self._renewing[key] = entry[1]
+                        due.append(entry[1])
+                executor = self._executor
+            for mapping in due:
+                if executor is not None:
+                    executor.submit(self._renew, mapping)
+
+    def _renew(self, mapping):
+        key = (mapping.external_port, mapping.protocol)
+        with self._lock:
+            if self._renewing.get(key) is not mapping:
+                return
+        try:
+            renewed = self.table.upnp.addportmapping(mapping.external_port, mapping.protocol,
+                                                     mapping.internal_ip, mapping.internal_port,
+                                                     mapping.description, mapping.remote_host,
+                                                     mapping.duration)
+            error = None if renewed else "路由器拒绝了请求"
+        except Exception as e:
+            renewed, error = False, str(e)
+        with self._lock:
+            current = self._renewing.get(key) is mapping
+            if current:
+                del self._renewing[key]
+                self._insert(mapping, None if renewed else LEASE_RETRY)
+            cancelled = renewed and not current and not self._closed and key not in self._index
+        if cancelled:
+            # 续约期间被取消且映射已从镜像删除：续约请求可能把它重新加了回去
+            with self.table._lock:
+                deleted = key not in self.table._mappings
+            if deleted:
+                self.table._rollback(mapping)
+        elif current and error is not None:
+            self.log(f"端口映射续约失败: {mapping.protocol} {mapping.external_port}: {error}", "WARNING")
@@ -0,0 +1,284 @@
+"""复用 HTTP 连接的 IGD 控制客户端
+
+miniupnpc 的每个调用都新建一条 TCP 连接，发送一个 SOAP 请求后关闭；
+遍历映射表和批量添加时，嵌入式路由器上的握手占了大部分时间。
+UPnPClient 与 miniupnpc.UPnP 的接口一致，可以直接代替 upnp 对象：
+到控制地址的 HTTP/1.1 连接保持打开并在请求间复用，SOAP 信封按动作预先生成，
+每次只填入参数。
+"""
+import functools
+import http.client
+import socket
+import threading
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+import igd
+from port_mapping import (BATCH_CONCURRENCY, EMPTY_LIST_ERRORS, END_OF_TABLE_ERROR, SOAP_TIMEOUT, SoapError,
+                          parse_soap_response)
+
+# 控制服务类型，按优先顺序
+CONTROL_SERVICES = (
+    "urn:schemas-upnp-org:service:WANIPConnection:2",
+    "urn:schemas-upnp-org:service:WANIPConnection:1",
+    "urn:schemas-upnp-org:service:WANPPPConnection:1",
+)
+
+# 复用的连接被路由器关闭时出现的错误，换新连接重试一次
+_STALE_ERRORS = (ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+@functools.lru_cache(maxsize=None)
+def _template(service, action, names):
+    """预先生成的信封片段：(开头, [(开始标签, 结束标签)...], 结尾, 请求头)"""
+    head = ('<?xml version="1.0"?>'
+            '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+            's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+            f'<s:Body><u:{action} xmlns:u="{service}">').encode("utf-8")
+    tags = tuple((f"<{name}>".encode("ascii"), f"</{name}>".encode("ascii")) for name in names)
+    tail = f"</u:{action}></s:Body></s:Envelope>".encode("utf-8")
+    headers = {
+        "Content-Type": 'text/xml; charset="utf-8"',
+        "SOAPAction": f'"{service}#{action}"',
+    }
+    return head, tags, tail, headers
+
+
+def build_envelope(service, action, arguments=()):
+    """按模板填入参数，返回 (信封, 请求头)"""
+    arguments = list(arguments)
+    head, tags, tail, headers = _template(service, action, tuple(name for name, _ in arguments))
+    parts = [head]
+    for (start, end), (_, value) in zip(tags, arguments):
+        parts += (start, escape(str(value)).encode("utf-8"), end)
+    parts.append(tail)
+    return b"".join(parts), headers
+
+
+def parse_control_services(data, root_url):
+    """从根描述中找出 WAN 连接服务，返回 [(服务类型, 控制地址)]，按 CONTROL_SERVICES 排序"""
+    root = ET.fromstring(data)
+    base = root_url
+    for element in root.iter():
+        if _local_name(element.tag) == "URLBase" and (element.text or "").strip():
+            base = element.text.strip()
+    services = []
+    for element in root.iter():
+        if _local_name(element.tag) != "service":
+            continue
+        fields = {_local_name(child.tag): (child.text or "").strip() for child in element}
+        if fields.get("serviceType") in CONTROL_SERVICES and fields.get("controlURL"):
+            services.append((fields["serviceType"], urllib.parse.urljoin(base, fields["controlURL"])))
+    return sorted(services, key=lambda service: CONTROL_SERVICES.index(service[0]))
+
+
+class ConnectionPool:
+    """到一个 host:port 的 keep-alive 连接池
+
+    每个请求独占一条连接，完成后放回；同时进行的请求多于空闲连接时新建连接，
+    最多保留 size 条空闲连接。
+    """
+
+    def __init__(self, host, port, size=BATCH_CONCURRENCY, timeout=SOAP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def post(self, path, body, headers, timeout=None):
+        """发送 POST 请求，返回 (状态码, 响应内容)；timeout 为 None 时使用连接池的设置"""
+        connection, reused = self._acquire()
+        while True:
+            try:
+                self._set_timeout(connection, self.timeout if timeout is None else timeout)
+                connection.request("POST", path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except _STALE_ERRORS:
+                connection.close()
+                if not reused:
+                    raise
+                # 空闲期间被路由器关闭的连接，换新连接重试
+                connection, reused = self._connect(), False
+                continue
+            except http.client.HTTPException as e:
+                connection.close()
+                raise OSError(f"无效的 HTTP 响应: {str(e)}") from e
+            except BaseException:
+                connection.close()
+                raise
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        return response.status, data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _connect(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    @staticmethod
+    def _set_timeout(connection, timeout):
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(), False
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+
+class UPnPClient:
+    """接口与 miniupnpc.UPnP 相同的 IGD 客户端，控制请求复用 HTTP 连接
+
+    添加/删除失败时抛出 SoapError（继承 Exception，消息包含错误码和描述）；
+    遍历到表尾或查询的端口未映射时返回 None，其他错误同样抛出 SoapError。
+    """
+
+    def __init__(self, timeout=SOAP_TIMEOUT, pool_size=BATCH_CONCURRENCY):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        # 与 miniupnpc 兼容的属性；discoverdelay 为发现等待的毫秒数
+        self.discoverdelay = int(igd.DISCOVERY_MAX_WAIT * 1000)
+        self.lanaddr = None
+        self.root_url = None
+        self.control_url = None
+        self.service_type = None
+        self._locations = []
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def discover(self):
+        """SSDP 发现，返回发现的设备数"""
+        self._locations = igd.discover_locations(max_wait=self.discoverdelay / 1000)
+        return len(self._locations)
+
+    def selectigd(self, root_url=None):
+        """选择网关并读取其控制地址；root_url 为空时使用 discover 发现的第一个可用设备"""
+        for location in [root_url] if root_url else self._locations:
+            try:
+                with urllib.request.urlopen(location, timeout=self.timeout) as response:
+                    services = parse_control_services(response.read(), location)
+            except (OSError, ValueError, ET.ParseError):
+                continue
+            if not services:
+                continue
+            self.root_url = location
+            self.service_type, self.control_url = services[0]
+            self.lanaddr = self._local_address()
+            return self.control_url
+        raise RuntimeError("未找到可用的 UPnP 网关")
+
+    def externalipaddress(self):
+        return self._call("GetExternalIPAddress").get("NewExternalIPAddress", "")
+
+    def connectiontype(self):
+        return self._call("GetConnectionTypeInfo").get("NewConnectionType", "")
+
+    def addportmapping(self, external_port, protocol, internal_ip, internal_port,
+                       description, remote_host='', duration=0):
+        self._call("AddPortMapping", [
+            ("NewRemoteHost", remote_host or ""), ("NewExternalPort", external_port),
+            ("NewProtocol", protocol), ("NewInternalPort", internal_port),
+            ("NewInternalClient", internal_ip), ("NewEnabled", 1),
+            ("NewPortMappingDescription", description), ("NewLeaseDuration", duration or 0)])
+        return True
+
+    def deleteportmapping(self, external_port, protocol, remote_host=''):
+        self._call("DeletePortMapping", [
+            ("NewRemoteHost", remote_host or ""), ("NewExternalPort", external_port),
+            ("NewProtocol", protocol)])
+        return True
+
+    def getgenericportmapping(self, index):
+        """返回 (外部端口, 协议, (内部地址, 内部端口), 描述, 启用, 远程主机, 租期)
+
+        超出范围（SpecifiedArrayIndexInvalid）时返回 None，其他错误抛出 SoapError。
+        """
+        try:
+            result = self._call("GetGenericPortMappingEntry", [("NewPortMappingIndex", index)])
+        except SoapError as e:
+            # 其他错误继续抛出，避免遍历把路由器的临时故障当作映射表末尾
+            if e.code == END_OF_TABLE_ERROR:
+                return None
+            raise
+        return (int(result.get("NewExternalPort") or 0), result.get("NewProtocol", ""),
+                (result.get("NewInternalClient", ""), int(result.get("NewInternalPort") or 0)),
+                result.get("NewPortMappingDescription", ""), int(result.get("NewEnabled") or 0),
+                result.get("NewRemoteHost", ""), int(result.get("NewLeaseDuration") or 0))
+
+    def getspecificportmapping(self, external_port, protocol):
+        """返回 (内部地址, 内部端口, 描述, 启用, 租期)，端口未映射时返回 None"""
+        try:
+            result = self._call("GetSpecificPortMappingEntry", [
+                ("NewRemoteHost", ""), ("NewExternalPort", external_port), ("NewProtocol", protocol)])
+        except SoapError as e:
+            # 其他错误继续抛出，避免把查询失败当作端口空闲
+            if e.code in EMPTY_LIST_ERRORS:
+                return None
+            raise
+        return (result.get("NewInternalClient", ""), int(result.get("NewInternalPort") or 0),
+                result.get("NewPortMappingDescription", ""), int(result.get("NewEnabled") or 0),
+                int(result.get("NewLeaseDuration") or 0))
+
+    def soap_call(self, control_url, service, action, arguments=(), timeout=None):
+        """与 port_mapping.soap_call 参数相同，通过连接池发送；timeout 为 None 时使用连接池的设置"""
+        parts = urllib.parse.urlsplit(control_url)
+        body, headers = build_envelope(service, action, arguments)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        status, data = self._pool(parts.hostname, parts.port or 80).post(path, body, headers, timeout)
+        return parse_soap_response(action, status, data)
+
+    def close(self):
+        """关闭所有保持的连接"""
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+    def _call(self, action, arguments=()):
+        if self.control_url is None:
+            raise RuntimeError("尚未选择网关")
+        return self.soap_call(self.control_url, self.service_type, action, arguments)
+
+    def _pool(self, host, port):
+        with self._lock:
+            pool = self._pools.get((host, port))
+            if pool is None:
+                pool = self._pools[(host, port)] = ConnectionPool(host, port, self.pool_size, self.timeout)
+            return pool
+
+    def _local_address(self):
+        """连接网关使用的本机地址"""
+        parts = urllib.parse.urlsplit(self.control_url)
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.connect((parts.hostname, parts.port or 80))
+                return s.getsockname()[0]
+        except OSError:
+            return None
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# 模块位于仓库根目录
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_igd import FakeIGD  # noqa: E402
+
+
+@pytest.fixture
+def fake_igd():
+    igd = FakeIGD()
+    yield igd
+    igd.close()
+
+
+@pytest.fixture
+def gateway_cache(tmp_path, monkeypatch):
+    """网关缓存和路由器档案写到临时目录，SSDP 搜索不发出组播"""
+    import functools
+    import igd
+    path = str(tmp_path / "igd.json")
+    monkeypatch.setattr(igd, "load_cache", functools.partial(igd.load_cache, path=path))
+    monkeypatch.setattr(igd, "save_cache", functools.partial(igd.save_cache, path=path))
+    monkeypatch.setattr(igd.RouterProfile.__init__, "__defaults__", (None, str(tmp_path / "profiles.json")))
+    monkeypatch.setattr(igd, "ssdp_search", lambda *args, **kwargs: [])
+    monkeypatch.setattr(igd, "discover_locations", lambda *args, **kwargs: [])
+    return path
@@ -0,0 +1,158 @@
+"""测试用的本地 IGD：提供根描述和 WANIPConnection 控制接口，映射表保存在内存中"""
+import collections
+import http.server
+import re
+import threading
+from xml.sax.saxutils import escape
+
+SERVICE_V1 = "urn:schemas-upnp-org:service:WANIPConnection:1"
+SERVICE_V2 = "urn:schemas-upnp-org:service:WANIPConnection:2"
+EXTERNAL_IP = "203.0.113.7"
+
+Entry = collections.namedtuple("Entry", "internal_ip internal_port description enabled duration")
+
+
+class FakeIGD:
+    """version=1 时不支持 GetListOfPortMappings；list_cap 为每页最多返回的条目数（模拟截断响应的路由器）"""
+
+    def __init__(self, version=1, list_cap=None):
+        self.version = version
+        self.list_cap = list_cap
+        self.table = {}
+        self.requests = collections.Counter()
+        self._lock = threading.Lock()
+        handler = type("Handler", (_Handler,), {"igd": self})
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def service(self):
+        return SERVICE_V2 if self.version == 2 else SERVICE_V1
+
+    @property
+    def root_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/rootDesc.xml"
+
+    @property
+    def control_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/ctl/IPConn"
+
+    def add(self, external_port, protocol, internal_ip="192.168.1.10", internal_port=None,
+            description="test", enabled=True, duration=0):
+        self.table[(external_port, protocol)] = Entry(internal_ip, internal_port or external_port,
+                                                      description, enabled, duration)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, action, arguments):
+        """返回 (输出参数, None) 或 (None, (错误码, 描述))"""
+        with self._lock:
+            self.requests[action] += 1
+            key = (int(arguments.get("NewExternalPort") or 0), arguments.get("NewProtocol", ""))
+            if action == "GetExternalIPAddress":
+                return {"NewExternalIPAddress": EXTERNAL_IP}, None
+            if action == "GetConnectionTypeInfo":
+                return {"NewConnectionType": "IP_Routed"}, None
+            if action == "AddPortMapping":
+                existing = self.table.get(key)
+                if existing is not None and existing.internal_ip != arguments["NewInternalClient"]:
+                    return None, (718, "ConflictInMappingEntry")
+                self.table[key] = Entry(arguments["NewInternalClient"], int(arguments["NewInternalPort"]),
+                                        arguments["NewPortMappingDescription"],
+                                        arguments["NewEnabled"] == "1", int(arguments["NewLeaseDuration"]))
+                return {}, None
+            if action == "DeletePortMapping":
+                if self.table.pop(key, None) is None:
+                    return None, (714, "NoSuchEntryInArray")
+                return {}, None
+            if action == "GetSpecificPortMappingEntry":
+                entry = self.table.get(key)
+                if entry is None:
+                    return None, (714, "NoSuchEntryInArray")
+                return {"NewInternalPort": entry.internal_port, "NewInternalClient": entry.internal_ip,
+                        "NewEnabled": int(entry.enabled), "NewPortMappingDescription": entry.description,
+                        "NewLeaseDuration": entry.duration}, None
+            if action == "GetGenericPortMappingEntry":
+                items = sorted(self.table.items())
+                index = int(arguments["NewPortMappingIndex"])
+                if index >= len(items):
+                    return None, (713, "SpecifiedArrayIndexInvalid")
+                (port, protocol), entry = items[index]
+                return {"NewRemoteHost": "", "NewExternalPort": port, "NewProtocol": protocol,
+                        "NewInternalPort": entry.internal_port, "NewInternalClient": entry.internal_ip,
+                        "NewEnabled": int(entry.enabled), "NewPortMappingDescription": entry.description,
+                        "NewLeaseDuration": entry.duration}, None
+            if action == "GetListOfPortMappings" and self.version == 2:
+                return {"NewPortListing": self._listing(arguments)}, None
+            return None, (401, "Invalid Action")
+
+    def _listing(self, arguments):
+        start, end = int(arguments["NewStartPort"]), int(arguments["NewEndPort"])
+        count = int(arguments["NewNumberOfPorts"])
+        if self.list_cap is not None:
+            count = min(count, self.list_cap)
+        items = [(port, entry) for (port, protocol), entry in sorted(self.table.items())
+                 if protocol == arguments["NewProtocol"] and start <= port <= end][:count]
+        entries = "".join(
+            "<p:PortMappingEntry>"
+            f"<p:NewRemoteHost></p:NewRemoteHost><p:NewExternalPort>{port}</p:NewExternalPort>"
+            f"<p:NewProtocol>{arguments['NewProtocol']}</p:NewProtocol>"
+            f"<p:NewInternalPort>{entry.internal_port}</p:NewInternalPort>"
+            f"<p:NewInternalClient>{entry.internal_ip}</p:NewInternalClient>"
+            f"<p:NewEnabled>{int(entry.enabled)}</p:NewEnabled>"
+            f"<p:NewDescription>{escape(entry.description)}</p:NewDescription>"
+            f"<p:NewLeaseTime>{entry.duration}</p:NewLeaseTime>"
+            "</p:PortMappingEntry>" for port, entry in items)
+        return ('<?xml version="1.0"?><p:PortMappingList xmlns:p="urn:schemas-upnp-org:gw:WANIPConnection" '
+                f'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">{entries}</p:PortMappingList>')
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    igd = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        igd = self.igd
+        device = f"urn:schemas-upnp-org:device:InternetGatewayDevice:{igd.version}"
+        self._reply(200, (
+            '<?xml version="1.0"?><root xmlns="urn:schemas-upnp-org:device-1-0">'
+            f"<device><deviceType>{device}</deviceType><manufacturer>Test</manufacturer>"
+            "<modelName>FakeIGD</modelName><modelNumber>1</modelNumber><UDN>uuid:fake-igd</UDN>"
+            "<deviceList><device><deviceList><device><serviceList><service>"
+            f"<serviceType>{igd.service}</serviceType><serviceId>urn:upnp-org:serviceId:WANIPConn1</serviceId>"
+            "<controlURL>/ctl/IPConn</controlURL><eventSubURL>/evt/IPConn</eventSubURL>"
+            "<SCPDURL>/WANIPCn.xml</SCPDURL></service></serviceList></device></deviceList>"
+            "</device></deviceList></device></root>"))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+        action = self.headers["SOAPAction"].strip('"').split("#")[1]
+        arguments = dict(re.findall(r"<(New\w+)>(.*?)</\1>", body, re.S))
+        result, error = self.igd.handle(action, arguments)
+        if error is not None:
+            self._reply(500, (
+                '<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+                "<s:Body><s:Fault><faultcode>s:Client</faultcode><faultstring>UPnPError</faultstring>"
+                '<detail><UPnPError xmlns="urn:schemas-upnp-org:control-1-0">'
+                f"<errorCode>{error[0]}</errorCode><errorDescription>{error[1]}</errorDescription>"
+                "</UPnPError></detail></s:Fault></s:Body></s:Envelope>"))
+            return
+        outputs = "".join(f"<{name}>{escape(str(value))}</{name}>" for name, value in result.items())
+        self._reply(200, (
+            '<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+            f'<s:Body><u:{action}Response xmlns:u="{self.igd.service}">{outputs}'
+            f"</u:{action}Response></s:Body></s:Envelope>"))
+
+    def _reply(self, status, body):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", 'text/xml; charset="utf-8"')
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
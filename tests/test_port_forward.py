@@ -0,0 +1,75 @@
+import errno
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+import port_forward
+
+pytestmark = pytest.mark.skipif(not port_forward.SPLICE_AVAILABLE, reason="需要 os.splice")
+
+
+@pytest.fixture
+def echo_server():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            with conn:
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    conn.sendall(data)
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield server.getsockname()
+    server.close()
+
+
+def _failing_splice(fail_on_socket_end):
+    """返回替代 os.splice 的函数：涉及套接字的一端为 fail_on_socket_end（"in"/"out"）时返回 EINVAL"""
+    real_splice = os.splice
+
+    def splice(src, dst, count, *args, **kwargs):
+        fd = src if fail_on_socket_end == "in" else dst
+        if stat.S_ISSOCK(os.fstat(fd).st_mode):
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+        return real_splice(src, dst, count, *args, **kwargs)
+
+    return splice
+
+
+@pytest.mark.parametrize("fail_on", ["in", "out"])
+def test_splice_falls_back_to_copy(echo_server, monkeypatch, fail_on):
+    monkeypatch.setattr(port_forward.os, "splice", _failing_splice(fail_on))
+    loop = port_forward.EventLoop()
+    loop.start()
+    forwarder = port_forward.TcpForwarder(loop, ("127.0.0.1", 0), echo_server, splice=True)
+    forwarder.start()
+    try:
+        payload = os.urandom(200000)
+        with socket.create_connection(forwarder.server_socket.getsockname(), timeout=5) as client:
+            client.sendall(payload)
+            client.shutdown(socket.SHUT_WR)
+            received = b""
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                received += data
+        assert received == payload
+        assert forwarder.splice is False
+        assert forwarder.stats.errors["splice_fallback"] >= 1
+        assert forwarder.stats.errors["relay"] == 0
+    finally:
+        forwarder.close()
+        loop.stop()
@@ -0,0 +1,68 @@
+import pytest
+
+import port_mapping
+import soap_client
+from fake_igd import FakeIGD
+
+
+def _client(igd):
+    client = soap_client.UPnPClient()
+    client.selectigd(igd.root_url)
+    return client
+
+
+def test_parse_generic_entry_disabled_string():
+    # miniupnpc 以字符串返回启用状态
+    entry = (8080, "TCP", ("192.168.1.10", 80), "web", "0", "", 0)
+    assert port_mapping.parse_generic_entry(entry).enabled is False
+    assert port_mapping.parse_generic_entry(entry[:4] + ("1",) + entry[5:]).enabled is True
+
+
+def test_mirror_with_miniupnpc(fake_igd):
+    miniupnpc = pytest.importorskip("miniupnpc")
+    for port in range(5000, 5010):
+        fake_igd.add(port, "TCP")
+    fake_igd.add(6000, "UDP", enabled=False)
+    upnp = miniupnpc.UPnP()
+    control_url = upnp.selectigd(fake_igd.root_url)
+
+    table = port_mapping.MappingTable(upnp, control_url)
+    table.ensure_loaded()
+
+    assert len(table) == 11
+    assert table.bulk_supported is False
+    assert table.get(6000, "UDP").enabled is False
+    assert table.get(5000, "TCP").enabled is True
+    assert table.find_free_ports(1, 5000, "TCP") == [4999]
+
+
+def test_mirror_with_soap_client(fake_igd):
+    fake_igd.add(5000, "TCP")
+    fake_igd.add(5001, "TCP", enabled=False)
+    client = _client(fake_igd)
+
+    table = port_mapping.MappingTable(client, client.control_url)
+    table.ensure_loaded()
+
+    assert [mapping.enabled for mapping in table.mappings()] == [True, False]
+    client.close()
+
+
+def test_bulk_listing_with_capped_pages():
+    # 路由器每页最多返回 100 条，少于请求的 LIST_PAGE_SIZE
+    igd = FakeIGD(version=2, list_cap=100)
+    for port in range(10000, 10601):
+        igd.add(port, "TCP")
+        igd.add(port, "UDP")
+    client = _client(igd)
+    try:
+        table = port_mapping.MappingTable(client, client.control_url)
+        table.ensure_loaded()
+
+        assert table.bulk_supported is True
+        assert len(table) == 1202
+        assert igd.requests["GetGenericPortMappingEntry"] == 0
+        assert not table.is_free(10600, "UDP")
+    finally:
+        client.close()
+        igd.close()
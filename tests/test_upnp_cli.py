@@ -0,0 +1,24 @@
+import igd
+import upnp_cli
+
+
+def test_remove_does_not_walk_the_table(fake_igd, gateway_cache):
+    for port in range(10000, 10300):
+        fake_igd.add(port, "TCP")
+    igd.save_cache({"root_url": fake_igd.root_url, "control_url": fake_igd.control_url})
+
+    assert upnp_cli.main(["--backend", "soap", "remove", "10005"]) == 0
+
+    assert (10005, "TCP") not in fake_igd.table
+    assert fake_igd.requests["GetGenericPortMappingEntry"] == 0
+    assert sum(fake_igd.requests.values()) <= 3
+
+
+def test_list_loads_the_table(fake_igd, gateway_cache, capsys):
+    for port in range(10000, 10010):
+        fake_igd.add(port, "TCP")
+    igd.save_cache({"root_url": fake_igd.root_url, "control_url": fake_igd.control_url})
+
+    assert upnp_cli.main(["--backend", "soap", "list"]) == 0
+
+    assert len(capsys.readouterr().out.splitlines()) == 10
@@ -0,0 +1,29 @@
+import igd
+import upnp_core
+from fake_igd import FakeIGD
+
+
+def test_ssdp_fallback_keeps_user_selected_gateway(fake_igd, gateway_cache, monkeypatch):
+    other = FakeIGD()
+    try:
+        monkeypatch.setattr(igd, "discover_locations", lambda *args, **kwargs: [other.root_url, fake_igd.root_url])
+        igd.save_cache({"root_url": fake_igd.root_url, "control_url": fake_igd.control_url,
+                        "user_selected": True})
+
+        # 刷新设备：不直接连接缓存的网关，重新进行 SSDP 发现
+        connection = upnp_core.discover(use_cache=False, backend="soap")
+
+        assert connection.gateway.root_url == fake_igd.root_url
+        cache = igd.load_cache()
+        assert cache["root_url"] == fake_igd.root_url
+        assert cache["user_selected"] is True
+    finally:
+        other.close()
+
+
+def test_ssdp_fallback_without_user_choice(fake_igd, gateway_cache, monkeypatch):
+    monkeypatch.setattr(igd, "discover_locations", lambda *args, **kwargs: [fake_igd.root_url])
+
+    upnp_core.discover(use_cache=False, backend="soap")
+
+    assert igd.load_cache()["user_selected"] is False
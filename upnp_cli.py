@@ -0,0 +1,210 @@
+"""UPnP 端口映射命令行工具
+
+不导入 tkinter，可在无图形界面的网关上运行，也适合 cron / systemd 调用。
+各子命令只导入自己用到的模块，冷启动开销接近解释器本身。
+
+用法:
+    python upnp_cli.py list
+    python upnp_cli.py add 8080 --ip 192.168.1.10 --internal-port 80
+    python upnp_cli.py remove 8080
+    python upnp_cli.py import rules.csv --rollback
+    python upnp_cli.py forward 8080 192.168.1.10 80
+    python upnp_cli.py scan
+"""
+import argparse
+import sys
+
+
+def make_log(verbose):
+    """日志输出到标准错误；默认只输出警告和错误"""
+    def log(message, level="INFO"):
+        if verbose or level in ("WARNING", "ERROR"):
+            print(f"[{level}] {message}", file=sys.stderr, flush=True)
+    return log
+
+
+def connect(args, log):
+    """连接网关；不预先读取设备描述和映射表，需要映射表的子命令在使用时才读取"""
+    import upnp_core
+    connection = upnp_core.discover(not args.no_cache, args.policy, log=log, backend=args.backend,
+                                    eager=False)
+    log(f"外网IP地址: {connection.external_ip}", "SUCCESS")
+    return connection
+
+
+def cmd_list(args, log):
+    connection = connect(args, log)
+    mappings = connection.mapping_table.mappings()
+    if args.json:
+        import json
+        print(json.dumps([mapping._asdict() for mapping in mappings], ensure_ascii=False, indent=2))
+        return 0
+    for mapping in mappings:
+        lease = f" 租期{mapping.duration}s" if mapping.duration else ""
+        print(f"{mapping.protocol:<4} {mapping.external_port:>5} -> {mapping.internal_ip}:{mapping.internal_port}"
+              f"  {mapping.description}{lease}")
+    return 0
+
+
+def cmd_add(args, log):
+    import port_mapping
+    import upnp_core
+    internal_ip = args.ip or upnp_core.local_ips()[0]
+    internal_port = args.internal_port or args.external_port
+    description = args.description or port_mapping.DEFAULT_DESCRIPTION
+    connection = connect(args, log)
+    table = connection.mapping_table
+    # 按路由器档案先尝试它接受的参数变体；根描述地址未知时不为此进行 SSDP 查找
+    upnp_core.load_profile(connection.gateway, table, log, search=False)
+    existing = table.lookup(args.external_port, args.protocol)
+    if existing is not None and (existing.internal_ip, existing.internal_port) != (internal_ip, internal_port):
+        free_ports = table.find_free_ports(5, args.external_port, args.protocol)
+        log(f"端口 {args.external_port} 已被映射到: {existing.internal_ip}:{existing.internal_port}", "ERROR")
+        if free_ports:
+            log(f"附近可用的端口: {', '.join(map(str, free_ports))}", "INFO")
+        return 1
+    table.add_learned(args.external_port, args.protocol, internal_ip, internal_port, description,
+                      args.lease, on_failure=lambda label, e: log(f"{label}失败: {str(e)}", "WARNING"))
+    print(f"{args.protocol} {args.external_port} -> {internal_ip}:{internal_port}")
+    return 0
+
+
+def cmd_remove(args, log):
+    connection = connect(args, log)
+    if not connection.mapping_table.deleteportmapping(args.external_port, args.protocol):
+        log(f"端口映射删除失败: {args.protocol} {args.external_port}", "ERROR")
+        return 1
+    return 0
+
+
+def cmd_import(args, log):
+    import port_mapping
+    import upnp_core
+    rules = port_mapping.load_rules(args.file)
+    connection = connect(args, log)
+    upnp_core.load_profile(connection.gateway, connection.mapping_table, log, search=False)
+
+    def on_result(result, done, total):
+        rule = result.rule
+        status = "OK" if result.error is None else f"失败: {result.error}"
+        print(f"[{done}/{total}] {rule.protocol} {rule.external_port} -> "
+              f"{rule.internal_ip}:{rule.internal_port} {status}", flush=True)
+
+    results, rolled_back = connection.mapping_table.apply_batch(
+        rules, concurrency=args.concurrency, rollback=args.rollback, on_result=on_result)
+    failed = sum(1 for result in results if result.error is not None)
+    if rolled_back:
+        log(f"{failed} 条规则失败，已回滚本次添加的映射", "ERROR")
+    return 1 if failed else 0
+
+
+def cmd_forward(args, log):
+    import signal
+    import threading
+    import port_forward
+    import upnp_core
+
+    listen_ip = args.listen_ip or upnp_core.local_ips()[0]
+    connection = None if args.no_upnp else connect(args, log)
+    service = port_forward.ForwardService(upnp=connection and connection.mapping_table, log=log)
+    rule = port_forward.ForwardRule(args.protocol, listen_ip, args.external_port, args.target_ip,
+                                    args.internal_port or args.external_port, splice=args.splice)
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+    try:
+        service.add_rule(rule)
+        log(f"端口转发已启动: {rule}", "SUCCESS")
+        if connection is not None:
+            log(f"外部访问地址: {connection.external_ip}:{args.external_port}", "SUCCESS")
+        stop.wait()
+    finally:
+        # 停止转发并删除其端口映射
+        service.stop()
+        if connection is not None:
+            connection.mapping_table.stop(release_leases=True)
+    return 0
+
+
+def cmd_scan(args, log):
+    import net_scan
+    results = net_scan.scan_interfaces(
+        max_hosts=args.max_hosts or net_scan.DEFAULT_MAX_HOSTS,
+        on_alive=lambda result: log(f"发现活跃设备: {result.ip} ({result.method})", "SUCCESS"))
+    if args.json:
+        import json
+        print(json.dumps([result._asdict() for result in results], indent=2))
+        return 0
+    for result in results:
+        latency = f"{result.latency * 1000:.1f}ms" if result.latency is not None else "-"
+        print(f"{result.ip:<15} {result.method:<4} {latency}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="UPnP 端口映射命令行工具")
+    parser.add_argument("-v", "--verbose", action="store_true", help="输出详细日志")
+    parser.add_argument("--no-cache", action="store_true", help="忽略保存的网关，重新进行 SSDP 发现")
+    parser.add_argument("--policy", choices=("fastest", "public"), default="fastest",
+                        help="发现多个网关时的选择策略")
+    parser.add_argument("--backend", choices=("miniupnpc", "soap"), default="miniupnpc",
+                        help="控制请求后端；soap 复用到路由器的 HTTP 连接，不需要 miniupnpc")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_protocol(command):
+        command.add_argument("-p", "--protocol", type=str.upper, choices=("TCP", "UDP"), default="TCP")
+
+    command = commands.add_parser("list", help="列出路由器上的端口映射")
+    command.add_argument("--json", action="store_true", help="以 JSON 格式输出")
+    command.set_defaults(func=cmd_list)
+
+    command = commands.add_parser("add", help="添加端口映射")
+    command.add_argument("external_port", type=int)
+    add_protocol(command)
+    command.add_argument("--ip", help="目标IP（默认本机）")
+    command.add_argument("--internal-port", type=int, help="目标端口（默认与外部端口相同）")
+    command.add_argument("-d", "--description", help="映射描述")
+    command.add_argument("--lease", type=int, default=0, help="租期（秒），0 表示永久")
+    command.set_defaults(func=cmd_add)
+
+    command = commands.add_parser("remove", help="删除端口映射")
+    command.add_argument("external_port", type=int)
+    add_protocol(command)
+    command.set_defaults(func=cmd_remove)
+
+    command = commands.add_parser("import", help="从 CSV/JSON 文件批量添加端口映射")
+    command.add_argument("file")
+    command.add_argument("--rollback", action="store_true", help="任一规则失败时回滚本次已添加的映射")
+    command.add_argument("--concurrency", type=int, default=8, help="同时进行的请求数")
+    command.set_defaults(func=cmd_import)
+
+    command = commands.add_parser("forward", help="映射到本机并转发到目标设备，直到收到 SIGINT/SIGTERM")
+    command.add_argument("external_port", type=int)
+    command.add_argument("target_ip")
+    command.add_argument("internal_port", type=int, nargs="?")
+    add_protocol(command)
+    command.add_argument("--listen-ip", help="本机监听地址（默认本机IP）")
+    command.add_argument("--splice", action="store_true", help="使用零拷贝转发（仅 Linux）")
+    command.add_argument("--no-upnp", action="store_true", help="只转发，不添加端口映射")
+    command.set_defaults(func=cmd_forward)
+
+    command = commands.add_parser("scan", help="扫描局域网中的活跃设备")
+    command.add_argument("--max-hosts", type=int, help="最多探测的主机数（默认 4096）")
+    command.add_argument("--json", action="store_true", help="以 JSON 格式输出")
+    command.set_defaults(func=cmd_scan)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    log = make_log(args.verbose)
+    try:
+        return args.func(args, log)
+    except Exception as e:
+        log(str(e), "ERROR")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""不依赖界面的核心操作：发现并连接网关
+
+图形界面和命令行共用这里的流程；本模块及其依赖都不导入 tkinter。
+日志通过 log(message, level) 回调输出。
+"""
+import collections
+import socket
+
+import igd
+import port_mapping
+import soap_client
+
+try:
+    import miniupnpc
+    UPNPC_AVAILABLE = True
+except ImportError:
+    UPNPC_AVAILABLE = False
+
+# 控制请求后端：miniupnpc，或复用 HTTP 连接的 soap_client.UPnPClient
+BACKENDS = ("miniupnpc", "soap")
+
+# 已连接的网关：miniupnpc 对象、映射表镜像、外网IP、当前网关及发现的所有网关（igd.Gateway）
+Connection = collections.namedtuple("Connection", "upnp mapping_table external_ip gateway gateways")
+
+
+def _null_log(message, level="INFO"):
+    pass
+
+
+def local_ips():
+    """获取本机IP地址列表"""
+    ips = []
+    try:
+        # 获取本机IP
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            ips.append(s.getsockname()[0])
+    except OSError:
+        pass
+
+    # 添加其他可能的IP
+    try:
+        for ip in socket.gethostbyname_ex(socket.gethostname())[2]:
+            if not ip.startswith("127.") and ip not in ips:
+                ips.append(ip)
+    except OSError:
+        pass
+
+    return ips or ["127.0.0.1"]
+
+
+def discover(use_cache=True, policy="fastest", log=None, on_ready=None, backend="miniupnpc",
+             eager=True):
+    """发现并连接网关，返回 Connection；未发现设备时抛出 RuntimeError
+
+    use_cache 为 True 时先直接连接上次保存的网关，无响应才进行 SSDP 发现。
+    发现多个网关时按 policy（见 igd.POLICIES）选择，用户明确选择过的网关优先。
+    backend 见 BACKENDS；eager 见 connect_gateway。
+    """
+    log = log or _null_log
+    if backend == "soap":
+        factory = soap_client.UPnPClient
+    elif not UPNPC_AVAILABLE:
+        raise RuntimeError("miniupnpc库未安装，请运行: pip install miniupnpc")
+    else:
+        factory = miniupnpc.UPnP
+
+    cache = igd.load_cache()
+    if use_cache and cache:
+        upnp = factory()
+        connected = igd.connect_cached(upnp, cache)
+        if connected:
+            control_url, external_ip = connected
+            log(f"已直接连接缓存的网关: {cache['root_url']}", "INFO")
+            gateway = igd.Gateway(cache["root_url"], control_url, external_ip, None, upnp)
+            return connect_gateway(gateway, [gateway], cache, log=log, on_ready=on_ready, eager=eager)
+        log("缓存的网关无响应，重新发现设备", "WARNING")
+
+    # 收集所有响应的网关并测量往返时间
+    gateways = igd.probe_gateways(factory, igd.discover_locations())
+    for gateway in gateways:
+        log(f"发现网关: {gateway.root_url} (外网IP {gateway.external_ip}, "
+            f"往返 {gateway.rtt * 1000:.1f}ms)", "INFO")
+
+    preferred = cache.get("root_url") if cache and cache.get("user_selected") else None
+    if gateways:
+        gateway = igd.select_gateway(gateways, policy, preferred)
+    else:
+        # 组播搜索没有结果时退回 miniupnpc 自带的发现流程
+        upnp = factory()
+        upnp.discoverdelay = 200
+        if upnp.discover() == 0:
+            raise RuntimeError("未发现任何UPnP设备")
+        control_url = upnp.selectigd()
+        gateway = igd.Gateway(None, control_url, upnp.externalipaddress(), None, upnp)
+        gateways = [gateway]
+
+    # 重新发现后仍连接到用户选择过的网关时保留这一选择
+    return connect_gateway(gateway, gateways, user_selected=bool(preferred and gateway.root_url == preferred),
+                           log=log, on_ready=on_ready, eager=eager)
+
+
+def connect_gateway(gateway, gateways, cache=None, user_selected=False, log=None, on_ready=None,
+                    eager=True):
+    """使用选定的网关：读取映射表并保存网关信息，返回 Connection
+
+    cache 为直接连接时使用的缓存内容，其中保存的功能检测结果会被复用。
+    on_ready(connection) 在连接可用后立即调用，之后才在本线程中读取设备描述、映射表并保存网关信息；
+    需要映射表的调用方通过 mapping_table.ensure_loaded() 等待首次读取完成。
+    eager 为 False 时不读取设备描述和映射表（映射表在第一次使用时读取），
+    适合只做一两个操作的命令行调用。
+    """
+    log = log or _null_log
+    upnp = gateway.upnp
+    # 设备描述在界面可用后才读取，此前学到的参数变体先记在内存中
+    mapping_table = port_mapping.MappingTable(upnp, gateway.control_url, log=log,
+                                              profile=igd.RouterProfile())
+    if cache and cache.get("bulk_list") is not None:
+        mapping_table.bulk_supported = cache["bulk_list"]
+
+    connection = Connection(upnp, mapping_table, gateway.external_ip, gateway, gateways)
+    if on_ready is not None:
+        on_ready(connection)
+
+    if eager:
+        # 以下在界面可用后进行：读取设备描述和路由器档案、检查UPnP功能支持并首次读取映射表
+        root_url = load_profile(gateway, mapping_table, log)
+        check_capabilities(upnp, mapping_table, log)
+    else:
+        root_url = gateway.root_url
+
+    # 保存网关信息，下次启动直接连接；不读取映射表时直接连接缓存的网关没有新信息，不再保存
+    try:
+        if root_url and (eager or cache is None):
+            igd.save_cache({
+                "root_url": root_url,
+                "control_url": gateway.control_url,
+                "lan_addr": getattr(upnp, 'lanaddr', None),
+                "external_ip": gateway.external_ip,
+                "connection_type": query_connection_type(upnp),
+                "bulk_list": mapping_table.bulk_supported,
+                "user_selected": user_selected or bool(cache and cache.get("user_selected")),
+            })
+    except OSError as e:
+        log(f"保存网关信息失败: {str(e)}", "WARNING")
+    return connection
+
+
+def load_profile(gateway, mapping_table, log=None, search=True):
+    """读取设备描述，给映射表换上该路由器的档案，返回根描述地址（未知时为 None）
+
+    search 为 False 时根描述地址未知也不进行 SSDP 查找。
+    """
+    log = log or _null_log
+    root_url = gateway.root_url
+    if root_url is None and search:
+        root_url = igd.find_root_url(gateway.control_url)
+    if root_url is None:
+        return None
+    profile = igd.RouterProfile(igd.fetch_identity(root_url))
+    if profile.reset:
+        log("路由器型号或固件已变化，重新学习端口映射参数", "INFO")
+    mapping_table.attach_profile(profile)
+    return root_url
+
+
+def query_connection_type(upnp):
+    try:
+        return upnp.connectiontype()
+    except Exception:
+        return None
+
+
+def check_capabilities(upnp, mapping_table, log=None):
+    """检查UPnP功能支持"""
+    log = log or _null_log
+    try:
+        # 检查路由器型号信息
+        if hasattr(upnp, 'lanaddr'):
+            log(f"路由器LAN地址: {upnp.lanaddr}", "INFO")
+        if hasattr(upnp, 'wanaddr'):
+            log(f"路由器WAN地址: {upnp.wanaddr}", "INFO")
+
+        # 读取一次端口映射表，之后由镜像提供
+        try:
+            mapping_table.ensure_loaded()
+            log(f"当前已有 {len(mapping_table)} 个端口映射", "INFO")
+        except Exception:
+            log("无法获取现有端口映射信息", "WARNING")
+
+        log("路由器UPnP功能检查完成", "SUCCESS")
+
+    except Exception as e:
+        log(f"UPnP功能检查失败: {str(e)}", "WARNING")
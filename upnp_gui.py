@@ -1,15 +1,76 @@
+import sys
+
+# 带参数运行时作为命令行工具，不导入 tkinter
+if __name__ == "__main__" and len(sys.argv) > 1:
+    import upnp_cli
+    sys.exit(upnp_cli.main())
+
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
+from tkinter import ttk, messagebox, scrolledtext, filedialog
 import socket
 import threading
 import queue
 import re
+import urllib.parse
+
+import net_scan
+import port_forward
+import port_mapping
+import upnp_core
+from upnp_core import UPNPC_AVAILABLE
 
-try:
-    import miniupnpc
-    UPNPC_AVAILABLE = True
-except ImportError:
-    UPNPC_AVAILABLE = False
+# 每次唤醒最多处理的消息数，其余的在界面响应输入和重绘后继续处理
+QUEUE_BATCH = 200
+
+class TkMessageQueue(queue.Queue):
+    """放入消息时唤醒 Tk 事件循环的消息队列
+
+    put 只把消息放入队列、设置标志，不调用 Tcl，不会阻塞放入消息的线程；
+    唤醒事件由专门的线程发出，事件被处理前不再重复发送，一批消息只产生一个事件。
+    空闲时不占用 CPU。
+    """
+    EVENT = "<<MessagesPosted>>"
+    
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+        # 已请求唤醒、尚未开始处理；事件循环启动前为 True，由第一次处理清除
+        self._signalled = True
+        self._closed = False
+        self._signal_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        threading.Thread(target=self._wake_loop, daemon=True).start()
+    
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        with self._signal_lock:
+            if self._signalled or self._closed:
+                return
+            self._signalled = True
+        self._wakeup.set()
+    
+    def acknowledge(self):
+        """开始处理消息前调用，之后放入的消息会再次唤醒事件循环"""
+        with self._signal_lock:
+            self._signalled = False
+    
+    def close(self):
+        """窗口关闭时调用，之后不再唤醒事件循环"""
+        self._closed = True
+        self._wakeup.set()
+    
+    def _wake_loop(self):
+        # 跨线程的 Tcl 调用要等界面线程处理，只在这个线程中进行
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._closed:
+                return
+            try:
+                self.root.event_generate(self.EVENT, when="tail")
+            except (tk.TclError, RuntimeError):
+                # 窗口已关闭
+                return
 
 class UPNPGui:
     def __init__(self, root):
@@ -28,14 +89,46 @@ class UPNPGui:
         self.upnp = None
         self.external_ip = None
         
-        # 消息队列用于线程间通信
-        self.message_queue = queue.Queue()
+        # 发现的网关列表（igd.Gateway）和多个网关时的选择策略，见 igd.POLICIES
+        self.gateways = []
+        self.gateway_policy = "fastest"
+        
+        # 路由器端口映射表的本地镜像，读操作不再逐条遍历路由器
+        self.mapping_table = None
+        # 刷新设备期间被替换的镜像，继续为带租期的映射续约，直到新镜像接管
+        self.retired_table = None
+        
+        # 消息队列用于线程间通信，放入消息时唤醒界面线程
+        self.message_queue = TkMessageQueue(self.root)
+        self.root.bind(TkMessageQueue.EVENT, self.process_queue)
+        
+        # 网络扫描每种探测方式同时进行的探测数，None 表示使用各方式的默认值
+        self.scan_concurrency = None
+        
+        # 网络扫描最多探测的主机数（所有网卡合计）
+        self.scan_max_hosts = net_scan.DEFAULT_MAX_HOSTS
+        
+        # 正在进行的网络扫描的取消标志，没有扫描时为 None
+        self.scan_cancel = None
+        
+        # 已发现主机的缓存，后台从邻居表刷新，地址变化时通知界面线程
+        self.host_cache = net_scan.HostCache(
+            on_change=lambda: self.message_queue.put(("HOSTS_CHANGED", None)))
+        
+        # 端口转发服务，所有转发规则共用一个事件循环
+        self.forward_service = port_forward.ForwardService(log=self.log_message)
         
         # 创建界面
         self.create_widgets()
         
-        # 启动消息处理
-        self.process_queue()
+        # 事件循环启动后处理在此之前放入的消息
+        self.root.after_idle(self.process_queue)
+        
+        # 启动主机缓存的后台刷新
+        self.host_cache.start()
+        
+        # 关闭窗口时清理转发
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
         # 自动发现设备
         self.discover_devices_async()
@@ -75,6 +168,9 @@ class UPNPGui:
         # 左侧控制面板
         self.create_control_panel(left_frame)
         
+        # 右侧转发监控面板
+        self.create_forward_panel(right_frame)
+        
         # 右侧信息面板
         self.create_info_panel(right_frame)
     
@@ -101,6 +197,14 @@ class UPNPGui:
                                         font=('Arial', 9), bg='#f0f0f0', fg='#27ae60')
         self.external_ip_label.pack(anchor='w')
         
+        # 网关列表，发现多个网关时可以切换
+        gateway_frame = tk.Frame(device_frame, bg='#f0f0f0')
+        gateway_frame.pack(fill='x', pady=(5, 0))
+        tk.Label(gateway_frame, text="网关:", font=('Arial', 9), bg='#f0f0f0').pack(side='left')
+        self.gateway_combo = ttk.Combobox(gateway_frame, state='readonly', font=('Arial', 9))
+        self.gateway_combo.pack(side='left', fill='x', expand=True, padx=(5, 0))
+        self.gateway_combo.bind('<<ComboboxSelected>>', self.on_gateway_selected)
+        
         # 分隔线
         tk.Frame(control_frame, height=2, bg='#bdc3c7').pack(fill='x', padx=10, pady=10)
         
@@ -174,6 +278,28 @@ class UPNPGui:
                                         width=20, font=('Arial', 10))
         self.description_entry.pack(side='right')
         
+        # 租期，0 表示永久映射；大于 0 时到期前自动续约，退出时删除
+        lease_frame = tk.Frame(config_frame, bg='#f0f0f0')
+        lease_frame.pack(fill='x', pady=5)
+        
+        tk.Label(lease_frame, text="租期(秒):", bg='#f0f0f0').pack(side='left')
+        self.lease_var = tk.StringVar(value="0")
+        self.lease_entry = tk.Entry(lease_frame, textvariable=self.lease_var,
+                                  width=20, font=('Arial', 10))
+        self.lease_entry.pack(side='right')
+        
+        # 零拷贝转发（仅Linux）
+        splice_frame = tk.Frame(config_frame, bg='#f0f0f0')
+        splice_frame.pack(fill='x', pady=5)
+        
+        # 默认关闭：零拷贝模式不经过缓冲池，不受转发内存上限约束
+        self.splice_var = tk.BooleanVar(value=False)
+        self.splice_check = tk.Checkbutton(splice_frame, text="端口转发使用零拷贝(splice)",
+                                         variable=self.splice_var, bg='#f0f0f0')
+        if not port_forward.SPLICE_AVAILABLE:
+            self.splice_check.config(state='disabled')
+        self.splice_check.pack(side='left')
+        
         # 按钮区域 - 第一行
         button_frame1 = tk.Frame(control_frame, bg='#f0f0f0')
         button_frame1.pack(fill='x', padx=10, pady=(20, 5))
@@ -246,9 +372,112 @@ class UPNPGui:
                                       relief='flat', padx=15, pady=6)
         self.forward_button.pack(side='left')
         
+        # 按钮区域 - 第三行
+        button_frame3 = tk.Frame(control_frame, bg='#f0f0f0')
+        button_frame3.pack(fill='x', padx=10, pady=(0, 10))
+        
+        # 查看转发按钮
+        self.view_forward_button = tk.Button(button_frame3, text="查看转发", 
+                                           command=self.view_forwards,
+                                           bg='#2980b9', fg='white', 
+                                           font=('Arial', 9, 'bold'),
+                                           relief='flat', padx=15, pady=6)
+        self.view_forward_button.pack(side='left', padx=(0, 5))
+        
+        # 停止转发按钮
+        self.stop_forward_button = tk.Button(button_frame3, text="停止转发", 
+                                           command=self.stop_port_forward,
+                                           bg='#c0392b', fg='white', 
+                                           font=('Arial', 9, 'bold'),
+                                           relief='flat', padx=15, pady=6)
+        self.stop_forward_button.pack(side='left', padx=(0, 5))
+        
+        # 批量导入按钮
+        self.import_button = tk.Button(button_frame3, text="批量导入", 
+                                     command=self.import_mappings,
+                                     bg='#27ae60', fg='white', 
+                                     font=('Arial', 9, 'bold'),
+                                     relief='flat', padx=15, pady=6)
+        self.import_button.pack(side='left')
+        
+        # 扫描进度区域
+        scan_frame = tk.Frame(control_frame, bg='#f0f0f0')
+        scan_frame.pack(fill='x', padx=10, pady=(0, 10))
+        
+        self.scan_progress = ttk.Progressbar(scan_frame, mode='determinate', maximum=100)
+        self.scan_progress.pack(side='left', fill='x', expand=True, padx=(0, 5))
+        
+        # 取消扫描按钮，仅在扫描进行时可用
+        self.cancel_scan_button = tk.Button(scan_frame, text="取消扫描", 
+                                          command=self.cancel_scan,
+                                          bg='#7f8c8d', fg='white', 
+                                          font=('Arial', 9, 'bold'),
+                                          relief='flat', padx=15, pady=6,
+                                          state='disabled')
+        self.cancel_scan_button.pack(side='left')
+        
         # 初始状态
         self.update_button_states()
     
+    def create_forward_panel(self, parent):
+        # 转发监控框架
+        monitor_frame = tk.LabelFrame(parent, text="转发监控", 
+                                    font=('Arial', 12, 'bold'),
+                                    bg='#f0f0f0', fg='#2c3e50',
+                                    relief='groove', bd=2)
+        monitor_frame.pack(side='bottom', fill='x', padx=(5, 0), pady=(5, 0))
+        
+        columns = ("rule", "active", "accept_rate", "up", "down", "latency", "errors")
+        headings = ("转发规则", "连接", "接入/秒", "上行", "下行", "连接延迟 p50/p99", "错误")
+        widths = (220, 50, 60, 110, 110, 120, 60)
+        self.forward_tree = ttk.Treeview(monitor_frame, columns=columns, show='headings', height=4)
+        for column, heading, width in zip(columns, headings, widths):
+            self.forward_tree.heading(column, text=heading)
+            self.forward_tree.column(column, width=width, anchor='w' if column == "rule" else 'e')
+        self.forward_tree.pack(fill='x', padx=10, pady=10)
+        
+        # 统计刷新任务
+        self.stats_job = None
+    
+    def format_bytes(self, count):
+        """格式化字节数"""
+        for unit in ("B", "KB", "MB", "GB"):
+            if count < 1024:
+                return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+            count /= 1024
+        return f"{count:.1f} TB"
+    
+    def schedule_forward_stats(self):
+        """有转发规则时开始定期刷新监控面板"""
+        if self.stats_job is None:
+            self.refresh_forward_stats()
+    
+    def refresh_forward_stats(self):
+        """请求统计快照，结果由 FORWARD_STATS 消息送回；没有转发规则时停止刷新
+
+        不等待转发线程，快照为空或迟到都不影响下一次刷新。
+        """
+        self.stats_job = None
+        self.forward_service.request_stats(lambda stats: self.message_queue.put(("FORWARD_STATS", stats)))
+        if self.forward_service.list_rules():
+            self.stats_job = self.root.after(1000, self.refresh_forward_stats)
+    
+    def show_forward_stats(self, stats):
+        """用统计快照刷新转发监控面板"""
+        self.forward_tree.delete(*self.forward_tree.get_children())
+        for rule, snapshot in stats:
+            p50, p99 = snapshot["connect_p50"], snapshot["connect_p99"]
+            latency = f"{p50:.1f}/{p99:.1f} ms" if p50 is not None else "-"
+            self.forward_tree.insert('', 'end', values=(
+                str(rule),
+                snapshot["active"],
+                f"{snapshot['accept_rate']:.1f}",
+                f"{self.format_bytes(snapshot['bytes_up'])} ({self.format_bytes(snapshot['up_rate'])}/s)",
+                f"{self.format_bytes(snapshot['bytes_down'])} ({self.format_bytes(snapshot['down_rate'])}/s)",
+                latency,
+                sum(snapshot["errors"].values()),
+            ))
+    
     def create_info_panel(self, parent):
         # 信息面板框架
         info_frame = tk.LabelFrame(parent, text="操作日志", 
@@ -303,9 +532,13 @@ class UPNPGui:
         self.log_message("7. 点击'检查端口'可以检查端口是否可用", "INFO")
         self.log_message("8. 点击'端口转发'可以绕过路由器限制，实现转发", "INFO")
         self.log_message("9. 如果添加映射失败，程序会自动尝试多种参数组合", "INFO")
+        self.log_message("10. 点击'查看转发'/'停止转发'可以管理运行中的端口转发", "INFO")
     
     def log_message(self, message, level="INFO"):
-        """添加日志消息"""
+        """添加日志消息，可以在任意线程调用"""
+        if threading.current_thread() is not threading.main_thread():
+            self.message_queue.put(("LOG", (message, level)))
+            return
         import datetime
         timestamp = datetime.datetime.now().strftime("%H:%M:%S")
         
@@ -333,52 +566,12 @@ class UPNPGui:
     
     def get_local_ips(self):
         """获取本机IP地址列表"""
-        ips = []
-        try:
-            # 获取本机IP
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                s.connect(("8.8.8.8", 80))
-                local_ip = s.getsockname()[0]
-                ips.append(local_ip)
-        except:
-            pass
-        
-        # 添加其他可能的IP
-        try:
-            hostname = socket.gethostname()
-            local_ips = socket.gethostbyname_ex(hostname)[2]
-            for ip in local_ips:
-                if not ip.startswith("127.") and ip not in ips:
-                    ips.append(ip)
-        except:
-            pass
-        
-        if not ips:
-            ips = ["127.0.0.1"]
-        
-        return ips
+        return upnp_core.local_ips()
     
     def get_network_ips(self):
-        """扫描网络中的其他设备IP"""
-        network_ips = []
-        local_ips = self.get_local_ips()
-        
-        if not local_ips:
-            return network_ips
-        
-        # 获取网络段
-        local_ip = local_ips[0]
-        if '.' in local_ip:
-            ip_parts = local_ip.split('.')
-            network_base = '.'.join(ip_parts[:3])
-            
-            # 扫描网络段中的其他IP（1-254）
-            for i in range(1, 255):
-                test_ip = f"{network_base}.{i}"
-                if test_ip != local_ip:
-                    network_ips.append(test_ip)
-        
-        return network_ips
+        """列出缓存中已发现的网络设备IP"""
+        local_ips = set(self.get_local_ips())
+        return [ip for ip in self.host_cache.ips() if ip not in local_ips]
     
     def update_ip_options(self):
         """更新IP选项"""
@@ -392,7 +585,7 @@ class UPNPGui:
         else:  # 自定义IP
             # 获取网络中的其他IP
             network_ips = self.get_network_ips()
-            all_ips = ["127.0.0.1"] + local_ips + network_ips[:10]  # 限制显示数量
+            all_ips = ["127.0.0.1"] + local_ips + network_ips
             self.internal_ip_combo['values'] = all_ips
             self.internal_ip_combo.config(state='normal')
             if local_ips:
@@ -407,76 +600,52 @@ class UPNPGui:
         else:
             self.log_message("已切换到自定义IP模式，可以输入任意网络IP")
     
-    def discover_devices_async(self):
-        """异步发现UPnP设备"""
+    def discover_devices_async(self, use_cache=True):
+        """异步发现UPnP设备
+
+        use_cache 为 True 时先直接连接上次保存的网关，无响应才进行 SSDP 发现。
+        发现多个网关时按 self.gateway_policy 选择，用户可在网关列表中切换。
+        """
         def discover():
             self.message_queue.put(("DISCOVER_START", None))
             
-            if not UPNPC_AVAILABLE:
-                self.message_queue.put(("DISCOVER_ERROR", "miniupnpc库未安装，请运行: pip install miniupnpc"))
-                return
-            
             try:
-                upnp = miniupnpc.UPnP()
-                upnp.discoverdelay = 200
-                
-                devices = upnp.discover()
-                
-                if devices == 0:
-                    self.message_queue.put(("DISCOVER_ERROR", "未发现任何UPnP设备"))
-                    return
-                
-                upnp.selectigd()
-                external_ip = upnp.externalipaddress()
-                
-                # 检查UPnP功能支持
-                self.check_upnp_capabilities(upnp)
-                
-                self.message_queue.put(("DISCOVER_SUCCESS", (upnp, external_ip, devices)))
-                
+                upnp_core.discover(use_cache, self.gateway_policy, log=self.log_message,
+                                   on_ready=lambda c: self.message_queue.put(("DISCOVER_SUCCESS", c)))
             except Exception as e:
                 self.message_queue.put(("DISCOVER_ERROR", f"发现设备失败: {str(e)}"))
         
         threading.Thread(target=discover, daemon=True).start()
     
-    def check_upnp_capabilities(self, upnp):
-        """检查UPnP功能支持"""
-        try:
-            # 检查路由器型号信息
-            if hasattr(upnp, 'lanaddr'):
-                self.log_message(f"路由器LAN地址: {upnp.lanaddr}", "INFO")
-            if hasattr(upnp, 'wanaddr'):
-                self.log_message(f"路由器WAN地址: {upnp.wanaddr}", "INFO")
-            
-            # 尝试获取端口映射数量（如果支持的话）
+    def on_gateway_selected(self, event=None):
+        """用户在网关列表中切换网关"""
+        index = self.gateway_combo.current()
+        if index < 0 or index >= len(self.gateways):
+            return
+        gateway = self.gateways[index]
+        if gateway.upnp is self.upnp:
+            return
+        self.log_message(f"正在切换到网关: {gateway.root_url or gateway.control_url}")
+        
+        def switch():
             try:
-                mapping_count = 0
-                i = 0
-                while True:
-                    try:
-                        # 尝试获取端口映射条目
-                        result = upnp.getgenericportmappingentry(i)
-                        if result:
-                            mapping_count += 1
-                            i += 1
-                        else:
-                            break
-                    except:
-                        break
-                
-                self.log_message(f"当前已有 {mapping_count} 个端口映射", "INFO")
-            except:
-                self.log_message("无法获取现有端口映射信息", "WARNING")
-            
-            self.log_message("路由器UPnP功能检查完成", "SUCCESS")
-            
-        except Exception as e:
-            self.log_message(f"UPnP功能检查失败: {str(e)}", "WARNING")
+                upnp_core.connect_gateway(gateway, self.gateways, user_selected=True, log=self.log_message,
+                                          on_ready=lambda c: self.message_queue.put(("DISCOVER_SUCCESS", c)))
+            except Exception as e:
+                self.message_queue.put(("DISCOVER_ERROR", f"连接网关失败: {str(e)}"))
+        
+        threading.Thread(target=switch, daemon=True).start()
+    
+    def format_gateway(self, gateway):
+        name = urllib.parse.urlsplit(gateway.root_url or gateway.control_url).netloc
+        rtt = f", {gateway.rtt * 1000:.0f}ms" if gateway.rtt is not None else ""
+        return f"{name} ({gateway.external_ip}{rtt})"
     
-    def process_queue(self):
-        """处理消息队列"""
+    def process_queue(self, event=None):
+        """处理消息队列，每次最多 QUEUE_BATCH 条"""
+        self.message_queue.acknowledge()
         try:
-            while True:
+            for _ in range(QUEUE_BATCH):
                 message_type, data = self.message_queue.get_nowait()
                 
                 if message_type == "DISCOVER_START":
@@ -485,7 +654,11 @@ class UPNPGui:
                     self.log_message("正在发现UPnP设备...")
                     
                 elif message_type == "DISCOVER_SUCCESS":
-                    self.upnp, self.external_ip, device_count = data
+                    self.upnp, self.external_ip, self.gateways = data.upnp, data.external_ip, data.gateways
+                    device_count = len(self.gateways)
+                    self.gateway_combo['values'] = [self.format_gateway(g) for g in self.gateways]
+                    self.gateway_combo.current(self.gateways.index(data.gateway))
+                    self.replace_mapping_table(data.mapping_table)
                     self.device_status.config(text=f"已连接 (发现{device_count}个设备)", fg='#27ae60')
                     self.external_ip_label.config(text=f"外网IP: {self.external_ip}")
                     self.update_status(f"已连接UPnP设备 ({device_count}个)", '#27ae60')
@@ -512,11 +685,42 @@ class UPNPGui:
                     self.log_message(str(data), "ERROR")
                     self.update_status("操作失败", '#e74c3c')
                     
+                elif message_type == "FORWARD_CHANGED":
+                    self.schedule_forward_stats()
+                    
+                elif message_type == "FORWARD_STATS":
+                    self.show_forward_stats(data)
+                    
+                elif message_type == "LOG":
+                    self.log_message(*data)
+                    
+                elif message_type == "SCAN_HOST":
+                    self.log_message(f"发现活跃设备: {data.ip} ({data.method})", "SUCCESS")
+                    # 发现一个合并一个，扫描期间即可选择
+                    values = list(self.internal_ip_combo['values'])
+                    if data.ip not in values:
+                        self.internal_ip_combo['values'] = values + [data.ip]
+                    
+                elif message_type == "HOSTS_CHANGED":
+                    # 扫描期间由 SCAN_HOST 逐个追加
+                    if self.ip_type_var.get() == "自定义IP" and self.scan_cancel is None:
+                        self.internal_ip_combo['values'] = (["127.0.0.1"] + self.get_local_ips()
+                                                            + self.get_network_ips())
+                    
+                elif message_type == "BATCH_PROGRESS":
+                    self.update_status(f"正在批量添加端口映射 ({data[0]}/{data[1]})...", '#f39c12')
+                    
+                elif message_type == "SCAN_PROGRESS":
+                    self.scan_progress['value'] = data * 100
+                    
+                elif message_type == "SCAN_DONE":
+                    self.finish_scan(*data)
+                    
         except queue.Empty:
-            pass
+            return
         
-        # 每100ms检查一次队列
-        self.root.after(100, self.process_queue)
+        # 还有未处理的消息，空闲时继续，期间界面可以响应输入和重绘
+        self.root.after_idle(self.process_queue)
     
     def update_button_states(self):
         """更新按钮状态"""
@@ -553,6 +757,11 @@ class UPNPGui:
             internal_ip = self.internal_ip_var.get()
             protocol = self.protocol_var.get()
             description = self.description_var.get()
+            lease = int(self.lease_var.get() or 0)
+            
+            if lease < 0:
+                messagebox.showerror("错误", "租期不能为负数")
+                return
             
             if not internal_ip:
                 messagebox.showerror("错误", "请输入目标IP地址")
@@ -565,63 +774,33 @@ class UPNPGui:
             
             def add_mapping():
                 try:
-                    # 尝试不同的参数组合
                     success = False
                     error_msg = ""
                     
-                    # 首先检查端口是否可能被占用
+                    # 首先检查端口是否已被映射到其他地址
+                    existing = self.lookup_mapping(external_port, protocol)
+                    if existing is not None and (existing.internal_ip, existing.internal_port) != (internal_ip, internal_port):
+                        self.log_message(f"端口 {external_port} 已被映射到: {existing.internal_ip}:{existing.internal_port}", "WARNING")
+                        free_ports = self.mapping_table.find_free_ports(5, external_port, protocol)
+                        if free_ports:
+                            self.log_message(f"附近可用的端口: {', '.join(map(str, free_ports))}", "INFO")
+                        self.message_queue.put(("OPERATION_ERROR", f"添加端口映射失败: 端口 {protocol} {external_port} 已被占用"))
+                        return
+                    
                     self.log_message(f"正在尝试添加端口映射...")
                     
-                    # 方法1：标准参数
+                    # 先用路由器档案中记录的参数组合，失败时才尝试其他组合
                     try:
-                        result = self.upnp.addportmapping(external_port, protocol, internal_ip, 
-                                                        internal_port, description, '')
-                        if result:
-                            success = True
-                            self.log_message("使用标准参数成功", "SUCCESS")
-                    except Exception as e1:
-                        error_msg = str(e1)
-                        self.log_message(f"标准参数失败: {str(e1)}", "WARNING")
-                        
-                        # 方法2：尝试不同的描述格式
-                        try:
-                            result = self.upnp.addportmapping(external_port, protocol, internal_ip, 
-                                                            internal_port, description, '0')
-                            if result:
-                                success = True
-                                self.log_message("使用修改后的远程主机参数成功", "SUCCESS")
-                        except Exception as e2:
-                            self.log_message(f"修改远程主机参数失败: {str(e2)}", "WARNING")
-                            
-                            # 方法3：尝试更简单的描述
-                            try:
-                                simple_desc = f"Port{external_port}"
-                                result = self.upnp.addportmapping(external_port, protocol, internal_ip, 
-                                                                internal_port, simple_desc, '')
-                                if result:
-                                    success = True
-                                    self.log_message("使用简化描述成功", "SUCCESS")
-                            except Exception as e3:
-                                self.log_message(f"简化描述失败: {str(e3)}", "WARNING")
-                                
-                                # 方法4：尝试不同的端口
-                                try:
-                                    alt_port = external_port + 1
-                                    result = self.upnp.addportmapping(alt_port, protocol, internal_ip, 
-                                                                    internal_port, description, '')
-                                    if result:
-                                        success = True
-                                        self.log_message(f"使用替代端口 {alt_port} 成功", "SUCCESS")
-                                except Exception as e4:
-                                    # 方法5：尝试最简参数
-                                    try:
-                                        result = self.upnp.addportmapping(external_port, protocol, internal_ip, 
-                                                                        internal_port, "UPnP", '')
-                                        if result:
-                                            success = True
-                                            self.log_message("使用最简参数成功", "SUCCESS")
-                                    except Exception as e5:
-                                        error_msg = f"所有方法都失败。主要错误: {str(e1)}"
+                        label = self.mapping_table.add_learned(
+                            external_port, protocol, internal_ip, internal_port, description, lease,
+                            on_failure=lambda label, e: self.log_message(f"{label}失败: {str(e)}", "WARNING"))
+                        success = True
+                        self.log_message(f"使用{label}成功", "SUCCESS")
+                    except Exception as e:
+                        error_msg = str(e)
+                        free_ports = self.mapping_table.find_free_ports(5, external_port, protocol)
+                        if free_ports:
+                            self.log_message(f"可以尝试其他端口: {', '.join(map(str, free_ports))}", "INFO")
                     
                     if success:
                         self.message_queue.put(("OPERATION_SUCCESS", 
@@ -649,6 +828,54 @@ class UPNPGui:
         except Exception as e:
             messagebox.showerror("错误", f"参数错误: {str(e)}")
     
+    def import_mappings(self):
+        """从 CSV/JSON 文件批量添加端口映射"""
+        if not self.upnp:
+            messagebox.showerror("错误", "未连接到UPnP设备")
+            return
+        
+        path = filedialog.askopenfilename(title="选择映射规则文件",
+                                          filetypes=[("规则文件", "*.csv *.json"), ("所有文件", "*.*")])
+        if not path:
+            return
+        
+        try:
+            rules = port_mapping.load_rules(path)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("错误", f"读取规则文件失败: {str(e)}")
+            return
+        if not rules:
+            messagebox.showinfo("提示", "文件中没有映射规则")
+            return
+        
+        rollback = messagebox.askyesno("批量导入", f"共 {len(rules)} 条规则。\n任一规则失败时回滚本次已添加的映射？")
+        
+        def on_result(result, done, total):
+            rule = result.rule
+            text = f"{rule.protocol} {rule.external_port} -> {rule.internal_ip}:{rule.internal_port}"
+            if result.error is None:
+                self.message_queue.put(("LOG", (f"[{done}/{total}] 已添加: {text}", "SUCCESS")))
+            else:
+                self.message_queue.put(("LOG", (f"[{done}/{total}] 失败: {text}: {result.error}", "ERROR")))
+            self.message_queue.put(("BATCH_PROGRESS", (done, total)))
+        
+        def apply():
+            try:
+                results, rolled_back = self.mapping_table.apply_batch(rules, rollback=rollback, on_result=on_result)
+                failed = sum(1 for result in results if result.error is not None)
+                if not failed:
+                    self.message_queue.put(("OPERATION_SUCCESS", f"批量添加完成: {len(results)} 条映射"))
+                elif rolled_back:
+                    self.message_queue.put(("OPERATION_ERROR", f"批量添加失败 {failed} 条，已回滚本次添加的映射"))
+                else:
+                    self.message_queue.put(("OPERATION_ERROR", f"批量添加完成: 成功 {len(results) - failed} 条，失败 {failed} 条"))
+            except Exception as e:
+                self.message_queue.put(("OPERATION_ERROR", f"批量添加失败: {str(e)}"))
+        
+        threading.Thread(target=apply, daemon=True).start()
+        self.log_message(f"正在批量添加 {len(rules)} 条端口映射...")
+        self.update_status(f"正在批量添加端口映射 (0/{len(rules)})...", '#f39c12')
+    
     def remove_port_mapping(self):
         """删除端口映射"""
         if not self.upnp:
@@ -661,7 +888,7 @@ class UPNPGui:
             
             def remove_mapping():
                 try:
-                    result = self.upnp.deleteportmapping(external_port, protocol)
+                    result = self.mapping_table.deleteportmapping(external_port, protocol)
                     if result:
                         self.message_queue.put(("OPERATION_SUCCESS", 
                                               f"端口映射删除成功: {protocol} {external_port}"))
@@ -678,67 +905,112 @@ class UPNPGui:
         except Exception as e:
             messagebox.showerror("错误", f"参数错误: {str(e)}")
     
+    def replace_mapping_table(self, table):
+        """换用新网关的映射表镜像；同一网关时由新镜像继续为带租期的映射续约"""
+        old = self.mapping_table or self.retired_table
+        self.mapping_table, self.retired_table = table, None
+        table.start()
+        if old is None:
+            return
+        leases = old.stop()
+        if old.control_url == table.control_url:
+            table.adopt_leases(leases)
+        elif leases:
+            ports = ", ".join(f"{m.protocol} {m.external_port}" for m in leases[:10])
+            more = f" 等 {len(leases)} 个" if len(leases) > 10 else ""
+            self.log_message(f"已切换网关，以下带租期的映射不再续约，将在租期到期后失效: {ports}{more}",
+                             "WARNING")
+    
     def refresh_devices(self):
         """刷新设备"""
         self.upnp = None
+        if self.mapping_table is not None:
+            self.retired_table = self.retired_table or self.mapping_table
+            self.mapping_table = None
         self.external_ip = None
         self.device_status.config(text="正在发现设备...", fg='#e67e22')
         self.external_ip_label.config(text="")
         self.update_button_states()
         self.log_message("正在刷新设备...")
-        self.discover_devices_async()
+        # 用户主动刷新时重新进行 SSDP 发现，并更新保存的网关
+        self.discover_devices_async(use_cache=False)
     
     def scan_network(self):
         """扫描网络中的活跃设备"""
+        if self.scan_cancel is not None:
+            self.log_message("网络扫描正在进行中", "WARNING")
+            return
+        
+        cancel = threading.Event()
+        self.scan_cancel = cancel
+        self.scan_button.config(state='disabled')
+        self.cancel_scan_button.config(state='normal')
+        self.scan_progress['value'] = 0
+        # 以本机地址为基础，扫描到的设备逐个追加
+        self.internal_ip_combo['values'] = ["127.0.0.1"] + self.get_local_ips()
+        
+        def log(message, level="INFO"):
+            self.message_queue.put(("LOG", (message, level)))
+        
+        def on_alive(result):
+            self.host_cache.update(result)
+            self.message_queue.put(("SCAN_HOST", result))
+        
         def scan():
-            self.log_message("开始扫描网络中的活跃设备...")
-            local_ips = self.get_local_ips()
-            
-            if not local_ips:
-                self.log_message("无法获取本机IP，扫描终止", "ERROR")
-                return
-            
-            local_ip = local_ips[0]
-            if '.' not in local_ip:
-                self.log_message("无法解析网络段，扫描终止", "ERROR")
-                return
-            
-            ip_parts = local_ip.split('.')
-            network_base = '.'.join(ip_parts[:3])
-            
-            active_ips = []
-            self.log_message(f"扫描网络段: {network_base}.x")
-            
-            # 扫描前20个IP（避免扫描时间过长）
-            for i in range(1, 21):
-                test_ip = f"{network_base}.{i}"
-                if test_ip == local_ip:
-                    continue
+            results = []
+            try:
+                log("开始扫描网络中的活跃设备...")
+                interfaces = net_scan.list_interfaces()
                 
-                try:
-                    # 使用ping检测设备是否在线
-                    import subprocess
-                    result = subprocess.run(['ping', '-n', '1', '-w', '1000', test_ip], 
-                                          capture_output=True, text=True, timeout=2)
-                    if result.returncode == 0:
-                        active_ips.append(test_ip)
-                        self.log_message(f"发现活跃设备: {test_ip}", "SUCCESS")
-                except:
-                    pass
-            
-            if active_ips:
-                self.log_message(f"扫描完成，发现{len(active_ips)}个活跃设备", "SUCCESS")
-                # 更新IP选项列表
-                local_ips = self.get_local_ips()
-                all_ips = ["127.0.0.1"] + local_ips + active_ips
-                self.internal_ip_combo['values'] = all_ips
-                if self.ip_type_var.get() == "自定义IP":
-                    self.log_message("IP列表已更新，可以选择扫描到的设备IP")
-            else:
-                self.log_message("未发现其他活跃设备", "WARNING")
+                if not interfaces:
+                    log("无法获取本机网卡地址，扫描终止", "ERROR")
+                    return
+                
+                per_interface = max(1, self.scan_max_hosts // len(interfaces))
+                for interface in interfaces:
+                    hosts = net_scan.interface_hosts(interface, per_interface)
+                    if hosts:
+                        log(f"扫描网络段: {interface.name} {interface.network} "
+                            f"({hosts[0]} - {hosts[-1]}, {len(hosts)}个地址)")
+                
+                # 各网卡并行扫描，每个网段在进程内并发探测（邻居表 / ICMP / TCP）；
+                # 结果和进度经消息队列交给界面线程
+                results = net_scan.scan_interfaces(
+                    interfaces, max_hosts=self.scan_max_hosts,
+                    concurrency=self.scan_concurrency, cancel=cancel,
+                    on_alive=on_alive,
+                    on_progress=lambda f: self.message_queue.put(("SCAN_PROGRESS", f)))
+            except Exception as e:
+                log(f"网络扫描失败: {str(e)}", "ERROR")
+            finally:
+                self.message_queue.put(("SCAN_DONE", (len(results), cancel.is_set())))
         
         threading.Thread(target=scan, daemon=True).start()
     
+    def cancel_scan(self):
+        """取消正在进行的网络扫描"""
+        if self.scan_cancel is not None:
+            self.scan_cancel.set()
+            self.cancel_scan_button.config(state='disabled')
+            self.log_message("正在取消网络扫描...", "WARNING")
+    
+    def finish_scan(self, count, cancelled):
+        """扫描线程结束后在界面线程中恢复按钮状态"""
+        self.scan_cancel = None
+        self.scan_button.config(state='normal')
+        self.cancel_scan_button.config(state='disabled')
+        
+        if cancelled:
+            self.log_message(f"网络扫描已取消，已发现{count}个活跃设备", "WARNING")
+        elif count:
+            self.scan_progress['value'] = 100
+            self.log_message(f"扫描完成，发现{count}个活跃设备", "SUCCESS")
+            if self.ip_type_var.get() == "自定义IP":
+                self.log_message("IP列表已更新，可以选择扫描到的设备IP")
+        else:
+            self.scan_progress['value'] = 100
+            self.log_message("未发现其他活跃设备", "WARNING")
+    
     def test_connection(self):
         """测试到目标IP的连接"""
         if not self.upnp:
@@ -757,17 +1029,17 @@ class UPNPGui:
         def test():
             self.log_message(f"正在测试到 {target_ip} 的连接...")
             
-            # 测试ping连接
+            # 测试主机是否在线
             try:
-                import subprocess
-                result = subprocess.run(['ping', '-n', '2', target_ip], 
-                                      capture_output=True, text=True, timeout=5)
-                if result.returncode == 0:
-                    self.log_message(f"Ping {target_ip} 成功", "SUCCESS")
+                result = net_scan.probe_host(target_ip, timeout=2)
+                if result is not None:
+                    self.host_cache.update(result)
+                    latency = f", 延迟 {result.latency * 1000:.1f}ms" if result.latency is not None else ""
+                    self.log_message(f"主机 {target_ip} 在线 (探测方式: {result.method}{latency})", "SUCCESS")
                 else:
-                    self.log_message(f"Ping {target_ip} 失败", "ERROR")
+                    self.log_message(f"主机 {target_ip} 无响应", "ERROR")
             except Exception as e:
-                self.log_message(f"Ping测试失败: {str(e)}", "ERROR")
+                self.log_message(f"主机探测失败: {str(e)}", "ERROR")
             
             # 测试端口连接
             try:
@@ -786,15 +1058,21 @@ class UPNPGui:
             
             # 测试UPnP端口映射功能
             try:
-                # 尝试添加一个临时测试端口映射
+                # 尝试添加一个临时测试端口映射，避开已被占用的端口
                 test_external_port = 9999
-                result = self.upnp.addportmapping(test_external_port, "TCP", target_ip, 
+                if self.lookup_mapping(test_external_port, "TCP") is not None:
+                    free_ports = self.mapping_table.find_free_ports(1, test_external_port, "TCP")
+                    if not free_ports:
+                        self.log_message("没有可用于测试的空闲端口", "ERROR")
+                        return
+                    test_external_port = free_ports[0]
+                result = self.mapping_table.addportmapping(test_external_port, "TCP", target_ip, 
                                                 test_port, "TestConnection", '')
                 if result:
                     self.log_message("UPnP端口映射功能正常", "SUCCESS")
                     # 立即删除测试映射
                     try:
-                        self.upnp.deleteportmapping(test_external_port, "TCP")
+                        self.mapping_table.deleteportmapping(test_external_port, "TCP")
                         self.log_message("测试端口映射已清理", "INFO")
                     except:
                         self.log_message("注意：测试端口映射可能未完全清理", "WARNING")
@@ -825,39 +1103,16 @@ class UPNPGui:
             try:
                 self.log_message("正在获取当前端口映射...")
                 
-                mappings = []
-                i = 0
-                
-                # 使用正确的方法获取端口映射
-                while True:
-                    try:
-                        # 尝试获取端口映射条目
-                        result = self.upnp.getgenericportmappingentry(i)
-                        if result:
-                            mappings.append(result)
-                            i += 1
-                        else:
-                            break
-                    except:
-                        break
+                mappings = self.mapping_table.mappings()
                 
                 if mappings:
                     self.log_message(f"发现 {len(mappings)} 个端口映射:", "INFO")
                     self.log_message("-" * 60, "INFO")
                     
                     for i, mapping in enumerate(mappings, 1):
-                        if len(mapping) >= 6:
-                            external_port = mapping[0]
-                            protocol = mapping[1]
-                            internal_ip = mapping[2]
-                            internal_port = mapping[3]
-                            description = mapping[4]
-                            enabled = mapping[5] if len(mapping) > 5 else "未知"
-                            
-                            self.log_message(f"{i}. {protocol} {external_port} -> {internal_ip}:{internal_port}", "INFO")
-                            self.log_message(f"   描述: {description}, 状态: {'启用' if enabled else '禁用'}", "INFO")
-                        else:
-                            self.log_message(f"{i}. {mapping}", "INFO")
+                        self.log_message(f"{i}. {mapping.protocol} {mapping.external_port} -> "
+                                         f"{mapping.internal_ip}:{mapping.internal_port}", "INFO")
+                        self.log_message(f"   描述: {mapping.description}, 状态: {'启用' if mapping.enabled else '禁用'}", "INFO")
                     
                     self.log_message("-" * 60, "INFO")
                 else:
@@ -870,6 +1125,14 @@ class UPNPGui:
         
         threading.Thread(target=view, daemon=True).start()
     
+    def lookup_mapping(self, external_port, protocol):
+        """查询单个端口的映射：GetSpecificPortMappingEntry 一次请求，失败时退回映射表镜像"""
+        try:
+            return self.mapping_table.lookup(external_port, protocol)
+        except Exception as e:
+            self.log_message(f"查询端口映射失败，使用缓存的映射表: {str(e)}", "WARNING")
+            return self.mapping_table.get(external_port, protocol)
+    
     def check_port(self):
         """检查端口是否可用"""
         if not self.upnp:
@@ -887,50 +1150,17 @@ class UPNPGui:
             try:
                 self.log_message(f"正在检查端口 {external_port} ({protocol}) 是否可用...")
                 
-                # 检查端口是否已被占用
-                port_in_use = False
-                try:
-                    # 尝试获取该端口的映射信息
-                    i = 0
-                    while True:
-                        try:
-                            result = self.upnp.getgenericportmappingentry(i)
-                            if result and len(result) >= 3:
-                                if result[0] == external_port and result[1] == protocol:
-                                    port_in_use = True
-                                    self.log_message(f"端口 {external_port} 已被映射到: {result[2]}:{result[3] if len(result) > 3 else 'N/A'}", "WARNING")
-                                    break
-                            i += 1
-                        except:
-                            break
-                except:
-                    pass
+                # 只查询这一个端口，不遍历映射表也不在路由器上试加映射
+                mapping = self.lookup_mapping(external_port, protocol)
                 
-                if not port_in_use:
+                if mapping is None:
                     self.log_message(f"端口 {external_port} ({protocol}) 可用", "SUCCESS")
-                    
-                    # 尝试测试添加一个临时映射来验证端口可用性
-                    try:
-                        test_result = self.upnp.addportmapping(external_port, protocol, "127.0.0.1", 
-                                                             external_port, "PortCheck", '')
-                        if test_result:
-                            self.log_message("端口映射功能正常，端口可以添加", "SUCCESS")
-                            # 立即删除测试映射
-                            try:
-                                self.upnp.deleteportmapping(external_port, protocol)
-                                self.log_message("测试映射已清理", "INFO")
-                            except:
-                                self.log_message("注意：测试映射可能未完全清理", "WARNING")
-                        else:
-                            self.log_message("端口映射添加失败，端口可能不可用", "ERROR")
-                    except Exception as e:
-                        self.log_message(f"端口测试失败: {str(e)}", "ERROR")
-                        if "Invalid Args" in str(e):
-                            self.log_message("可能原因：端口已被占用或路由器不支持该端口", "WARNING")
-                        elif "Conflict" in str(e):
-                            self.log_message("端口冲突：该端口已被其他映射使用", "WARNING")
                 else:
+                    self.log_message(f"端口 {external_port} 已被映射到: {mapping.internal_ip}:{mapping.internal_port}", "WARNING")
                     self.log_message(f"端口 {external_port} 不可用，已被占用", "ERROR")
+                    free_ports = self.mapping_table.find_free_ports(5, external_port, protocol)
+                    if free_ports:
+                        self.log_message(f"附近可用的端口: {', '.join(map(str, free_ports))}", "INFO")
                     
             except Exception as e:
                 self.log_message(f"检查端口失败: {str(e)}", "ERROR")
@@ -948,6 +1178,7 @@ class UPNPGui:
             internal_port = int(self.internal_port_var.get())
             target_ip = self.internal_ip_var.get()
             protocol = self.protocol_var.get()
+            use_splice = self.splice_var.get()
             
             if not self.validate_ip(target_ip):
                 messagebox.showerror("错误", "IP地址格式不正确")
@@ -963,89 +1194,86 @@ class UPNPGui:
             return
         
         local_ip = local_ips[0]
+        rule = port_forward.ForwardRule(protocol, local_ip, external_port, target_ip, internal_port,
+                                        splice=use_splice)
         
         def forward():
             try:
                 self.log_message("🚀 启动端口转发解决方案...", "INFO")
                 self.log_message(f"方案：映射到本机 {local_ip}:{external_port}，然后转发到 {target_ip}:{internal_port}", "INFO")
                 
-                # 第一步：映射到本机
-                self.log_message("步骤1：添加端口映射到本机...")
-                mapping_result = self.upnp.addportmapping(external_port, protocol, local_ip, 
-                                                        external_port, f"Forward to {target_ip}:{internal_port}", '')
-                
-                if mapping_result:
-                    self.log_message("✅ 端口映射到本机成功", "SUCCESS")
-                    
-                    # 第二步：启动端口转发服务
-                    self.log_message("步骤2：启动本机端口转发服务...")
-                    self.log_message(f"本机端口转发：{external_port} -> {target_ip}:{internal_port}", "INFO")
-                    
-                    # 创建端口转发服务
-                    import threading
-                    import time
-                    
-                    def port_forward_server():
-                        try:
-                            if protocol == "TCP":
-                                server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                                server_socket.bind((local_ip, external_port))
-                                server_socket.listen(5)
-                                
-                                self.log_message(f"✅ 端口转发服务已启动：{local_ip}:{external_port}", "SUCCESS")
-                                self.log_message("按 Ctrl+C 停止转发服务", "INFO")
-                                
-                                while True:
-                                    try:
-                                        client_socket, addr = server_socket.accept()
-                                        self.log_message(f"新连接来自: {addr}", "INFO")
-                                        
-                                        # 创建到目标服务器的连接
-                                        target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                                        target_socket.connect((target_ip, internal_port))
-                                        
-                                        # 启动数据转发线程
-                                        def forward_data(src, dst, direction):
-                                            try:
-                                                while True:
-                                                    data = src.recv(4096)
-                                                    if not data:
-                                                        break
-                                                    dst.send(data)
-                                            except:
-                                                pass
-                                            finally:
-                                                src.close()
-                                                dst.close()
-                                        
-                                        threading.Thread(target=forward_data, args=(client_socket, target_socket, "->"), daemon=True).start()
-                                        threading.Thread(target=forward_data, args=(target_socket, client_socket, "<-"), daemon=True).start()
-                                        
-                                    except Exception as e:
-                                        if "KeyboardInterrupt" not in str(e):
-                                            self.log_message(f"连接处理错误: {str(e)}", "ERROR")
-                                        break
-                                        
-                        except Exception as e:
-                            self.log_message(f"端口转发服务启动失败: {str(e)}", "ERROR")
-                    
-                    # 启动转发服务
-                    forward_thread = threading.Thread(target=port_forward_server, daemon=True)
-                    forward_thread.start()
-                    
-                    self.log_message("🎉 端口转发解决方案已启动！", "SUCCESS")
-                    self.log_message(f"外部访问地址: {self.external_ip}:{external_port}", "SUCCESS")
-                    self.log_message("转发路径: 外网 -> 本机 -> 目标设备", "INFO")
-                    
+                # 映射到本机并在共享事件循环上启动转发
+                self.forward_service.upnp = self.mapping_table
+                if (protocol, external_port) in self.forward_service.rules:
+                    self.log_message(f"端口 {external_port} ({protocol}) 已有转发规则，正在替换...", "WARNING")
+                    forwarder = self.forward_service.update_rule(rule)
                 else:
-                    self.log_message("❌ 端口映射到本机失败", "ERROR")
-                    self.log_message("无法启动端口转发服务", "ERROR")
+                    forwarder = self.forward_service.add_rule(rule)
+                self.message_queue.put(("FORWARD_CHANGED", None))
+                
+                self.log_message("✅ 端口映射到本机成功", "SUCCESS")
+                self.log_message(f"✅ 端口转发服务已启动：{local_ip}:{external_port}", "SUCCESS")
+                if getattr(forwarder, 'splice', False):
+                    self.log_message("转发模式：零拷贝(splice)", "INFO")
+                
+                self.log_message("🎉 端口转发解决方案已启动！", "SUCCESS")
+                self.log_message(f"外部访问地址: {self.external_ip}:{external_port}", "SUCCESS")
+                self.log_message("转发路径: 外网 -> 本机 -> 目标设备", "INFO")
                     
             except Exception as e:
                 self.log_message(f"端口转发启动失败: {str(e)}", "ERROR")
         
         threading.Thread(target=forward, daemon=True).start()
+    
+    def view_forwards(self):
+        """查看正在运行的端口转发"""
+        rules = self.forward_service.list_rules()
+        if not rules:
+            self.log_message("当前没有运行中的端口转发", "INFO")
+            return
+        
+        self.log_message(f"运行中的端口转发 {len(rules)} 条:", "INFO")
+        self.log_message("-" * 60, "INFO")
+        for i, (rule, connections) in enumerate(rules, 1):
+            self.log_message(f"{i}. {rule}  活跃连接: {connections}", "INFO")
+        self.log_message("-" * 60, "INFO")
+    
+    def stop_port_forward(self):
+        """停止当前外部端口上的端口转发"""
+        try:
+            external_port = int(self.external_port_var.get())
+            protocol = self.protocol_var.get()
+        except ValueError:
+            messagebox.showerror("错误", "请输入有效的端口号")
+            return
+        
+        def stop():
+            try:
+                if self.forward_service.remove_rule(protocol, external_port):
+                    self.message_queue.put(("OPERATION_SUCCESS", f"端口转发已停止: {protocol} {external_port}"))
+                    self.message_queue.put(("FORWARD_CHANGED", None))
+                else:
+                    self.message_queue.put(("OPERATION_ERROR", f"没有运行中的端口转发: {protocol} {external_port}"))
+            except Exception as e:
+                self.message_queue.put(("OPERATION_ERROR", f"停止端口转发失败: {str(e)}"))
+        
+        threading.Thread(target=stop, daemon=True).start()
+        self.log_message(f"正在停止端口转发: {protocol} {external_port}")
+    
+    def on_close(self):
+        """关闭窗口时停止所有转发并清理其端口映射"""
+        # 后台线程的日志不再唤醒界面线程，避免等待线程结束时互相阻塞
+        self.message_queue.close()
+        try:
+            self.forward_service.stop()
+        except Exception:
+            pass
+        self.host_cache.stop()
+        for table in (self.mapping_table, self.retired_table):
+            if table is not None:
+                # 带租期的映射不再续约，直接删除
+                table.stop(release_leases=True)
+        self.root.destroy()
 
 def main():
     if not UPNPC_AVAILABLE: